@@ -1,8 +1,11 @@
 from .main import (
     create_memory,
+    create_memories,
     create_unique_memory,
     get_memories,
+    list_memories,
     search_memory,
+    search_memory_batch,
     get_memory,
     update_memory,
     delete_memory,
@@ -41,19 +44,49 @@ from .persistence import (
 
 from .client import (
     get_client,
+    get_or_create_collection,
+    search_documents,
+    close_clients,
+    get_client_stats,
+    run_client_eviction,
 )
 
 from .clustering import (
     cluster,
 )
 
-from .check_model import check_model, infer_embeddings
+from .check_model import (
+    check_model,
+    quantize_model,
+    infer_embeddings,
+    get_embedding_engine,
+    get_embedding_stats,
+)
+
+from .embedding_cache import (
+    get_embedding_cache,
+    get_embedding_cache_stats,
+)
+
+from .pool import (
+    get_pool_stats,
+    close_pools,
+)
+
+from .batcher import (
+    get_embedding_batcher,
+    start_embedding_batcher,
+    stop_embedding_batcher,
+)
 
 __all__ = [
     "create_memory",
+    "create_memories",
     "create_unique_memory",
     "get_memories",
+    "list_memories",
     "search_memory",
+    "search_memory_batch",
     "get_memory",
     "update_memory",
     "delete_memory",
@@ -69,6 +102,11 @@ __all__ = [
     "import_json_to_memory",
     "import_file_to_memory",
     "get_client",
+    "get_or_create_collection",
+    "search_documents",
+    "close_clients",
+    "get_client_stats",
+    "run_client_eviction",
     "get_persistent_directory",
     "create_event",
     "get_epoch",
@@ -78,5 +116,15 @@ __all__ = [
     "set_epoch",
     "cluster",
     "check_model",
+    "quantize_model",
     "infer_embeddings",
+    "get_embedding_engine",
+    "get_embedding_stats",
+    "get_embedding_cache",
+    "get_embedding_cache_stats",
+    "get_pool_stats",
+    "close_pools",
+    "get_embedding_batcher",
+    "start_embedding_batcher",
+    "stop_embedding_batcher",
 ]
@@ -0,0 +1,254 @@
+"""
+Maintenance commands for the Postgres memory store.
+
+Usage: python -m agentmemory.admin index [--category NAME ...] [--rebuild]
+           [--method {hnsw,ivfflat}] [--m M] [--ef-construction N] [--lists N]
+       python -m agentmemory.admin migrate-metadata [--category NAME ...]
+           [--drop-columns]
+       python -m agentmemory.admin text-index [--category NAME ...]
+
+index: builds the ANN index of every memory table that lacks one, or with
+--rebuild replaces existing indexes (e.g. to change method or parameters).
+Indexes are built with CREATE INDEX CONCURRENTLY, so the tables stay writable.
+
+migrate-metadata: moves the metadata columns of each table into the indexed
+JSONB metadata column (POSTGRES_METADATA_LAYOUT=jsonb). Workers pick the
+layout of a table from its columns when they load the schema, so stop them
+while migrating, or restart them afterwards. --drop-columns removes the old
+columns once they are copied.
+
+text-index: adds the document_tsv word search column and the pg_trgm and
+tsvector indexes to tables created before they existed. Adding the generated
+column rewrites the table under an exclusive lock; the indexes are then built
+concurrently.
+"""
+import argparse
+import time
+from contextlib import contextmanager
+
+from psycopg2 import errors
+
+from agentmemory.client import POSTGRES_CONNECTION_STRING
+from agentmemory.postgres import (
+    JSONB_NUMERIC_KEYS,
+    NON_METADATA_COLUMNS,
+    PGVECTOR_HNSW_EF_CONSTRUCTION,
+    PGVECTOR_HNSW_M,
+    PGVECTOR_INDEX,
+    PostgresClient,
+    ivfflat_lists,
+    metadata_index_sql,
+    text_index_sql,
+    vector_index_sql,
+)
+
+# jsonb_build_object takes at most 100 arguments
+JSONB_BUILD_PAIRS = 50
+
+
+@contextmanager
+def autocommit_cursor(client):
+    # CONCURRENTLY statements cannot run inside a transaction block
+    connection = client.pool.getconn()
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cur:
+            yield cur
+    finally:
+        connection.autocommit = False
+        client.pool.putconn(connection)
+
+
+def build_index(
+    client,
+    category,
+    method=PGVECTOR_INDEX,
+    m=PGVECTOR_HNSW_M,
+    ef_construction=PGVECTOR_HNSW_EF_CONSTRUCTION,
+    lists=None,
+    rebuild=False,
+):
+    table_name = client._table_name(category)
+    index_name = f"{table_name}_embedding_idx"
+    with autocommit_cursor(client) as cur:
+        if lists is None:
+            cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+            lists = ivfflat_lists(cur.fetchone()[0])
+        target = f"{index_name}_rebuild" if rebuild else index_name
+        # a failed concurrent build leaves an invalid index behind
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}_rebuild")
+        try:
+            cur.execute(
+                vector_index_sql(
+                    table_name, method, m, ef_construction, lists, target, True
+                )
+            )
+        except (errors.UndefinedObject, errors.FeatureNotSupported):
+            if method != "hnsw":
+                raise
+            print(f"{table_name}: hnsw is not available, using ivfflat")
+            method = "ivfflat"
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {target}")
+            cur.execute(
+                vector_index_sql(
+                    table_name, method, m, ef_construction, lists, target, True
+                )
+            )
+        if rebuild:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+            cur.execute(f"ALTER INDEX {target} RENAME TO {index_name}")
+    return method
+
+
+def index_command(args):
+    if POSTGRES_CONNECTION_STRING is None:
+        raise EnvironmentError(
+            "Postgres connection string not set in environment variables!"
+        )
+    # no embeddings are computed here, so the model path is never used
+    client = PostgresClient(POSTGRES_CONNECTION_STRING)
+    categories = args.category or [c.name for c in client.list_collections()]
+    for category in categories:
+        started = time.perf_counter()
+        method = build_index(
+            client,
+            category,
+            method=args.method,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            lists=args.lists,
+            rebuild=args.rebuild,
+        )
+        print(
+            f"{client._table_name(category)}: {method} index ready "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+
+def metadata_object_sql(columns):
+    """SQL building the jsonb metadata object of a row from its TEXT columns."""
+    parts = []
+    for start in range(0, len(columns), JSONB_BUILD_PAIRS):
+        pairs = []
+        for column in columns[start : start + JSONB_BUILD_PAIRS]:
+            value = column
+            if column in JSONB_NUMERIC_KEYS:
+                # stored as numbers when they parse, like jsonb_metadata_value
+                value = (
+                    f"CASE WHEN {column} ~ '^-?[0-9]+(\\.[0-9]+)?([eE][-+]?[0-9]+)?$' "
+                    f"THEN to_jsonb({column}::double precision) "
+                    f"ELSE to_jsonb({column}) END"
+                )
+            pairs.append(f"'{column}', {value}")
+        parts.append(f"jsonb_build_object({', '.join(pairs)})")
+    # unset columns are left out, as if the key had never been written
+    return f"jsonb_strip_nulls({' || '.join(parts)})"
+
+
+def migrate_metadata(client, category, drop_columns=False):
+    table_name = client._table_name(category)
+    with autocommit_cursor(client) as cur:
+        cur.execute(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            """,
+            (table_name,),
+        )
+        columns = [
+            row[0]
+            for row in cur.fetchall()
+            if row[0] not in NON_METADATA_COLUMNS + ["metadata"]
+        ]
+        cur.execute(
+            f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS "
+            "metadata JSONB NOT NULL DEFAULT '{}'::jsonb"
+        )
+        if columns:
+            cur.execute(
+                f"UPDATE {table_name} "
+                f"SET metadata = metadata || {metadata_object_sql(columns)}"
+            )
+        for statement in metadata_index_sql(table_name, concurrently=True):
+            cur.execute(statement)
+        if drop_columns and columns:
+            cur.execute(
+                f"ALTER TABLE {table_name} "
+                + ", ".join(f"DROP COLUMN {column}" for column in columns)
+            )
+    client.schema.invalidate()
+    return columns
+
+
+def migrate_metadata_command(args):
+    if POSTGRES_CONNECTION_STRING is None:
+        raise EnvironmentError(
+            "Postgres connection string not set in environment variables!"
+        )
+    client = PostgresClient(POSTGRES_CONNECTION_STRING)
+    categories = args.category or [c.name for c in client.list_collections()]
+    for category in categories:
+        started = time.perf_counter()
+        columns = migrate_metadata(client, category, drop_columns=args.drop_columns)
+        print(
+            f"{client._table_name(category)}: {len(columns)} metadata columns "
+            f"migrated in {time.perf_counter() - started:.1f}s"
+        )
+
+
+def text_index_command(args):
+    if POSTGRES_CONNECTION_STRING is None:
+        raise EnvironmentError(
+            "Postgres connection string not set in environment variables!"
+        )
+    client = PostgresClient(POSTGRES_CONNECTION_STRING)
+    categories = args.category or [c.name for c in client.list_collections()]
+    with autocommit_cursor(client) as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for category in categories:
+        started = time.perf_counter()
+        table_name = client._table_name(category)
+        with autocommit_cursor(client) as cur:
+            for statement in text_index_sql(table_name, concurrently=True):
+                cur.execute(statement)
+        print(
+            f"{table_name}: text indexes ready "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+    client.schema.invalidate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index = subparsers.add_parser("index")
+    index.add_argument("--category", action="append")
+    index.add_argument("--rebuild", action="store_true")
+    index.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    index.add_argument("--m", type=int, default=PGVECTOR_HNSW_M)
+    index.add_argument(
+        "--ef-construction", type=int, default=PGVECTOR_HNSW_EF_CONSTRUCTION
+    )
+    index.add_argument(
+        "--lists", type=int, default=None, help="ivfflat lists, default rows/1000"
+    )
+
+    migrate = subparsers.add_parser("migrate-metadata")
+    migrate.add_argument("--category", action="append")
+    migrate.add_argument("--drop-columns", action="store_true")
+
+    text_index = subparsers.add_parser("text-index")
+    text_index.add_argument("--category", action="append")
+    args = parser.parse_args()
+
+    if args.command == "index":
+        index_command(args)
+    elif args.command == "migrate-metadata":
+        migrate_metadata_command(args)
+    elif args.command == "text-index":
+        text_index_command(args)
+
+
+if __name__ == "__main__":
+    main()
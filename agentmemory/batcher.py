@@ -0,0 +1,277 @@
+import asyncio
+import bisect
+import concurrent.futures
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from agentmemory.embedding_cache import cached_embeddings
+
+EMBEDDING_BATCH_MAX_SIZE = int(os.environ.get("EMBEDDING_BATCH_MAX_SIZE", 64))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_MAX_WAIT_MS", 5))
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+QUEUE_WAIT_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000]
+
+
+class Histogram:
+    """Bucket counts; the last bucket holds values above the largest bound."""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self) -> Dict:
+        labels = [f"<={bucket}" for bucket in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+        }
+
+
+class BatcherStopped(RuntimeError):
+    """Raised for requests still waiting when the batcher is stopped."""
+
+
+class _Request:
+    __slots__ = ("texts", "model_path", "model_name", "future", "enqueued")
+
+    def __init__(self, texts, model_path, model_name, future):
+        self.texts = texts
+        self.model_path = model_path
+        self.model_name = model_name
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests from concurrent coroutines and runs them as one
+    model call on a dedicated worker thread.
+
+    A batch is dispatched once it holds `max_batch_size` texts or the oldest
+    request has waited `max_wait_ms`. Requests for different models are never
+    mixed in one batch, and requests of more than `max_batch_size` texts are
+    split into several.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = EMBEDDING_BATCH_MAX_SIZE,
+        max_wait_ms: float = EMBEDDING_BATCH_MAX_WAIT_MS,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Optional[_Request] = None
+        self._in_flight: List[_Request] = []
+        # created by start, as stop shuts it down
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_BUCKETS_MS)
+
+    def start(self) -> None:
+        """Start the dispatch task on the running event loop."""
+        if self._task is not None and not self._task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="embedding-batcher"
+        )
+        self._task = self.loop.create_task(self._run(self._executor))
+
+    async def stop(self) -> None:
+        """Stop dispatching and fail the requests that were not embedded yet
+        with BatcherStopped, so nobody waits on them forever."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self.loop = None
+        waiting = self._in_flight + ([self._pending] if self._pending else [])
+        while self._queue is not None and not self._queue.empty():
+            waiting.append(self._queue.get_nowait())
+        self._in_flight, self._pending = [], None
+        for request in waiting:
+            if not request.future.done():
+                request.future.set_exception(
+                    BatcherStopped("embedding batcher stopped")
+                )
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def embed(
+        self, texts: List[str], model_path: str, model_name: Optional[str] = None
+    ) -> npt.NDArray:
+        if not self.running:
+            self.start()
+        texts = list(texts)
+        if len(texts) > self.max_batch_size:
+            parts = await asyncio.gather(
+                *(
+                    self.embed(
+                        texts[i : i + self.max_batch_size], model_path, model_name
+                    )
+                    for i in range(0, len(texts), self.max_batch_size)
+                )
+            )
+            return np.concatenate(parts)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(texts, model_path, model_name, future))
+        return await future
+
+    def embed_threadsafe(
+        self, texts: List[str], model_path: str, model_name: Optional[str] = None
+    ) -> npt.NDArray:
+        """
+        Blocking entry point for code running on worker threads, e.g. the
+        synchronous agentmemory calls. Falls back to embedding directly when
+        the batcher is not running or stops before the request is embedded,
+        or when called from the loop thread itself, where waiting on the loop
+        would deadlock.
+        """
+        loop = self.loop
+        if not self.running or loop is None or _on_loop_thread(loop):
+            return cached_embeddings(texts, model_path, model_name)
+        try:
+            return asyncio.run_coroutine_threadsafe(
+                self.embed(texts, model_path, model_name), loop
+            ).result()
+        except (BatcherStopped, concurrent.futures.CancelledError):
+            return cached_embeddings(texts, model_path, model_name)
+
+    async def _next_batch(self) -> List[_Request]:
+        first = self._pending or await self._queue.get()
+        self._pending = None
+        batch = [first]
+        size = len(first.texts)
+        deadline = first.enqueued + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if (request.model_path, request.model_name) != (
+                first.model_path,
+                first.model_name,
+            ) or size + len(request.texts) > self.max_batch_size:
+                # starts the next batch
+                self._pending = request
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    async def _run(self, executor: ThreadPoolExecutor) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self._in_flight = batch
+            dispatched = time.perf_counter()
+            texts = [text for request in batch for text in request.texts]
+            with self._stats_lock:
+                self.batch_sizes.observe(len(texts))
+                for request in batch:
+                    self.queue_wait_ms.observe((dispatched - request.enqueued) * 1000)
+            try:
+                embeddings = await loop.run_in_executor(
+                    executor,
+                    cached_embeddings,
+                    texts,
+                    batch[0].model_path,
+                    batch[0].model_name,
+                )
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self._in_flight = []
+                continue
+            offset = 0
+            for request in batch:
+                result = embeddings[offset : offset + len(request.texts)]
+                offset += len(request.texts)
+                if not request.future.done():
+                    request.future.set_result(np.array(result))
+            self._in_flight = []
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "running": self.running,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "queue_depth": self._queue.qsize() if self._queue else 0,
+                "batch_size": self.batch_sizes.snapshot(),
+                "queue_wait_ms": self.queue_wait_ms.snapshot(),
+            }
+
+
+def _on_loop_thread(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+_batcher: Optional[EmbeddingBatcher] = None
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher()
+    return _batcher
+
+
+async def start_embedding_batcher() -> EmbeddingBatcher:
+    batcher = get_embedding_batcher()
+    batcher.start()
+    return batcher
+
+
+async def stop_embedding_batcher() -> None:
+    global _batcher
+    if _batcher is not None:
+        await _batcher.stop()
+        _batcher = None
+
+
+def embed_documents(
+    documents: List[str], model_path: str, model_name: Optional[str] = None
+) -> npt.NDArray:
+    """
+    Embed through the shared micro-batcher when it is running, otherwise
+    straight through the embedding cache.
+    """
+    if _batcher is None:
+        return cached_embeddings(documents, model_path, model_name)
+    return _batcher.embed_threadsafe(documents, model_path, model_name)
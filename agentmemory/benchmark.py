@@ -0,0 +1,348 @@
+"""
+Embedding benchmarks.
+
+Usage: python -m agentmemory.benchmark {padding,quantization,tokens} [options]
+
+padding: compares the legacy fixed 256 token padding against dynamic padding,
+with and without length bucketing, on document length distributions resembling
+what the memory pipeline embeds: short search queries, 200 token chunks from
+MemoryManager.split_text_into_chunks, and a mix of both.
+
+quantization: compares the fp32 model with its int8 copy on a synthetic memory
+corpus, reporting embeddings/sec, recall@k of the memory each query was written
+from, and how much of the fp32 top-k the int8 model returns.
+
+tokens: times token_accounting.fit_lines and fit_pieces against the loops they
+replaced, which dropped one line and counted the whole history again, on
+histories of 100, 1k and 10k lines. The loops take minutes on 10k lines; lower
+--loop-max-lines to skip them there.
+"""
+import argparse
+import random
+import time
+from math import inf
+
+import numpy as np
+
+from agentmemory.check_model import (
+    QUANTIZED_SUFFIX,
+    EmbeddingEngine,
+    check_model,
+    default_model_path,
+)
+from token_accounting import _memoized_count, count_tokens, fit_lines, fit_pieces
+
+_WORDS = (
+    "the user asked about memory notes calendar meeting project python code "
+    "weather tomorrow remind me about book flight hotel berlin dinner friday "
+    "search results summary email draft review document function error fixed"
+).split()
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def make_documents(distribution, count, seed=0):
+    rng = random.Random(seed)
+    documents = []
+    for _ in range(count):
+        if distribution == "queries":
+            documents.append(_sentence(rng, rng.randint(3, 20)))
+        elif distribution == "chunks":
+            # chunks are capped at 200 tokens but the last one of a message is shorter
+            documents.append(_sentence(rng, min(190, int(rng.expovariate(1 / 90)) + 5)))
+        elif distribution == "mixed":
+            if rng.random() < 0.5:
+                documents.append(_sentence(rng, rng.randint(3, 20)))
+            else:
+                documents.append(_sentence(rng, rng.randint(20, 190)))
+        else:
+            raise ValueError(f"Unknown distribution {distribution}")
+    return documents
+
+
+def run_padding(model_path, count=512, batch_size=32, repeats=3):
+    fixed = EmbeddingEngine(model_path, fixed_padding=True)
+    dynamic = EmbeddingEngine(model_path)
+    modes = {
+        "fixed": lambda docs: fixed.embed(docs, batch_size, bucket_by_length=False),
+        "dynamic": lambda docs: dynamic.embed(docs, batch_size, bucket_by_length=False),
+        "bucketed": lambda docs: dynamic.embed(docs, batch_size, bucket_by_length=True),
+    }
+    results = []
+    for distribution in ("queries", "chunks", "mixed"):
+        documents = make_documents(distribution, count)
+        reference = None
+        for mode, embed in modes.items():
+            best = float("inf")
+            for _ in range(repeats):
+                started = time.perf_counter()
+                embeddings = embed(documents)
+                best = min(best, time.perf_counter() - started)
+            if reference is None:
+                reference = embeddings
+            results.append(
+                {
+                    "distribution": distribution,
+                    "mode": mode,
+                    "docs_per_sec": len(documents) / best,
+                    "max_abs_diff": float(np.abs(embeddings - reference).max()),
+                }
+            )
+    return results
+
+
+_PEOPLE = ["Anna", "Ben", "my sister", "the landlord", "Marek", "the dentist"]
+_PLACES = ["Prague", "the office", "Lisbon", "the gym", "home", "the airport"]
+_TOPICS = [
+    "the quarterly report",
+    "a birthday present",
+    "the broken heater",
+    "the python course",
+    "the rent payment",
+    "a hiking trip",
+    "the job interview",
+    "the car insurance",
+]
+_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "the weekend"]
+_MEMORY_TEMPLATES = [
+    "User mentioned that {person} will talk to them about {topic} in {place} on {day}.",
+    "Note: on {day} the user is meeting {person} at {place} regarding {topic}.",
+    "The user said {topic} needs to be sorted out with {person} before {day}.",
+]
+_QUERY_TEMPLATES = [
+    "when am I seeing {person} about {topic}?",
+    "what did I plan with {person} in {place}",
+    "remind me what's happening on {day} with {topic}",
+]
+
+
+def make_corpus(memories=2000, queries=200, seed=0):
+    """Synthetic memories plus queries that each paraphrase one of them."""
+    rng = random.Random(seed)
+    corpus, slots = [], []
+    for _ in range(memories):
+        values = {
+            "person": rng.choice(_PEOPLE),
+            "place": rng.choice(_PLACES),
+            "topic": rng.choice(_TOPICS),
+            "day": rng.choice(_DAYS),
+        }
+        corpus.append(rng.choice(_MEMORY_TEMPLATES).format(**values))
+        slots.append(values)
+    targets = rng.sample(range(memories), queries)
+    query_texts = [rng.choice(_QUERY_TEMPLATES).format(**slots[i]) for i in targets]
+    return corpus, query_texts, targets
+
+
+def _top_k(query_embeddings, corpus_embeddings, k):
+    scores = query_embeddings @ corpus_embeddings.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def _timed_embed(engine, documents, batch_size, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        embeddings = engine.embed(documents, batch_size)
+        best = min(best, time.perf_counter() - started)
+    return embeddings, len(documents) / best
+
+
+def run_quantization(
+    model_name="all-MiniLM-L6-v2",
+    model_path=default_model_path,
+    memories=2000,
+    queries=200,
+    k=10,
+    batch_size=32,
+    repeats=3,
+):
+    corpus, query_texts, targets = make_corpus(memories, queries)
+    results = {}
+    for variant in (model_name, model_name + QUANTIZED_SUFFIX):
+        engine = EmbeddingEngine(check_model(model_name=variant, model_path=model_path))
+        corpus_embeddings, docs_per_sec = _timed_embed(
+            engine, corpus, batch_size, repeats
+        )
+        query_embeddings = engine.embed(query_texts, batch_size)
+        top_k = _top_k(query_embeddings, corpus_embeddings, k)
+        results[variant] = {
+            "docs_per_sec": docs_per_sec,
+            "recall_at_k": float(
+                np.mean([target in row for target, row in zip(targets, top_k)])
+            ),
+            "top_k": top_k,
+        }
+    reference = results[model_name]["top_k"]
+    for result in results.values():
+        result["overlap_with_fp32"] = float(
+            np.mean(
+                [
+                    len(set(row) & set(reference_row)) / k
+                    for row, reference_row in zip(result.pop("top_k"), reference)
+                ]
+            )
+        )
+    return results
+
+
+def make_history(lines, seed=0):
+    """Chat history like text of `lines` lines, some of them empty."""
+    rng = random.Random(seed)
+    return "\n".join(_sentence(rng, rng.randint(0, 20)) for _ in range(lines))
+
+
+def loop_fit_lines(text, budget, model):
+    # the loop fit_lines replaced
+    token_count = count_tokens(text, model)
+    while token_count > budget:
+        lines = text.split("\n")
+        if len(lines) > 1:
+            lines.pop(-1)
+            text = "\n".join(lines)
+        else:
+            text = text[:-100]
+        token_count = count_tokens(text, model)
+    return text, token_count
+
+
+def loop_fit_pieces(pieces, budget, model):
+    # the loop of process_active_brain that fit_pieces(keep_last=True) replaced
+    pieces = list(pieces)
+    token_count = count_tokens("\n".join(pieces), model)
+    while token_count > budget and len(pieces) > 1:
+        pieces.pop(0)
+        token_count = count_tokens("\n".join(pieces), model)
+    return len(pieces), token_count
+
+
+def _best_time(function, repeats):
+    best = inf
+    for _ in range(repeats):
+        # every run starts from cold memoized counts
+        _memoized_count.cache_clear()
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return result, best
+
+
+def run_tokens(
+    lines=(100, 1000, 10000),
+    budget=1000,
+    model="gpt-4",
+    repeats=3,
+    loop_max_lines=10000,
+):
+    results = []
+    for count in lines:
+        text = make_history(count)
+        pieces = text.split("\n")
+        cases = [
+            (
+                "fit_lines",
+                lambda: loop_fit_lines(text, budget, model),
+                lambda: fit_lines(text, budget, model),
+            ),
+            (
+                "fit_pieces",
+                lambda: loop_fit_pieces(pieces, budget, model),
+                lambda: fit_pieces(pieces, budget, model, keep_last=True),
+            ),
+        ]
+        for name, loop, fitted in cases:
+            fitted_result, fitted_time = _best_time(fitted, repeats)
+            result = {
+                "lines": count,
+                "function": name,
+                "loop_ms": None,
+                "fitted_ms": fitted_time * 1000,
+                "same": None,
+            }
+            if count <= loop_max_lines:
+                # a single run, the loop is the slow side
+                loop_result, loop_time = _best_time(loop, 1)
+                result["loop_ms"] = loop_time * 1000
+                result["same"] = loop_result == fitted_result
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    padding = subparsers.add_parser("padding")
+    padding.add_argument("--model-path", default=None)
+    padding.add_argument("--documents", type=int, default=512)
+    padding.add_argument("--batch-size", type=int, default=32)
+    padding.add_argument("--repeats", type=int, default=3)
+
+    quantization = subparsers.add_parser("quantization")
+    quantization.add_argument("--model-name", default="all-MiniLM-L6-v2")
+    quantization.add_argument("--model-dir", default=default_model_path)
+    quantization.add_argument("--memories", type=int, default=2000)
+    quantization.add_argument("--queries", type=int, default=200)
+    quantization.add_argument("-k", type=int, default=10)
+    quantization.add_argument("--batch-size", type=int, default=32)
+    quantization.add_argument("--repeats", type=int, default=3)
+
+    tokens = subparsers.add_parser("tokens")
+    tokens.add_argument("--lines", type=int, nargs="+", default=[100, 1000, 10000])
+    tokens.add_argument("--budget", type=int, default=1000)
+    tokens.add_argument("--model", default="gpt-4")
+    tokens.add_argument("--repeats", type=int, default=3)
+    tokens.add_argument("--loop-max-lines", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.benchmark == "padding":
+        model_path = args.model_path or check_model()
+        results = run_padding(model_path, args.documents, args.batch_size, args.repeats)
+        print(f"{'distribution':<14}{'mode':<10}{'docs/s':>10}{'max diff':>12}")
+        for result in results:
+            print(
+                f"{result['distribution']:<14}{result['mode']:<10}"
+                f"{result['docs_per_sec']:>10.1f}{result['max_abs_diff']:>12.2e}"
+            )
+    elif args.benchmark == "tokens":
+        results = run_tokens(
+            args.lines, args.budget, args.model, args.repeats, args.loop_max_lines
+        )
+        print(f"{'lines':>7}  {'function':<12}{'loop ms':>11}{'ms':>10}{'speedup':>9}")
+        for result in results:
+            loop = result["loop_ms"]
+            if loop is None:
+                timings = f"{'-':>11}{result['fitted_ms']:>10.2f}{'-':>9}"
+            else:
+                speedup = loop / max(result["fitted_ms"], 1e-6)
+                timings = f"{loop:>11.1f}{result['fitted_ms']:>10.2f}{speedup:>8.0f}x"
+            differs = "  (differs from the loop)" if result["same"] is False else ""
+            print(f"{result['lines']:>7}  {result['function']:<12}{timings}{differs}")
+    else:
+        results = run_quantization(
+            args.model_name,
+            args.model_dir,
+            args.memories,
+            args.queries,
+            args.k,
+            args.batch_size,
+            args.repeats,
+        )
+        recall = f"recall@{args.k}"
+        print(f"{'model':<28}{'emb/s':>10}{recall:>12}{'fp32 overlap':>14}")
+        for variant, result in results.items():
+            print(
+                f"{variant:<28}{result['docs_per_sec']:>10.1f}"
+                f"{result['recall_at_k']:>12.3f}{result['overlap_with_fp32']:>14.3f}"
+            )
+        names = list(results)
+        print(
+            f"recall@{args.k} difference (int8 - fp32): "
+            f"{results[names[1]]['recall_at_k'] - results[names[0]]['recall_at_k']:+.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import requests
+import shutil
 import tarfile
 from pathlib import Path
 from tqdm import tqdm
@@ -23,7 +24,45 @@ def _download(url: str, fname: Path, chunk_size: int = 1024) -> None:
 default_model_path = str(Path.home() / ".cache" / "chroma" / "onnx_models")
 
 
+# appending this to a model name selects a locally quantized copy of the model
+QUANTIZED_SUFFIX = "-int8"
+
+
+def quantize_model(source_path: str, target_path: str) -> str:
+    """
+    Write a dynamically quantized int8 copy of the ONNX model in `source_path`
+    to `target_path`, next to a copy of its tokenizer files.
+    """
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError as e:
+        raise ImportError(
+            "Quantizing the embedding model requires the onnx package"
+        ) from e
+
+    os.makedirs(target_path, exist_ok=True)
+    for name in os.listdir(source_path):
+        if name != "model.onnx" and os.path.isfile(os.path.join(source_path, name)):
+            shutil.copy2(os.path.join(source_path, name), target_path)
+    # write under a temporary name so an interrupted run is redone next time
+    partial_path = os.path.join(target_path, "model.partial.onnx")
+    quantize_dynamic(
+        os.path.join(source_path, "model.onnx"),
+        partial_path,
+        weight_type=QuantType.QInt8,
+    )
+    os.replace(partial_path, os.path.join(target_path, "model.onnx"))
+    return target_path
+
+
 def check_model(model_name="all-MiniLM-L6-v2", model_path=default_model_path) -> str:
+    if model_name.endswith(QUANTIZED_SUFFIX):
+        source_path = check_model(model_name[: -len(QUANTIZED_SUFFIX)], model_path)
+        quantized_path = Path(model_path) / model_name / "onnx"
+        if not os.path.exists(quantized_path / "model.onnx"):
+            quantize_model(source_path, str(quantized_path))
+        return str(quantized_path)
+
     DOWNLOAD_PATH = Path(model_path) / model_name
     ARCHIVE_FILENAME = "onnx.tar.gz"
     MODEL_DOWNLOAD_URL = (
@@ -41,12 +80,27 @@ def check_model(model_name="all-MiniLM-L6-v2", model_path=default_model_path) ->
     return str(DOWNLOAD_PATH / "onnx")
 
 
-import importlib
+import threading
+import time
 import numpy as np
 from tokenizers import Tokenizer
 import onnxruntime
 import numpy.typing as npt
-from typing import List
+from typing import Dict, List, Sequence
+
+EMBEDDING_INTRA_OP_THREADS = int(os.environ.get("EMBEDDING_INTRA_OP_THREADS", 0))
+EMBEDDING_INTER_OP_THREADS = int(os.environ.get("EMBEDDING_INTER_OP_THREADS", 0))
+EMBEDDING_GRAPH_OPTIMIZATION = os.environ.get("EMBEDDING_GRAPH_OPTIMIZATION", "all")
+EMBEDDING_BUCKET_BY_LENGTH = os.environ.get(
+    "EMBEDDING_BUCKET_BY_LENGTH", "true"
+).lower() in ("1", "true", "yes")
+
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
 
 
 def _normalize(v: npt.NDArray) -> npt.NDArray:
@@ -55,30 +109,110 @@ def _normalize(v: npt.NDArray) -> npt.NDArray:
     return v / norm[:, np.newaxis]
 
 
-def infer_embeddings(
-    documents: List[str], model_path: str, batch_size: int = 32
-) -> npt.NDArray:
-    # Load the tokenizer and model
-    tokenizer = Tokenizer.from_file(model_path + "/tokenizer.json")
-    tokenizer.enable_truncation(max_length=256)
-    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=256)
-    model = onnxruntime.InferenceSession(model_path + "/model.onnx")
-
-    all_embeddings = []
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i : i + batch_size]
-        encoded = [tokenizer.encode(d) for d in batch]
-        input_ids = np.array([e.ids for e in encoded])
-        attention_mask = np.array([e.attention_mask for e in encoded])
+class EmbeddingEngine:
+    """
+    Tokenizer and ONNX inference session loaded once and shared by every caller.
+
+    ONNX Runtime sessions are safe to run from several threads at once, so a
+    single engine serves all users; only the counters are guarded by a lock.
+
+    Batches are padded to their longest document rather than to `max_length`;
+    `fixed_padding=True` restores the old pad-everything-to-256 behaviour and
+    only exists for benchmarking.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        intra_op_num_threads: int = EMBEDDING_INTRA_OP_THREADS,
+        inter_op_num_threads: int = EMBEDDING_INTER_OP_THREADS,
+        graph_optimization_level: str = EMBEDDING_GRAPH_OPTIMIZATION,
+        max_length: int = 256,
+        fixed_padding: bool = False,
+    ):
+        if graph_optimization_level not in _GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"Unknown graph optimization level {graph_optimization_level}, "
+                f"expected one of {list(_GRAPH_OPTIMIZATION_LEVELS)}"
+            )
+        self.model_path = model_path
+        self.max_length = max_length
+        self.fixed_padding = fixed_padding
+
+        started = time.perf_counter()
+        self.tokenizer = Tokenizer.from_file(model_path + "/tokenizer.json")
+        self.tokenizer.enable_truncation(max_length=max_length)
+        # padding is done per batch in _embed_batch
+        self.tokenizer.no_padding()
+
+        options = onnxruntime.SessionOptions()
+        # 0 lets ONNX Runtime pick the thread count itself
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        options.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVELS[
+            graph_optimization_level
+        ]
+        self.session = onnxruntime.InferenceSession(
+            model_path + "/model.onnx",
+            sess_options=options,
+            providers=onnxruntime.get_available_providers(),
+        )
+        self.load_time = time.perf_counter() - started
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._documents = 0
+        self._tokens = 0
+        self._padded_tokens = 0
+        self._batch_time_total = 0.0
+        self._batch_time_max = 0.0
+        self._batch_time_last = 0.0
+
+    def embed(
+        self,
+        documents: List[str],
+        batch_size: int = 32,
+        bucket_by_length: bool = EMBEDDING_BUCKET_BY_LENGTH,
+    ) -> npt.NDArray:
+        """
+        Embed `documents`, returning one normalized row per document in input order.
+
+        With `bucket_by_length` the documents are sorted by token count before
+        batching so that each batch holds similar lengths and little padding.
+        """
+        if not documents:
+            return np.zeros((0, 0), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(list(documents))
+        order = list(range(len(encodings)))
+        if bucket_by_length:
+            order.sort(key=lambda i: len(encodings[i].ids))
+
+        all_embeddings = []
+        for i in range(0, len(order), batch_size):
+            batch = [encodings[j] for j in order[i : i + batch_size]]
+            started = time.perf_counter()
+            all_embeddings.append(self._embed_batch(batch))
+            self._record_batch(batch, time.perf_counter() - started)
+        embeddings = np.concatenate(all_embeddings)
+        if bucket_by_length:
+            restored = np.empty_like(embeddings)
+            restored[order] = embeddings
+            embeddings = restored
+        return embeddings
+
+    def _embed_batch(self, batch: Sequence) -> npt.NDArray:
+        length = self._padded_length(batch)
+        input_ids = np.zeros((len(batch), length), dtype=np.int64)
+        attention_mask = np.zeros((len(batch), length), dtype=np.int64)
+        for row, encoding in enumerate(batch):
+            input_ids[row, : len(encoding.ids)] = encoding.ids
+            attention_mask[row, : len(encoding.ids)] = encoding.attention_mask
         onnx_input = {
-            "input_ids": np.array(input_ids, dtype=np.int64),
-            "attention_mask": np.array(attention_mask, dtype=np.int64),
-            "token_type_ids": np.array(
-                [np.zeros(len(e), dtype=np.int64) for e in input_ids],
-                dtype=np.int64,
-            ),
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
         }
-        model_output = model.run(None, onnx_input)
+        model_output = self.session.run(None, onnx_input)
         last_hidden_state = model_output[0]
         # Perform mean pooling with attention weighting
         input_mask_expanded = np.broadcast_to(
@@ -87,6 +221,78 @@ def infer_embeddings(
         embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
             input_mask_expanded.sum(1), a_min=1e-9, a_max=None
         )
-        embeddings = _normalize(embeddings).astype(np.float32)
-        all_embeddings.append(embeddings)
-    return np.concatenate(all_embeddings)
+        return _normalize(embeddings).astype(np.float32)
+
+    def _padded_length(self, batch: Sequence) -> int:
+        if self.fixed_padding:
+            return self.max_length
+        return max(1, max(len(encoding.ids) for encoding in batch))
+
+    def _record_batch(self, batch: Sequence, elapsed: float) -> None:
+        tokens = sum(len(encoding.ids) for encoding in batch)
+        padded_tokens = self._padded_length(batch) * len(batch)
+        with self._stats_lock:
+            self._batches += 1
+            self._documents += len(batch)
+            self._tokens += tokens
+            self._padded_tokens += padded_tokens
+            self._batch_time_total += elapsed
+            self._batch_time_last = elapsed
+            self._batch_time_max = max(self._batch_time_max, elapsed)
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                "load_time": self.load_time,
+                "batches": self._batches,
+                "documents": self._documents,
+                "tokens": self._tokens,
+                "padded_tokens": self._padded_tokens,
+                "padding_ratio": (
+                    1 - self._tokens / self._padded_tokens
+                    if self._padded_tokens
+                    else 0.0
+                ),
+                "batch_time_total": self._batch_time_total,
+                "batch_time_mean": (
+                    self._batch_time_total / self._batches if self._batches else 0.0
+                ),
+                "batch_time_max": self._batch_time_max,
+                "batch_time_last": self._batch_time_last,
+            }
+
+
+_engines: Dict[str, EmbeddingEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_embedding_engine(model_path: str, **session_options) -> EmbeddingEngine:
+    """
+    Return the process-wide engine for `model_path`, loading it on first use.
+
+    Session options only take effect for the call that loads the model.
+    """
+    engine = _engines.get(model_path)
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        engine = _engines.get(model_path)
+        if engine is None:
+            engine = EmbeddingEngine(model_path, **session_options)
+            _engines[model_path] = engine
+    return engine
+
+
+def get_embedding_stats() -> Dict[str, Dict[str, float]]:
+    return {path: engine.stats() for path, engine in list(_engines.items())}
+
+
+def infer_embeddings(
+    documents: List[str],
+    model_path: str,
+    batch_size: int = 32,
+    bucket_by_length: bool = EMBEDDING_BUCKET_BY_LENGTH,
+) -> npt.NDArray:
+    return get_embedding_engine(model_path).embed(
+        documents, batch_size=batch_size, bucket_by_length=bucket_by_length
+    )
@@ -3,7 +3,11 @@ import os
 import chromadb
 from chromadb.config import Settings
 
+from agentmemory.check_model import check_model
+from agentmemory.batcher import embed_documents
 from agentmemory.postgres import PostgresClient
+from agentmemory.registry import ChromaClientRegistry
+from agentmemory.text_index import TextIndex
 
 DEFAULT_CLIENT_TYPE = "CHROMA"
 CLIENT_TYPE = os.environ.get("CLIENT_TYPE", DEFAULT_CLIENT_TYPE)
@@ -13,6 +17,30 @@ POSTGRES_MODEL_NAME = os.environ.get("POSTGRES_MODEL_NAME", "all-MiniLM-L6-v2")
 # client = None
 
 
+class EngineEmbeddingFunction:
+    """Chroma embedding function backed by the shared batcher, cache and engine."""
+
+    def __call__(self, texts):
+        model_path = os.environ.get("MODEL_PATH") or check_model(
+            model_name=POSTGRES_MODEL_NAME
+        )
+        return embed_documents(list(texts), model_path=model_path).tolist()
+
+
+embedding_function = EngineEmbeddingFunction()
+
+
+def _open_chroma_client(username):
+    user_memory_path = os.path.join("users", username)
+    return chromadb.PersistentClient(
+        settings=Settings(anonymized_telemetry=False, allow_reset=True),
+        path=user_memory_path,
+    )
+
+
+chroma_clients = ChromaClientRegistry(_open_chroma_client)
+
+
 def get_client(client_type=None, username=None, *args, **kwargs):
     # global client
     # if client is not None:
@@ -31,7 +59,7 @@ def get_client(client_type=None, username=None, *args, **kwargs):
             model_name=POSTGRES_MODEL_NAME,
             model_path=os.environ["MODEL_PATH"],
         )
-    else:
+    elif args or kwargs:
         user_memory_path = os.path.join("users", username)
         client = chromadb.PersistentClient(
             settings=Settings(anonymized_telemetry=False, allow_reset=True),
@@ -39,5 +67,185 @@ def get_client(client_type=None, username=None, *args, **kwargs):
             *args,
             **kwargs,
         )
+    else:
+        client = chroma_clients.get_client(username)
 
     return client
+
+
+def get_or_create_collection(category, username=None):
+    """
+    Get or create a collection, making sure Chroma embeds with the shared engine
+    instead of loading its own copy of the model for every collection handle.
+    """
+    if CLIENT_TYPE == "POSTGRES":
+        return get_client(username=username).get_or_create_collection(category)
+    return chroma_clients.get_or_create_collection(
+        username, category, embedding_function=embedding_function
+    )
+
+
+def _in_order(results, ids):
+    # chroma returns the rows of a get by ids in storage order
+    rank = {id_: i for i, id_ in enumerate(ids)}
+    order = sorted(range(len(results["ids"])), key=lambda i: rank[results["ids"][i]])
+    return {
+        key: [values[i] for i in order] if isinstance(values, list) else values
+        for key, values in results.items()
+    }
+
+
+def search_documents(
+    category,
+    text,
+    mode="substring",
+    n_results=None,
+    where=None,
+    where_document=None,
+    include=["metadatas", "documents"],
+    username=None,
+    match_all=True,
+):
+    """
+    Memories whose document contains `text` ignoring case ("substring") or
+    all of its words ("words", best matches first; any of them with
+    `match_all=False`), in the shape of collection.get(). Postgres answers
+    from its pg_trgm and tsvector indexes, Chroma from a per-collection
+    TextIndex built on first use.
+    """
+    collection = get_or_create_collection(category, username=username)
+    if CLIENT_TYPE == "POSTGRES":
+        return collection.search_text(
+            text,
+            mode=mode,
+            n_results=n_results,
+            where=where,
+            where_document=where_document,
+            include=include,
+            match_all=match_all,
+        )
+
+    def build():
+        index = TextIndex()
+        documents = collection.get(include=["documents"])
+        index.add(documents["ids"], documents["documents"])
+        return index
+
+    index = chroma_clients.get_text_index(username, category, build)
+    if mode == "substring":
+        ids = index.search_substring(text)
+    elif mode == "words":
+        ids = index.search_words(text, match_all=match_all)
+    else:
+        raise ValueError(f"Unknown text search mode {mode}")
+    if not ids:
+        return {"ids": [], "documents": [], "metadatas": []}
+    if where or where_document:
+        # filter first without payload, chroma 0.4 cannot fetch embeddings of
+        # a filtered id list
+        matched = set(
+            collection.get(
+                ids=ids, where=where or None, where_document=where_document, include=[]
+            )["ids"]
+        )
+        ids = [id_ for id_ in ids if id_ in matched]
+    if n_results is not None:
+        ids = ids[:n_results]
+    if not ids:
+        return {"ids": [], "documents": [], "metadatas": []}
+    results = collection.get(ids=ids, include=include)
+    return _in_order(results, ids)
+
+
+def get_memory_page(
+    category,
+    order_by="created_at",
+    descending=True,
+    after=None,
+    limit=20,
+    where=None,
+    where_document=None,
+    include=["metadatas", "documents"],
+    username=None,
+):
+    """
+    One page of memories sorted by `order_by` ("created_at" or "id", ties
+    broken by id) starting after the sort key `after`, in the shape of
+    collection.get(). Postgres sorts and pages in the database. Chroma cannot
+    sort, so the matching ids and metadata are sorted here and only the page
+    is fetched with its documents and embeddings.
+    """
+    collection = get_or_create_collection(category, username=username)
+    if CLIENT_TYPE == "POSTGRES":
+        return collection.get_page(
+            order_by=order_by,
+            descending=descending,
+            after=after,
+            limit=limit,
+            where=where,
+            where_document=where_document,
+            include=include,
+        )
+
+    if order_by not in ("created_at", "id"):
+        raise ValueError(f"Cannot order memories by {order_by}")
+    rows = collection.get(
+        where=where or None, where_document=where_document, include=["metadatas"]
+    )
+    keys = []
+    for id_, metadata in zip(rows["ids"], rows["metadatas"]):
+        if order_by == "created_at":
+            created_at = float((metadata or {}).get("created_at") or 0)
+            keys.append((created_at, id_))
+        else:
+            keys.append((id_,))
+    if after is not None:
+        after = tuple(after)
+        keys = [key for key in keys if (key < after if descending else key > after)]
+    keys.sort(reverse=descending)
+    ids = [key[-1] for key in keys[:limit]]
+    if not ids:
+        return {"ids": [], "documents": [], "metadatas": []}
+    results = collection.get(ids=ids, include=include)
+    return _in_order(results, ids)
+
+
+def update_text_index(category, ids, documents, username=None):
+    """Keep the Chroma text index of a category in step with written documents."""
+    if CLIENT_TYPE != "POSTGRES":
+        chroma_clients.update_text_index(username, category, ids, documents)
+
+
+def remove_from_text_index(category, ids, username=None):
+    if CLIENT_TYPE != "POSTGRES":
+        chroma_clients.remove_from_text_index(username, category, ids)
+
+
+def forget_text_index(category, username=None):
+    if CLIENT_TYPE != "POSTGRES":
+        chroma_clients.forget_text_index(username, category)
+
+
+def forget_collections(username=None):
+    """Drop cached collection handles after collections were deleted."""
+    if CLIENT_TYPE != "POSTGRES":
+        chroma_clients.forget_collections(username)
+
+
+def close_client(username=None):
+    if CLIENT_TYPE != "POSTGRES":
+        chroma_clients.close(username)
+
+
+def close_clients():
+    chroma_clients.close_all()
+
+
+async def run_client_eviction():
+    """Close the clients of idle users periodically, until cancelled."""
+    if CLIENT_TYPE != "POSTGRES":
+        await chroma_clients.run_eviction()
+
+
+def get_client_stats():
+    return chroma_clients.stats()
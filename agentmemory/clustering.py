@@ -12,6 +12,7 @@ def cluster(epsilon, min_samples, category, filter_metadata=None, novel=False):
         n_results=float("inf"),
         filter_metadata=filter_metadata,
         novel=novel,
+        include_embeddings=False,
     )
     visited = {memory["id"]: False for memory in memories}
 
@@ -30,6 +31,7 @@ def cluster(epsilon, min_samples, category, filter_metadata=None, novel=False):
             max_distance=epsilon,
             filter_metadata=filter_metadata,
             novel=novel,
+            include_embeddings=False,
         )
 
         # get the current metadata
@@ -86,6 +88,7 @@ def _expand_cluster(
                 max_distance=epsilon,
                 filter_metadata=filter_metadata,
                 novel=novel,
+                include_embeddings=False,
             )
             if len(next_neighbors) >= min_samples:
                 neighbors += next_neighbors
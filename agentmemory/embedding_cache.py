@@ -0,0 +1,294 @@
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from agentmemory.check_model import infer_embeddings
+
+EMBEDDING_CACHE_MAX_BYTES = int(
+    os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+# "float32" or "float16" enables the memory-mapped tier, empty disables it
+EMBEDDING_CACHE_DISK = os.environ.get("EMBEDDING_CACHE_DISK", "")
+EMBEDDING_CACHE_DISK_CAPACITY = int(
+    os.environ.get("EMBEDDING_CACHE_DISK_CAPACITY", 100000)
+)
+
+_KEY_BYTES = 16
+
+
+def normalize_text(text: str) -> str:
+    # the tokenizer splits on whitespace, so collapsing runs of it never
+    # changes the tokens the model sees
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_name: str, text: str) -> bytes:
+    data = f"{model_name}\0{normalize_text(text)}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=_KEY_BYTES).digest()
+
+
+class DiskTier:
+    """
+    Fixed-capacity ring of embeddings stored in memory-mapped files.
+
+    `vectors.bin` holds one row per slot, `keys.bin` the key of each slot and
+    `stamps.bin` a sequence number used to find the next slot to overwrite
+    after a restart. Meant for a single writing process.
+    """
+
+    def __init__(self, path: str, dtype: str = "float16", capacity: int = 100000):
+        if dtype not in ("float16", "float32"):
+            raise ValueError(f"Unknown disk cache dtype {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.capacity = capacity
+        self.dim = None
+        self.slots: Dict[bytes, int] = {}
+        self.evictions = 0
+        self._next = 0
+        self._stamp = 0
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["dtype"] == dtype:
+                self.capacity = meta["capacity"]
+                self._open(meta["dim"], "r+")
+
+    def _open(self, dim: int, mode: str) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        self.dim = dim
+        self.vectors = np.memmap(
+            os.path.join(self.path, "vectors.bin"),
+            dtype=self.dtype,
+            mode=mode,
+            shape=(self.capacity, dim),
+        )
+        self.keys = np.memmap(
+            os.path.join(self.path, "keys.bin"),
+            dtype=np.uint8,
+            mode=mode,
+            shape=(self.capacity, _KEY_BYTES),
+        )
+        self.stamps = np.memmap(
+            os.path.join(self.path, "stamps.bin"),
+            dtype=np.int64,
+            mode=mode,
+            shape=(self.capacity,),
+        )
+        if mode == "w+":
+            with open(os.path.join(self.path, "meta.json"), "w") as f:
+                json.dump(
+                    {"dim": dim, "dtype": self.dtype, "capacity": self.capacity}, f
+                )
+            return
+        used = np.nonzero(self.stamps)[0]
+        for slot in used:
+            self.slots[self.keys[slot].tobytes()] = int(slot)
+        if len(used):
+            newest = int(used[np.argmax(self.stamps[used])])
+            self._stamp = int(self.stamps[newest])
+            self._next = (newest + 1) % self.capacity
+
+    def get(self, key: bytes) -> Optional[npt.NDArray]:
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return np.array(self.vectors[slot], dtype=np.float32)
+
+    def put(self, key: bytes, embedding: npt.NDArray) -> None:
+        if self.dim is None:
+            self._open(len(embedding), "w+")
+        if len(embedding) != self.dim or key in self.slots:
+            return
+        slot = self._next
+        if self.stamps[slot]:
+            self.slots.pop(self.keys[slot].tobytes(), None)
+            self.evictions += 1
+        self._stamp += 1
+        self.vectors[slot] = embedding
+        self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+        self.stamps[slot] = self._stamp
+        self.slots[key] = slot
+        self._next = (slot + 1) % self.capacity
+
+    def flush(self) -> None:
+        if self.dim is not None:
+            self.vectors.flush()
+            self.keys.flush()
+            self.stamps.flush()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (model name, normalized text hash).
+
+    Lookups go to an in-memory LRU bounded by `max_bytes` first and then to the
+    optional memory-mapped disk tier. With a float16 disk tier, disk hits are
+    rounded to half precision.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        disk_path: Optional[str] = None,
+        disk_dtype: str = "float16",
+        disk_capacity: int = EMBEDDING_CACHE_DISK_CAPACITY,
+    ):
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[bytes, npt.NDArray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.disk = (
+            DiskTier(disk_path, disk_dtype, disk_capacity) if disk_path else None
+        )
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, text: str) -> Optional[npt.NDArray]:
+        key = cache_key(self.model_name, text)
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: bytes) -> Optional[npt.NDArray]:
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return embedding
+        if self.disk is not None:
+            embedding = self.disk.get(key)
+            if embedding is not None:
+                self.disk_hits += 1
+                self._put_memory(key, embedding)
+                return embedding
+        self.misses += 1
+        return None
+
+    def put(self, text: str, embedding: npt.NDArray) -> None:
+        key = cache_key(self.model_name, text)
+        with self._lock:
+            self._put(key, np.asarray(embedding, dtype=np.float32))
+            if self.disk is not None:
+                self.disk.flush()
+
+    def _put(self, key: bytes, embedding: npt.NDArray) -> None:
+        self._put_memory(key, embedding)
+        if self.disk is not None:
+            self.disk.put(key, embedding)
+
+    def _put_memory(self, key: bytes, embedding: npt.NDArray) -> None:
+        if embedding.nbytes > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+        self._entries[key] = embedding
+        self._bytes += embedding.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def embed(
+        self, documents: List[str], model_path: str, **embed_options
+    ) -> npt.NDArray:
+        """
+        Return embeddings for `documents` in order, running the model only for
+        texts that are not cached yet (each distinct text at most once).
+        """
+        keys = [cache_key(self.model_name, document) for document in documents]
+        found: Dict[bytes, npt.NDArray] = {}
+        missing: Dict[bytes, str] = {}
+        with self._lock:
+            for key, document in zip(keys, documents):
+                if key in found or key in missing:
+                    continue
+                embedding = self._get(key)
+                if embedding is None:
+                    missing[key] = document
+                else:
+                    found[key] = embedding
+
+        if missing:
+            embeddings = infer_embeddings(
+                list(missing.values()), model_path=model_path, **embed_options
+            )
+            with self._lock:
+                for key, embedding in zip(missing, embeddings):
+                    self._put(key, embedding)
+                    found[key] = embedding
+                if self.disk is not None:
+                    self.disk.flush()
+
+        if not documents:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in keys]).astype(np.float32)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+            if self.disk is not None:
+                stats["disk_entries"] = len(self.disk.slots)
+                stats["disk_capacity"] = self.disk.capacity
+                stats["disk_evictions"] = self.disk.evictions
+            return stats
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str, model_path: str) -> EmbeddingCache:
+    """Return the process-wide cache for `model_name`, creating it on first use."""
+    cache = _caches.get(model_name)
+    if cache is not None:
+        return cache
+    with _caches_lock:
+        cache = _caches.get(model_name)
+        if cache is None:
+            disk_path = None
+            if EMBEDDING_CACHE_DISK:
+                disk_path = os.path.join(
+                    model_path, "embedding_cache", EMBEDDING_CACHE_DISK
+                )
+            cache = EmbeddingCache(
+                model_name,
+                disk_path=disk_path,
+                disk_dtype=EMBEDDING_CACHE_DISK or "float16",
+            )
+            _caches[model_name] = cache
+    return cache
+
+
+def get_embedding_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {name: cache.stats() for name, cache in list(_caches.items())}
+
+
+def cached_embeddings(
+    documents: List[str], model_path: str, model_name: Optional[str] = None
+) -> npt.NDArray:
+    """infer_embeddings with the process-wide cache in front of the model."""
+    if model_name is None:
+        # check_model lays models out as <model_name>/onnx
+        model_name = os.path.basename(os.path.dirname(os.path.normpath(model_path)))
+    return get_embedding_cache(model_name, model_path).embed(documents, model_path)
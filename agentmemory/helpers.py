@@ -62,54 +62,22 @@ def chroma_collection_to_list(collection):
     if isinstance(collection, list):
         return collection
 
-    # If there are no embeddings, zip metadatas, documents and ids together
-    if collection.get("embeddings", None) is None:
-        for metadata, document, id in zip(
-            collection["metadatas"], collection["documents"], collection["ids"]
-        ):
-            # append the zipped data as dictionary to the list
-            dict_list.append({"metadata": metadata, "document": document, "id": id})
-
-        return dict_list
-
-    # if distance is none, zip metadatas, documents, ids and embeddings together
-    if collection.get("distances", None) is None:
-        for metadata, document, id, embedding in zip(
-            collection["metadatas"],
-            collection["documents"],
-            collection["ids"],
-            collection["embeddings"],
-        ):
-            # append the zipped data as dictionary to the list
-            dict_list.append(
-                {
-                    "metadata": metadata,
-                    "document": document,
-                    "embedding": embedding,
-                    "id": id,
-                }
-            )
-
-        return dict_list
-
-    # if embeddings are present, zip all data including embeddings and distances
-    for metadata, document, id, embedding, distance in zip(
-        collection["metadatas"],
-        collection["documents"],
-        collection["ids"],
-        collection["embeddings"],
-        collection.get("distances"),
+    # embeddings and distances are only present when they were included
+    embeddings = collection.get("embeddings", None)
+    distances = collection.get("distances", None)
+
+    for i, (metadata, document, id) in enumerate(
+        zip(collection["metadatas"], collection["documents"], collection["ids"])
     ):
+        item = {"metadata": metadata, "document": document}
+        if embeddings is not None:
+            item["embedding"] = embeddings[i]
+        if distances is not None:
+            item["distance"] = distances[i]
+        item["id"] = id
         # append the zipped data as dictionary to the list
-        dict_list.append(
-            {
-                "metadata": metadata,
-                "document": document,
-                "embedding": embedding,
-                "distance": distance,
-                "id": id,
-            }
-        )
+        dict_list.append(item)
+
     debug_log("Collection to list", {"collection": collection, "list": dict_list})
     return dict_list
 
@@ -220,3 +188,26 @@ def get_include_types(include_embeddings, include_distances):
 
     debug_log("Get include types", {"include_types": include_types})
     return include_types
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Function to fuse rankings with reciprocal rank fusion.
+
+    Arguments:
+    rankings (list): Lists of ids, each ordered best first.
+    k (int): Fusion constant, larger values flatten the rank differences.
+
+    Returns:
+    list: (id, score) tuples, best first. Each id scores 1 / (k + rank) for
+    each ranking it appears in, with ranks starting at 1.
+
+    Example:
+    >>> reciprocal_rank_fusion([["a", "b"], ["b", "c"]])
+    [('b', 0.0325...), ('a', 0.0163...), ('c', 0.0161...)]
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -8,15 +8,50 @@ logger = logs.Log("agentmemory", "agentmemory.log").get_logger()
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-from agentmemory.client import get_client
+from agentmemory.client import (
+    CLIENT_TYPE,
+    close_client,
+    forget_collections,
+    forget_text_index,
+    get_client,
+    get_memory_page,
+    get_or_create_collection,
+    remove_from_text_index,
+    search_documents,
+    update_text_index,
+)
 from agentmemory.helpers import (
     chroma_collection_to_list,
     debug_log,
     flatten_arrays,
     get_include_types,
+    reciprocal_rank_fusion,
 )
 
 
+def _prepare_metadata(metadata, mUsername=None):
+    # add timestamps to metadata
+    # Use provided timestamp if available, otherwise use current time
+    current_time = datetime.datetime.now().timestamp()
+    metadata["created_at"] = metadata.get("created_at", current_time)
+    metadata["updated_at"] = datetime.datetime.now().timestamp()
+
+    # add username to metadata
+    metadata["username"] = mUsername if mUsername is not None else "assistant"
+
+    # for each field in metadata...
+    # if the field is a boolean, convert it to a string
+    for key, value in metadata.items():
+        if (
+            isinstance(value, bool)
+            or isinstance(value, dict)
+            or isinstance(value, list)
+        ):
+            debug_log(f"WARNING: Boolean metadata field {key} converted to string")
+            metadata[key] = str(value)
+    return metadata
+
+
 def create_memory(
     category,
     text,
@@ -43,16 +78,9 @@ def create_memory(
     >>> create_memory('sample_category', 'sample_text', id='sample_id', metadata={'sample_key': 'sample_value'})
     """
     # get or create the collection
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
-    # add timestamps to metadata
-    # Use provided timestamp if available, otherwise use current time
-    current_time = datetime.datetime.now().timestamp()
-    metadata["created_at"] = metadata.get("created_at", current_time)
-    metadata["updated_at"] = datetime.datetime.now().timestamp()
-
-    # add username to metadata
-    metadata["username"] = mUsername if mUsername is not None else "assistant"
+    _prepare_metadata(metadata, mUsername)
 
     logger.debug(f"created_at: {metadata['created_at']}")
     # convert to human readable format
@@ -67,17 +95,6 @@ def create_memory(
         # pad the id with zeros to make it 16 digits long
         id = id.zfill(16)
 
-    # for each field in metadata...
-    # if the field is a boolean, convert it to a string
-    for key, value in metadata.items():
-        if (
-            isinstance(value, bool)
-            or isinstance(value, dict)
-            or isinstance(value, list)
-        ):
-            debug_log(f"WARNING: Boolean metadata field {key} converted to string")
-            metadata[key] = str(value)
-
     text = str(text)
 
     # insert the document into the collection
@@ -88,6 +105,7 @@ def create_memory(
             metadatas=[metadata],
             embeddings=[embedding] if embedding is not None else None,
         )
+        update_text_index(category, [str(id)], [text], username=username)
         debug_log(f"Created memory {id}: {text}", metadata)
         return id
     except Exception as e:
@@ -98,6 +116,89 @@ def create_memory(
         return None
 
 
+def create_memories(
+    category,
+    texts,
+    metadatas=None,
+    embeddings=None,
+    ids=None,
+    username=None,
+    mUsername=None,
+    batch_size=1000,
+):
+    """
+    Create many memories in a collection, writing them in batches instead of
+    one upsert per memory.
+
+    Arguments:
+    category (str): Category of the collection.
+    texts (list): Document texts.
+    metadatas (list, optional): Metadata for each text.
+    embeddings (list, optional): Embeddings for each text, None entries are computed.
+    ids (list, optional): Unique ids, generated from the collection count if omitted.
+
+    Returns:
+    list: The ids of the created memories.
+
+    Example:
+    >>> create_memories('sample_category', ['first text', 'second text'])
+    """
+    memories = get_or_create_collection(category, username=username)
+    texts = [str(text) for text in texts]
+    if metadatas is None:
+        metadatas = [{} for _ in texts]
+    for metadata in metadatas:
+        _prepare_metadata(metadata, mUsername)
+    if ids is None:
+        start = memories.count()
+        ids = [str(start + i).zfill(16) for i in range(len(texts))]
+    else:
+        ids = [str(id) for id in ids]
+    if embeddings is None:
+        embeddings = [None] * len(texts)
+
+    started = time.perf_counter()
+    for offset in range(0, len(texts), batch_size):
+        end = min(offset + batch_size, len(texts))
+        # chroma takes embeddings for every row of a call or for none of them
+        for with_embeddings in (True, False):
+            rows = [
+                i
+                for i in range(offset, end)
+                if (embeddings[i] is not None) == with_embeddings
+            ]
+            if not rows:
+                continue
+            try:
+                memories.upsert(
+                    ids=[ids[i] for i in rows],
+                    documents=[texts[i] for i in rows],
+                    metadatas=[metadatas[i] for i in rows],
+                    embeddings=(
+                        [embeddings[i] for i in rows] if with_embeddings else None
+                    ),
+                )
+                update_text_index(
+                    category,
+                    [ids[i] for i in rows],
+                    [texts[i] for i in rows],
+                    username=username,
+                )
+            except Exception as e:
+                debug_log(
+                    f"ERROR: Could not create {len(rows)} memories in {category}",
+                    type="error",
+                )
+                debug_log(f"ERROR: {e}", type="error")
+                raise
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Created {len(texts)} memories in {category} in {elapsed:.2f}s "
+        f"({len(texts) / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+    return ids
+
+
 def create_unique_memory(
     category, content, metadata={}, similarity=0.95, username=None
 ):
@@ -301,7 +402,7 @@ def get_memory_by_date(
             logger.debug(f"start_timestamp: {start_timestamp}")
             logger.debug(f"end_timestamp: {end_timestamp}")
 
-            memories = get_client(username=username).get_or_create_collection(category)
+            memories = get_or_create_collection(category, username=username)
             for memory in memories:
                 pass
             results = memories.get(
@@ -331,6 +432,9 @@ def search_memory(
     novel=False,
     username=None,
     exact_match=False,
+    ef_search=None,
+    probes=None,
+    mode=None,
 ):
     """
     Search a collection with given query texts.
@@ -349,13 +453,23 @@ def search_memory(
         0.0 = No memories will be excluded, 0.9 = most memories will be excluded
     novel (bool): Only include memories that are marked as novel
     username (str): Username for the client
-    exact_match (bool): Whether to perform an exact match search
+    exact_match (bool): Whether to perform an exact match search, same as mode="exact"
+    ef_search (int): Postgres only, HNSW candidate list size for this search
+    probes (int): Postgres only, IVFFlat lists to scan for this search
+    mode (str): "vector" (default), "exact" for documents containing search_text,
+        or "hybrid" to fuse the vector ranking with a word search ranking (RRF),
+        which finds names, codes and addresses the embeddings miss. Hybrid
+        results carry a "score" and whether they matched lexically.
 
     Returns:
     list: List of search results.
     """
 
-    memories = get_client(username=username).get_or_create_collection(category)
+    if mode is None:
+        mode = "exact" if exact_match else "vector"
+    exact_match = mode == "exact"
+
+    memories = get_or_create_collection(category, username=username)
 
     if (memories.count()) == 0:
         return []
@@ -377,44 +491,248 @@ def search_memory(
     if contains_text:
         where_document = {"$contains": contains_text}
 
-    # For exact match, we'll use get() instead of query()
+    # For exact match, we'll use the text index instead of query()
     if exact_match:
-        results = memories.get(
-            where=filter_metadata, where_document=where_document, include=include_types
+        results = search_documents(
+            category,
+            search_text,
+            n_results=n_results,
+            where=filter_metadata,
+            where_document=where_document,
+            include=include_types,
+            username=username,
         )
         result_list = chroma_collection_to_list(results)
-        result_list = [
-            res for res in result_list if search_text.lower() in res["document"].lower()
-        ]
-        result_list = result_list[:n_results]  # Limit results after filtering
+    elif mode == "hybrid":
+        result_list = _hybrid_search(
+            memories,
+            category,
+            search_text,
+            n_results,
+            filter_metadata,
+            where_document,
+            include_types,
+            username,
+            ef_search=ef_search,
+            probes=probes,
+        )
     else:
         # Perform the query for non-exact match
+        search_options = {}
+        if CLIENT_TYPE == "POSTGRES":
+            # chroma only has a per-collection search_ef
+            search_options = {"ef_search": ef_search, "probes": probes}
         query = memories.query(
             query_texts=[search_text],
             where=filter_metadata,
             where_document=where_document,
             n_results=n_results,
             include=include_types + (["distances"] if include_distances else []),
+            **search_options,
         )
         query = flatten_arrays(query)
         result_list = chroma_collection_to_list(query)
 
     if not exact_match:
-        if min_distance is not None and min_distance > 0:
-            result_list = [
-                res for res in result_list if res.get("distance", 0) >= min_distance
-            ]
-
-        if max_distance is not None and max_distance < 2.0:
-            result_list = [
-                res for res in result_list if res.get("distance", 0) <= max_distance
-            ]
+        result_list = _filter_distances(result_list, min_distance, max_distance)
 
     debug_log(f"Searched memory: {search_text}", result_list)
 
     return result_list
 
 
+def search_memory_batch(
+    category,
+    search_texts,
+    n_results=50,
+    filter_metadata=None,
+    contains_text=None,
+    include_embeddings=True,
+    include_distances=True,
+    max_distance=None,
+    min_distance=None,
+    novel=False,
+    username=None,
+    ef_search=None,
+    probes=None,
+):
+    """
+    Vector search for several query texts at once: they are embedded as one
+    batch and, on Postgres, searched in one statement.
+
+    Arguments are the same as for search_memory, with a list of search_texts.
+
+    Returns:
+    list: One list of search results per search text, in order.
+
+    Example:
+    >>> search_memory_batch('books', ['space opera', 'robots'], n_results=5)
+    """
+    search_texts = list(search_texts)
+    if not search_texts:
+        return []
+
+    memories = get_or_create_collection(category, username=username)
+
+    count = memories.count()
+    if count == 0:
+        return [[] for _ in search_texts]
+
+    n_results = min(n_results, count)
+    include_types = ["documents", "metadatas"]
+    if include_embeddings:
+        include_types.append("embeddings")
+    if include_distances:
+        include_types.append("distances")
+
+    if filter_metadata is None:
+        filter_metadata = {}
+
+    if novel:
+        filter_metadata["novel"] = "True"
+
+    where_document = None
+    if contains_text:
+        where_document = {"$contains": contains_text}
+
+    if CLIENT_TYPE == "POSTGRES":
+        queries = memories.query_many(
+            search_texts,
+            n_results=n_results,
+            where=filter_metadata,
+            where_document=where_document,
+            ef_search=ef_search,
+            probes=probes,
+            include=include_types,
+        )
+    else:
+        # chroma embeds all query texts in one call and nests results per text
+        results = memories.query(
+            query_texts=search_texts,
+            where=filter_metadata,
+            where_document=where_document,
+            n_results=n_results,
+            include=include_types,
+        )
+        queries = [
+            {
+                key: values[i]
+                for key, values in results.items()
+                if isinstance(values, list)
+            }
+            for i in range(len(search_texts))
+        ]
+
+    result_lists = []
+    for search_text, query in zip(search_texts, queries):
+        result_list = chroma_collection_to_list(query)
+        result_list = _filter_distances(result_list, min_distance, max_distance)
+        debug_log(f"Searched memory: {search_text}", result_list)
+        result_lists.append(result_list)
+    return result_lists
+
+
+def _filter_distances(result_list, min_distance=None, max_distance=None):
+    # lexical hits are kept whatever their distance
+    if min_distance is not None and min_distance > 0:
+        result_list = [
+            res
+            for res in result_list
+            if res.get("lexical_match") or res.get("distance", 0) >= min_distance
+        ]
+
+    if max_distance is not None and max_distance < 2.0:
+        result_list = [
+            res
+            for res in result_list
+            if res.get("lexical_match") or res.get("distance", 0) <= max_distance
+        ]
+    return result_list
+
+
+def _hybrid_search(
+    memories,
+    category,
+    search_text,
+    n_results,
+    filter_metadata,
+    where_document,
+    include_types,
+    username=None,
+    ef_search=None,
+    probes=None,
+):
+    if CLIENT_TYPE == "POSTGRES":
+        # both rankings and the fusion run as one statement
+        results = memories.hybrid_query(
+            search_text,
+            n_results=n_results,
+            where=filter_metadata,
+            where_document=where_document,
+            ef_search=ef_search,
+            probes=probes,
+            include=include_types,
+        )
+        rows = zip(
+            results["ids"],
+            results["documents"],
+            results["metadatas"],
+            results["embeddings"] or [None] * len(results["ids"]),
+            results["distances"],
+            results["scores"],
+            results["lexical_matches"],
+        )
+        return [
+            {
+                "metadata": metadata,
+                "document": document,
+                **({"embedding": embedding} if embedding is not None else {}),
+                "distance": distance,
+                "score": score,
+                "lexical_match": lexical_match,
+                "id": id,
+            }
+            for id, document, metadata, embedding, distance, score, lexical_match in rows
+        ]
+
+    vector = memories.query(
+        query_texts=[search_text],
+        where=filter_metadata,
+        where_document=where_document,
+        n_results=n_results,
+        include=include_types + ["distances"],
+    )
+    vector = flatten_arrays(vector)
+    lexical = search_documents(
+        category,
+        search_text,
+        mode="words",
+        n_results=n_results,
+        where=filter_metadata,
+        where_document=where_document,
+        include=include_types,
+        username=username,
+        match_all=False,
+    )
+    records = {}
+    for collection, extra in ((lexical, {"lexical_match": True}), (vector, {})):
+        for i, id in enumerate(collection["ids"]):
+            record = records.setdefault(id, {"id": id, "lexical_match": False})
+            record["metadata"] = collection["metadatas"][i]
+            record["document"] = collection["documents"][i]
+            if collection.get("embeddings") is not None:
+                record["embedding"] = collection["embeddings"][i]
+            if collection.get("distances") is not None:
+                record["distance"] = collection["distances"][i]
+            record.update(extra)
+    fused = reciprocal_rank_fusion([vector["ids"], lexical["ids"]])
+    result_list = []
+    for id, score in fused[:n_results]:
+        records[id]["score"] = score
+        result_list.append(records[id])
+    return result_list
+
+
 def get_memory(category, id, include_embeddings=True, username=None):
     """
     Retrieve a specific memory from a given category based on its ID.
@@ -432,7 +750,7 @@ def get_memory(category, id, include_embeddings=True, username=None):
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     # Get the types to include based on the function parameters
     include_types = get_include_types(include_embeddings, False)
@@ -475,6 +793,7 @@ def get_memories(
         n_results (int, optional): The number of results to return. Defaults to 20.
         include_embeddings (bool, optional): Whether to include the embeddings. Defaults to True.
         novel (bool, optional): Whether to only include memories that are marked as novel. Defaults to False.
+        start_from (str, optional): Only return memories after this ID in the sort order. Defaults to None.
 
     Returns:
         list: List of retrieved memories.
@@ -482,12 +801,59 @@ def get_memories(
     Example:
         >>> get_memories("books", sort_order="asc", n_results=10)
     """
+    memories, _ = list_memories(
+        category,
+        n_results=n_results,
+        order_by="id",
+        sort_order=sort_order,
+        cursor=None if start_from is None else str(start_from),
+        contains_text=contains_text,
+        filter_metadata=filter_metadata,
+        include_embeddings=include_embeddings,
+        novel=novel,
+        username=username,
+    )
+    return memories
 
-    # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
 
-    # min n_results to prevent searching for more elements than are available
-    n_results = min(n_results, memories.count())
+def list_memories(
+    category,
+    n_results=20,
+    order_by="created_at",
+    sort_order="desc",
+    cursor=None,
+    contains_text=None,
+    filter_metadata=None,
+    include_embeddings=False,
+    novel=False,
+    username=None,
+):
+    """
+    Retrieve one page of memories from a given category, sorted by the database.
+
+    Pages are keyset-paginated: each page ends with a cursor holding the sort key
+    of its last memory, and the next page starts right after it, so every page
+    costs the same however deep it is.
+
+    Arguments:
+        category (str): The category of the memories.
+        n_results (int, optional): The page size. Defaults to 20.
+        order_by (str, optional): 'created_at' or 'id'; ties on created_at are broken by ID. Defaults to 'created_at'.
+        sort_order (str, optional): 'asc' or 'desc'. Defaults to 'desc'.
+        cursor (str, optional): The cursor returned with the previous page. Defaults to None for the first page.
+        contains_text (str, optional): Only include memories whose document contains this text. Defaults to None.
+        filter_metadata (dict, optional): Filter to apply on metadata. Defaults to None.
+        include_embeddings (bool, optional): Whether to include the embeddings. Defaults to False.
+        novel (bool, optional): Whether to only include memories that are marked as novel. Defaults to False.
+        username (str, optional): The username for client authentication. Defaults to None.
+
+    Returns:
+        tuple: The list of memories, and the cursor of the next page or None after the last one.
+
+    Example:
+        >>> memories, cursor = list_memories("books", n_results=10)
+        >>> more, cursor = list_memories("books", n_results=10, cursor=cursor)
+    """
 
     # Get the types to include based on the function parameters
     include_types = get_include_types(include_embeddings, False)
@@ -511,24 +877,46 @@ def get_memories(
             filter_metadata = {}
         filter_metadata["novel"] = "True"
 
-    # Retrieve all memories that meet the given metadata filter
-    memories = memories.get(
-        where=filter_metadata, where_document=where_document, include=include_types
+    memories = get_memory_page(
+        category,
+        order_by=order_by,
+        descending=sort_order == "desc",
+        after=_parse_cursor(cursor, order_by),
+        limit=n_results,
+        where=filter_metadata,
+        where_document=where_document,
+        include=include_types,
+        username=username,
     )
 
     if not isinstance(memories, list):
         # Convert the collection to list format
         memories = chroma_collection_to_list(memories)
 
-    # Sort memories by ID. If sort_order is 'desc', then the reverse parameter will be True, and memories will be sorted in descending order.
-    memories.sort(key=lambda x: x["id"], reverse=sort_order == "desc")
+    next_cursor = None
+    if memories and len(memories) == n_results:
+        next_cursor = _page_cursor(memories[-1], order_by)
 
-    # Only keep the top n_results memories
-    memories = memories[:n_results]
+    debug_log(f"Listed memories from category {category}", memories)
 
-    debug_log(f"Got memories from category {category}", memories)
+    return memories, next_cursor
 
-    return memories
+
+def _page_cursor(memory, order_by):
+    # the sort key of the memory, "<created_at>:<id>" or "<id>"
+    if order_by == "created_at":
+        created_at = float(memory["metadata"].get("created_at") or 0)
+        return f"{created_at!r}:{memory['id']}"
+    return str(memory["id"])
+
+
+def _parse_cursor(cursor, order_by):
+    if cursor is None:
+        return None
+    if order_by == "created_at":
+        created_at, _, id = cursor.rpartition(":")
+        return (float(created_at), id)
+    return (cursor,)
 
 
 def get_last_message(category, chat_id, username=None, message_uuid=None):
@@ -550,10 +938,10 @@ def get_last_message(category, chat_id, username=None, message_uuid=None):
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
-    # Get the types to include based on the function parameters
-    include_types = get_include_types(True, False)
+    # only documents and metadata are used, embeddings are left out
+    include_types = get_include_types(False, False)
 
     # Retrieve all memories that meet the given metadata filter
     memories = memories.get(where={"chat_id": chat_id}, include=include_types)
@@ -605,7 +993,7 @@ def update_memory(
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     # If neither text nor metadata is provided, raise an exception
     if metadata is None and text is None:
@@ -632,6 +1020,8 @@ def update_memory(
     memories.update(
         ids=[str(id)], documents=documents, metadatas=metadatas, embeddings=embeddings
     )
+    if documents is not None:
+        update_text_index(category, [str(id)], documents, username=username)
 
     debug_log(
         f"Updated memory {id} in category {category}",
@@ -654,7 +1044,7 @@ def delete_memory(category, id, username=None):
         >>> delete_memory("books", "1")
     """
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     if not memory_exists(category, id, username=username):
         debug_log(
@@ -664,6 +1054,7 @@ def delete_memory(category, id, username=None):
         return
     # Delete the memory
     memories.delete(ids=[str(id)])
+    remove_from_text_index(category, [str(id)], username=username)
 
     debug_log(f"Deleted memory {id} in category {category}")
 
@@ -685,13 +1076,14 @@ def delete_memories(category, document=None, metadata=None, username=None):
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     # Create a query to match either the document or the metadata
     if document is not None:
         memories.delete(where_document={"$contains": document})
     if metadata is not None:
         memories.delete(where=metadata)
+    forget_text_index(category, username=username)
 
     debug_log(f"Deleted memories from category {category}")
 
@@ -755,7 +1147,7 @@ def memory_exists(category, id, includes_metadata=None, username=None):
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     # Check if there's a memory with the given ID and metadata
     memory = memories.get(ids=[str(id)], where=includes_metadata, limit=1)
@@ -785,7 +1177,7 @@ def count_memories(category, novel=False, username=None):
     """
 
     # Get or create the collection for the given category
-    memories = get_client(username=username).get_or_create_collection(category)
+    memories = get_or_create_collection(category, username=username)
 
     if novel:
         memories = memories.get(where={"novel": "True"})
@@ -822,6 +1214,7 @@ def wipe_category(category, username=None):
     if collection is not None:
         # Delete the entire category
         get_client(username=username).delete_collection(category)
+        forget_collections(username=username)
 
 
 def wipe_all_memories(username=None):
@@ -837,6 +1230,7 @@ def wipe_all_memories(username=None):
     # Iterate over all collections
     for collection in collections:
         client.delete_collection(collection.name)
+    forget_collections(username=username)
 
     debug_log("Wiped all memories", type="system")
 
@@ -850,3 +1244,4 @@ def stop_database(username=None):
     """
     client = get_client(username=username)
     client.reset()
+    close_client(username=username)
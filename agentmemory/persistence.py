@@ -1,11 +1,18 @@
 import json
+import time
+
+import logs
 from agentmemory import (
-    create_memory,
-    get_memories,
+    create_memories,
+    list_memories,
     wipe_all_memories,
 )
 from agentmemory.client import get_client
 
+logger = logs.Log("agentmemory", "agentmemory.log").get_logger()
+
+EXPORT_PAGE_SIZE = 1000
+
 
 def export_memory_to_json(include_embeddings=True, username=None):
     """
@@ -22,6 +29,7 @@ def export_memory_to_json(include_embeddings=True, username=None):
         >>> export_memory_to_json()
     """
 
+    started = time.perf_counter()
     collections = get_client(username=username).list_collections()
 
     collections_dict = {}
@@ -31,14 +39,29 @@ def export_memory_to_json(include_embeddings=True, username=None):
         collection_name = collection.name
         collections_dict[collection_name] = []
 
-        # Get all memories from the current collection
-        memories = get_memories(
-            collection_name, include_embeddings=include_embeddings, username=username
-        )
-        for memory in memories:
+        # Get all memories from the current collection, a page at a time
+        cursor = None
+        while True:
+            memories, cursor = list_memories(
+                collection_name,
+                n_results=EXPORT_PAGE_SIZE,
+                order_by="id",
+                sort_order="asc",
+                cursor=cursor,
+                include_embeddings=include_embeddings,
+                username=username,
+            )
             # Append each memory to its corresponding collection list
-            collections_dict[collection_name].append(memory)
-
+            collections_dict[collection_name].extend(memories)
+            if cursor is None:
+                break
+
+    rows = sum(len(memories) for memories in collections_dict.values())
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Exported {rows} memories in {elapsed:.2f}s "
+        f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+    )
     return collections_dict
 
 
@@ -83,19 +106,28 @@ def import_json_to_memory(data, replace=True, username=None):
     if replace:
         wipe_all_memories(username=username)
 
+    started = time.perf_counter()
+    rows = 0
     # Iterate over all collections in the input data
     for category in data:
-        # Iterate over all memories in the current collection
-        for memory in data[category]:
-            # Create a new memory in the current category
-            create_memory(
-                category,
-                text=memory["document"],
-                metadata=memory["metadata"],
-                id=memory["id"],
-                embedding=memory.get("embedding", None),
-                username=username,
-            )
+        memories = data[category]
+        if not memories:
+            continue
+        # Create all memories of the category in bulk
+        create_memories(
+            category,
+            texts=[memory["document"] for memory in memories],
+            metadatas=[memory["metadata"] for memory in memories],
+            ids=[memory["id"] for memory in memories],
+            embeddings=[memory.get("embedding", None) for memory in memories],
+            username=username,
+        )
+        rows += len(memories)
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Imported {rows} memories in {elapsed:.2f}s "
+        f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+    )
 
 
 def import_file_to_memory(path="./memory.json", replace=True, username=None):
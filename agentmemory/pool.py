@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+POSTGRES_POOL_MIN = int(os.environ.get("POSTGRES_POOL_MIN", 1))
+POSTGRES_POOL_MAX = int(os.environ.get("POSTGRES_POOL_MAX", 10))
+POSTGRES_POOL_TIMEOUT = float(os.environ.get("POSTGRES_POOL_TIMEOUT", 10))
+# connections idle for longer than this are pinged before being handed out
+POSTGRES_POOL_HEALTH_CHECK_INTERVAL = float(
+    os.environ.get("POSTGRES_POOL_HEALTH_CHECK_INTERVAL", 30)
+)
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    """
+    Thread-safe psycopg2 pool that blocks up to `timeout` seconds for a free
+    connection instead of failing at once, registers pgvector on every new
+    connection and replaces connections that fail a health check.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        minconn: int = POSTGRES_POOL_MIN,
+        maxconn: int = POSTGRES_POOL_MAX,
+        timeout: float = POSTGRES_POOL_TIMEOUT,
+        health_check_interval: float = POSTGRES_POOL_HEALTH_CHECK_INTERVAL,
+    ):
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at: Dict[int, float] = {}
+        self.checkouts = 0
+        self.timeouts = 0
+        self.replaced = 0
+        super().__init__(minconn, maxconn, dsn)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        from pgvector.psycopg2 import register_vector
+
+        register_vector(conn)
+        conn.commit()
+        return conn
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        returned_at = self._returned_at.get(id(conn), 0)
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise PoolError(
+                f"no connection available within {self.timeout} seconds "
+                f"({self.maxconn} in use)"
+            )
+        try:
+            conn = super().getconn(key)
+            while not self._healthy(conn):
+                super().putconn(conn, key, close=True)
+                with self._lock:
+                    self.replaced += 1
+                conn = super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        # the base class rolls back any transaction left open on `conn`
+        if close or conn.closed:
+            self._returned_at.pop(id(conn), None)
+        else:
+            self._returned_at[id(conn)] = time.monotonic()
+        try:
+            super().putconn(conn, key, close=close)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, committing on success and rolling back on error."""
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "in_use": len(self._used),
+                "idle": len(self._pool),
+                "min": self.minconn,
+                "max": self.maxconn,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "replaced": self.replaced,
+            }
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn: str) -> ConnectionPool:
+    """Return the process-wide pool for `dsn`, opening it on first use."""
+    pool = _pools.get(dsn)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = ConnectionPool(dsn)
+            _pools[dsn] = pool
+    return pool
+
+
+def get_pool_stats() -> Dict[str, Dict[str, int]]:
+    stats = {}
+    for dsn, pool in list(_pools.items()):
+        # keyed by host/database rather than the dsn, which may hold a password
+        params = parse_dsn(dsn)
+        stats[f"{params.get('host', '')}/{params.get('dbname', '')}"] = pool.stats()
+    return stats
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
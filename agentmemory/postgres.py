@@ -1,7 +1,43 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-import psycopg2
 
-from agentmemory.check_model import check_model, infer_embeddings
+import numpy as np
+from psycopg2 import errors
+from psycopg2.extras import Json, execute_values
+
+import logs
+from agentmemory.check_model import check_model
+from agentmemory.batcher import embed_documents
+from agentmemory.pool import get_pool
+
+logger = logs.Log("agentmemory", "agentmemory.log").get_logger()
+
+# "hnsw", "ivfflat" or "none"; hnsw falls back to ivfflat on pgvector < 0.5
+PGVECTOR_INDEX = os.environ.get("PGVECTOR_INDEX", "hnsw")
+PGVECTOR_HNSW_M = int(os.environ.get("PGVECTOR_HNSW_M", 16))
+PGVECTOR_HNSW_EF_CONSTRUCTION = int(os.environ.get("PGVECTOR_HNSW_EF_CONSTRUCTION", 64))
+PGVECTOR_IVFFLAT_LISTS = int(os.environ.get("PGVECTOR_IVFFLAT_LISTS", 100))
+
+# "columns" stores each metadata key in its own TEXT column, "jsonb" stores all
+# of them in one indexed metadata column; existing tables keep their layout
+POSTGRES_METADATA_LAYOUT = os.environ.get("POSTGRES_METADATA_LAYOUT", "columns")
+# reciprocal rank fusion constant of hybrid search, 60 as in Cormack et al.
+HYBRID_RRF_K = int(os.environ.get("HYBRID_RRF_K", 60))
+TSQUERY_ALL = "plainto_tsquery('simple', %s)"
+# any of the words, by turning the ANDs of plainto_tsquery into ORs; a CAST
+# rather than ::tsquery, which is not allowed where it is used as a FROM item
+TSQUERY_ANY = (
+    "CAST(replace(plainto_tsquery('simple', %s)::text, ' & ', ' | ') AS tsquery)"
+)
+# table columns that are not metadata keys in the column layout
+NON_METADATA_COLUMNS = ["id", "document", "embedding", "document_tsv"]
+# jsonb layout: keys with their own expression index, and keys stored as numbers
+JSONB_INDEXED_KEYS = ["chat_id", "uid", "username", "novel"]
+JSONB_NUMERIC_KEYS = ["created_at", "updated_at"]
 
 
 def parse_metadata(where):
@@ -18,28 +54,84 @@ def parse_metadata(where):
     return metadata
 
 
-def handle_and_condition(and_conditions):
+def jsonb_metadata_value(key, value):
+    # stored like the TEXT columns of the column layout, except timestamps,
+    # which stay numbers so range filters compare numerically
+    if value is None:
+        return None
+    if key in JSONB_NUMERIC_KEYS:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    return str(value)
+
+
+def jsonb_metadata(metadata):
+    return {key: jsonb_metadata_value(key, value) for key, value in metadata.items()}
+
+
+def metadata_condition(key, sql_operator, operand, layout="columns"):
+    if layout != "jsonb":
+        return f"{key} {sql_operator} %s", [operand]
+    if key in JSONB_NUMERIC_KEYS:
+        return f"(metadata->>%s)::double precision {sql_operator} %s", [
+            key,
+            jsonb_metadata_value(key, operand),
+        ]
+    if sql_operator == "=" and key not in JSONB_INDEXED_KEYS:
+        # containment is what the GIN index serves
+        return "metadata @> %s::jsonb", [json.dumps({key: str(operand)})]
+    return f"metadata->>%s {sql_operator} %s", [key, str(operand)]
+
+
+def handle_and_condition(and_conditions, layout="columns"):
     conditions = []
     params = []
     for condition in and_conditions:
         for key, value in condition.items():
             for operator, operand in value.items():
                 sql_operator = get_sql_operator(operator)
-                conditions.append(f"{key} {sql_operator} %s")
-                params.append(operand)
+                condition_sql, new_params = metadata_condition(
+                    key, sql_operator, operand, layout
+                )
+                conditions.append(condition_sql)
+                params.extend(new_params)
     return conditions, params
 
 
-def handle_or_condition(or_conditions):
+def handle_or_condition(or_conditions, layout="columns"):
     or_groups = []
     params = []
     for condition in or_conditions:
-        conditions, new_params = handle_and_condition([condition])
+        conditions, new_params = handle_and_condition([condition], layout)
         or_groups.append(" AND ".join(conditions))
         params.extend(new_params)
     return f"({') OR ('.join(or_groups)})", params
 
 
+def where_conditions(where, layout="columns"):
+    conditions = []
+    params = []
+    for key, value in where.items():
+        if key == "$and":
+            new_conditions, new_params = handle_and_condition(value, layout)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
+        elif key == "$or":
+            or_condition, new_params = handle_or_condition(value, layout)
+            conditions.append(or_condition)
+            params.extend(new_params)
+        elif key == "$contains":
+            conditions.append(f"document LIKE %s")
+            params.append(f"%{value}%")
+        else:
+            condition_sql, new_params = metadata_condition(key, "=", str(value), layout)
+            conditions.append(condition_sql)
+            params.extend(new_params)
+    return conditions, params
+
+
 def get_sql_operator(operator):
     if operator == "$eq":
         return "="
@@ -63,19 +155,18 @@ class PostgresCollection:
         table_name = self.client._table_name(self.category)
 
         query = f"SELECT COUNT(*) FROM {table_name}"
-        self.client.cur.execute(query)
 
-        return self.client.cur.fetchone()[0]
+        def run(cur):
+            cur.execute(query)
+            return cur.fetchone()[0]
+
+        return self.client.run(self.category, run)
 
     def add(self, ids, documents=None, metadatas=None, embeddings=None):
-        if embeddings is None:
-            for id_, document, metadata in zip(ids, documents, metadatas):
-                self.client.insert_memory(self.category, document, metadata)
-        else:
-            for id_, document, metadata, emb in zip(
-                ids, documents, metadatas, embeddings
-            ):
-                self.client.insert_memory(self.category, document, metadata, emb)
+        # like the per-row path this replaced, ids are generated by the client
+        self.client.insert_memories(
+            self.category, documents, metadatas, embeddings=embeddings
+        )
 
     def get(
         self,
@@ -89,7 +180,6 @@ class PostgresCollection:
         # TODO: Mirrors Chroma API, but could be optimized a lot
 
         category = self.category
-        table_name = self.client._table_name(category)
         conditions = []
         params = []
         if where_document is not None:
@@ -98,22 +188,11 @@ class PostgresCollection:
             conditions.append("document LIKE %s")
             params.append(f"%{where_document}%")
 
+        layout = self.client._layout(category)
         if where:
-            for key, value in where.items():
-                if key == "$and":
-                    new_conditions, new_params = handle_and_condition(value)
-                    conditions.extend(new_conditions)
-                    params.extend(new_params)
-                elif key == "$or":
-                    or_condition, new_params = handle_or_condition(value)
-                    conditions.append(or_condition)
-                    params.extend(new_params)
-                elif key == "$contains":
-                    conditions.append(f"document LIKE %s")
-                    params.append(f"%{value}%")
-                else:
-                    conditions.append(f"{key}=%s")
-                    params.append(str(value))
+            new_conditions, new_params = where_conditions(where, layout)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
 
             self.client._ensure_metadata_columns_exist(category, parse_metadata(where))
 
@@ -126,53 +205,154 @@ class PostgresCollection:
             conditions.append("id=ANY(%s)")
             params.append(ids)
 
-        if limit is None:
-            limit = 100  # or another default value
+        # like Chroma, no limit returns every match
         if offset is None:
             offset = 0
 
-        query = f"SELECT * FROM {table_name}"
+        return self._select(conditions, params, where, limit, offset, include)
+
+    def get_page(
+        self,
+        order_by="created_at",
+        descending=True,
+        after=None,
+        limit=20,
+        where=None,
+        where_document=None,
+        include=["metadatas", "documents"],
+    ):
+        """
+        One page of memories sorted in the database by `order_by`
+        ("created_at" or "id"), ties broken by id. `after` is the
+        (created_at, id) or (id,) key of the last memory of the previous
+        page; pages start from it rather than from an offset, so a deep page
+        costs as much as the first one.
+        """
+        category = self.category
+        self.client.ensure_table_exists(category)
+        conditions, params, layout = self.client._conditions(
+            category, where, where_document
+        )
+        metadata = parse_metadata(where) if where else {}
+        direction = "DESC" if descending else "ASC"
+        if order_by == "created_at":
+            metadata["created_at"] = None
+            keys = [created_at_sql(layout), "t.id"]
+        elif order_by == "id":
+            keys = ["t.id"]
+        else:
+            raise ValueError(f"Cannot order memories by {order_by}")
+        self.client._ensure_metadata_columns_exist(category, metadata)
+        if after is not None:
+            after = list(after[:-1]) + [int(after[-1])]
+            conditions.append(
+                f"({', '.join(keys)}) {'<' if descending else '>'} "
+                f"({', '.join(['%s'] * len(after))})"
+            )
+            params.extend(after)
+        return self._select(
+            conditions,
+            params,
+            where,
+            limit,
+            0,
+            include,
+            order_by=", ".join(f"{key} {direction}" for key in keys),
+        )
+
+    def search_text(
+        self,
+        text,
+        mode="substring",
+        n_results=None,
+        where=None,
+        where_document=None,
+        include=["metadatas", "documents"],
+        match_all=True,
+    ):
+        """
+        Memories whose document contains `text` ignoring case ("substring",
+        served by the pg_trgm index), or all of its words ("words", served
+        by the tsvector index and ranked by ts_rank; any of them with
+        `match_all=False`).
+        """
+        category = self.category
+        table_name = self.client._table_name(category)
+        layout = self.client._layout(category)
+        conditions = []
+        params = []
+        order_by = "id"
+        order_params = []
+        if mode == "substring":
+            escaped = re.sub(r"([\\%_])", r"\\\1", text)
+            conditions.append("document ILIKE %s")
+            params.append(f"%{escaped}%")
+        elif mode == "words":
+            tsvector = "to_tsvector('simple', document)"
+            if self.client.schema.has_column(table_name, "document_tsv"):
+                tsvector = "document_tsv"
+            tsquery = TSQUERY_ALL if match_all else TSQUERY_ANY
+            conditions.append(f"{tsvector} @@ {tsquery}")
+            params.append(text)
+            order_by = f"ts_rank({tsvector}, {tsquery}) DESC, id"
+            order_params.append(text)
+        else:
+            raise ValueError(f"Unknown text search mode {mode}")
+        if where_document is not None:
+            if where_document.get("$contains", None) is not None:
+                where_document = where_document["$contains"]
+            conditions.append("document LIKE %s")
+            params.append(f"%{where_document}%")
+        if where:
+            new_conditions, new_params = where_conditions(where, layout)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
+            self.client._ensure_metadata_columns_exist(category, parse_metadata(where))
+        return self._select(
+            conditions,
+            params + order_params,
+            where,
+            n_results,
+            0,
+            include,
+            order_by=order_by,
+        )
+
+    def _select(self, conditions, params, where, limit, offset, include, order_by=None):
+        category = self.category
+        table_name = self.client._table_name(category)
+        layout = self.client._layout(category)
+        include_embeddings = include is not None and "embeddings" in include
+        query = (
+            f"SELECT {projection_sql(layout, include_embeddings)} FROM {table_name} t"
+        )
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
+        if order_by:
+            query += f" ORDER BY {order_by}"
         query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        params = list(params) + [limit, offset]
 
-        self.client.cur.execute(query, tuple(params))
+        def run(cur):
+            cur.execute(query, tuple(params))
+            return cur.fetchall(), [desc[0] for desc in cur.description]
 
-        rows = self.client.cur.fetchall()
+        rows, columns = self.client.run(
+            category, run, parse_metadata(where) if where else {}
+        )
 
         # Convert rows to list of dictionaries
-        columns = [desc[0] for desc in self.client.cur.description]
-        metadata_columns = [
-            col for col in columns if col not in ["id", "document", "embedding"]
-        ]
-
-        result = []
-        for row in rows:
-            item = dict(zip(columns, row))
-            metadata = {col: item[col] for col in metadata_columns}
-            item["metadata"] = metadata
-            result.append(item)
+        result = [dict(zip(columns, row)) for row in rows]
 
         output = {
             "ids": [row["id"] for row in result],
             "documents": [row["document"] for row in result],
-            "metadatas": [row["metadata"] for row in result],
+            "metadatas": [row["metadata"] or {} for row in result],
         }
 
-        if len(result) == 0 or include is None:
-            return output
-
-        # embeddings is an array, check if include includes "embeddings"
-        if "embeddings" in include and result[0].get("embedding", None) is not None:
-            output["embeddings"] = [row["embedding"] for row in result]
+        if include_embeddings and result and result[0]["embedding"] is not None:
             # transform from ndarray to list
-            output["embeddings"] = [emb.tolist() for emb in output["embeddings"]]
-
-        if "distances" in include and result[0].get("distance", None) is not None:
-            output["distances"] = [row["distances"] for row in result]
-            # transform to list
-            output["distances"] = [dist.tolist() for dist in output["distances"]]
+            output["embeddings"] = [row["embedding"].tolist() for row in result]
 
         return output
 
@@ -187,9 +367,62 @@ class PostgresCollection:
         where=None,
         where_document=None,
         include=["metadatas", "documents", "distances"],
+        ef_search=None,
+        probes=None,
     ):
         return self.client.query(
-            self.category, query_texts, n_results, where, where_document
+            self.category,
+            query_texts,
+            n_results,
+            where,
+            where_document,
+            ef_search=ef_search,
+            probes=probes,
+            include=include,
+        )
+
+    def query_many(
+        self,
+        query_texts,
+        n_results=10,
+        where=None,
+        where_document=None,
+        ef_search=None,
+        probes=None,
+        include=["metadatas", "documents", "distances"],
+    ):
+        return self.client.query_many(
+            self.category,
+            query_texts,
+            n_results,
+            where,
+            where_document,
+            ef_search=ef_search,
+            probes=probes,
+            include=include,
+        )
+
+    def hybrid_query(
+        self,
+        query_text,
+        n_results=10,
+        where=None,
+        where_document=None,
+        ef_search=None,
+        probes=None,
+        candidates=None,
+        include=["metadatas", "documents", "distances"],
+    ):
+        return self.client.hybrid_query(
+            self.category,
+            query_text,
+            n_results,
+            where,
+            where_document,
+            ef_search=ef_search,
+            probes=probes,
+            candidates=candidates,
+            include=include,
         )
 
     def update(self, ids, documents=None, metadatas=None, embeddings=None):
@@ -207,7 +440,9 @@ class PostgresCollection:
                 self.client.update(self.category, id_, document, metadata, emb)
 
     def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
-        self.add(ids, documents, metadatas, embeddings)
+        self.client.insert_memories(
+            self.category, documents, metadatas, ids, embeddings, upsert=True
+        )
 
     def delete(self, ids=None, where=None, where_document=None):
         table_name = self.client._table_name(self.category)
@@ -230,29 +465,22 @@ class PostgresCollection:
             params.append(ids)
 
         if where:
-            for key, value in where.items():
-                if key == "$and":
-                    new_conditions, new_params = handle_and_condition(value)
-                    conditions.extend(new_conditions)
-                    params.extend(new_params)
-                elif key == "$or":
-                    or_condition, new_params = handle_or_condition(value)
-                    conditions.append(or_condition)
-                    params.extend(new_params)
-                elif key == "$contains":
-                    conditions.append(f"document LIKE %s")
-                    params.append(f"%{value}%")
-                else:
-                    conditions.append(f"{key}=%s")
-                    params.append(str(value))
+            new_conditions, new_params = where_conditions(
+                where, self.client._layout(self.category)
+            )
+            conditions.extend(new_conditions)
+            params.extend(new_params)
 
         if conditions:
             query = f"DELETE FROM {table_name} WHERE " + " AND ".join(conditions)
         else:
             raise Exception("No valid conditions provided for deletion.")
 
-        self.client.cur.execute(query, tuple(params))
-        self.client.connection.commit()
+        self.client.run(
+            self.category,
+            lambda cur: cur.execute(query, tuple(params)),
+            parse_metadata(where) if where else {},
+        )
 
 
 class PostgresCategory:
@@ -260,6 +488,233 @@ class PostgresCategory:
         self.name = name
 
 
+class SchemaCache:
+    """
+    Memory tables and their columns, so the hot path does not run DDL or
+    catalog lookups. Loaded once from information_schema and updated when
+    this process runs DDL. PostgresClient.run drops it when a statement hits
+    a table or column that another worker has dropped; the next lookup, from
+    any thread, reads it again with a cursor from `cursor`.
+    """
+
+    def __init__(self, cursor=None):
+        self._lock = threading.Lock()
+        # one thread reads the dropped cache again, without holding _lock
+        self._reload_lock = threading.Lock()
+        self._tables = None
+        self._cursor = cursor
+
+    def load(self, cur):
+        cur.execute(
+            """
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name LIKE 'memory\\_%'
+            """
+        )
+        tables = {}
+        for table_name, column_name in cur.fetchall():
+            tables.setdefault(table_name, set()).add(column_name)
+        with self._lock:
+            self._tables = tables
+        return tables
+
+    @property
+    def loaded(self):
+        return self._tables is not None
+
+    def _known(self):
+        """The tables, read again first if the cache was dropped meanwhile."""
+        with self._lock:
+            tables = self._tables
+        if tables is not None:
+            return tables
+        with self._reload_lock:
+            with self._lock:
+                tables = self._tables
+            if tables is None:
+                if self._cursor is None:
+                    raise RuntimeError("Schema cache is not loaded")
+                with self._cursor() as cur:
+                    tables = self.load(cur)
+        return tables
+
+    def has_table(self, table_name):
+        tables = self._known()
+        with self._lock:
+            return table_name.lower() in tables
+
+    def has_column(self, table_name, column):
+        tables = self._known()
+        with self._lock:
+            return column.lower() in tables.get(table_name.lower(), set())
+
+    def missing_columns(self, table_name, columns):
+        tables = self._known()
+        with self._lock:
+            known = tables.get(table_name.lower(), set())
+            return [column for column in columns if column.lower() not in known]
+
+    def add_columns(self, table_name, columns):
+        with self._lock:
+            if self._tables is not None:
+                self._tables.setdefault(table_name.lower(), set()).update(
+                    column.lower() for column in columns
+                )
+
+    def drop_table(self, table_name):
+        with self._lock:
+            if self._tables is not None:
+                self._tables.pop(table_name.lower(), None)
+
+    def invalidate(self):
+        with self._lock:
+            self._tables = None
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+@contextmanager
+def pooled_cursor(connection_string):
+    """Cursor on a connection of the process-wide pool, committed on success."""
+    with get_pool(connection_string).connection() as connection:
+        with connection.cursor() as cur:
+            yield cur
+
+
+def get_schema_cache(connection_string):
+    with _schemas_lock:
+        if connection_string not in _schemas:
+            _schemas[connection_string] = SchemaCache(
+                lambda: pooled_cursor(connection_string)
+            )
+        return _schemas[connection_string]
+
+
+def ivfflat_lists(rows):
+    # pgvector's recommendation: rows / 1000 up to 1M rows, sqrt(rows) above
+    if rows > 1000000:
+        return int(rows**0.5)
+    return max(1, rows // 1000)
+
+
+def vector_index_sql(
+    table_name,
+    method=PGVECTOR_INDEX,
+    m=PGVECTOR_HNSW_M,
+    ef_construction=PGVECTOR_HNSW_EF_CONSTRUCTION,
+    lists=PGVECTOR_IVFFLAT_LISTS,
+    index_name=None,
+    concurrently=False,
+):
+    """CREATE INDEX statement for the embedding column, using L2 distance like query()."""
+    index_name = index_name or f"{table_name}_embedding_idx"
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unknown vector index method {method}")
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f"{index_name} ON {table_name} "
+        f"USING {method} (embedding vector_l2_ops) WITH ({options})"
+    )
+
+
+def metadata_sql(layout="columns", alias="t"):
+    """
+    SQL expression for the metadata dict of a memory row. In the column
+    layout the row is turned into jsonb minus its non-metadata columns, so
+    the embedding is not sent and metadata columns added by other workers
+    are still returned.
+    """
+    if layout == "jsonb":
+        return f"{alias}.metadata"
+    excluded = " - ".join(f"'{column}'" for column in NON_METADATA_COLUMNS)
+    return f"to_jsonb({alias}) - {excluded}"
+
+
+def created_at_sql(layout="columns", alias="t"):
+    """Creation time sort key of a memory row, 0 for rows without one."""
+    if layout == "jsonb":
+        return f"COALESCE(({alias}.metadata->>'created_at')::double precision, 0)"
+    return f"COALESCE({alias}.created_at::double precision, 0)"
+
+
+def query_results(include_embeddings=True):
+    """Empty query result dict; embeddings is None when they were not selected."""
+    return {
+        "ids": [],
+        "documents": [],
+        "metadatas": [],
+        "embeddings": [] if include_embeddings else None,
+        "distances": [],
+    }
+
+
+def append_query_result(results, item):
+    results["ids"].append(item["id"])
+    results["documents"].append(item["document"])
+    results["metadatas"].append(item["metadata"] or {})
+    results["distances"].append(item["distance"])
+    if results["embeddings"] is not None:
+        results["embeddings"].append(item["embedding"])
+
+
+def projection_sql(layout="columns", include_embeddings=False, alias="t"):
+    """Select list of id, document, metadata and, if asked for, the embedding."""
+    columns = [f"{alias}.id", f"{alias}.document"]
+    if include_embeddings:
+        columns.append(f"{alias}.embedding")
+    columns.append(f"{metadata_sql(layout, alias)} AS metadata")
+    return ", ".join(columns)
+
+
+def text_index_sql(table_name, concurrently=False):
+    """
+    Statements adding the word search column and the text indexes: pg_trgm
+    for substring and LIKE/ILIKE filters, GIN over document_tsv for words.
+    """
+    concurrently = "CONCURRENTLY " if concurrently else ""
+    return [
+        f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS document_tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', document)) STORED",
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_document_tsv_idx "
+        f"ON {table_name} USING gin (document_tsv)",
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_document_trgm_idx "
+        f"ON {table_name} USING gin (document gin_trgm_ops)",
+    ]
+
+
+def metadata_index_sql(table_name, concurrently=False):
+    """CREATE INDEX statements for the metadata column of the jsonb layout."""
+    concurrently = "CONCURRENTLY " if concurrently else ""
+    statements = [
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_metadata_idx "
+        f"ON {table_name} USING gin (metadata jsonb_path_ops)"
+    ]
+    for key in JSONB_INDEXED_KEYS:
+        statements.append(
+            f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_{key}_idx "
+            f"ON {table_name} ((metadata->>'{key}'))"
+        )
+    for key in JSONB_NUMERIC_KEYS:
+        statements.append(
+            f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_{key}_idx "
+            f"ON {table_name} (((metadata->>'{key}')::double precision))"
+        )
+    # serves the keyset pages of get_page, same expression as created_at_sql
+    statements.append(
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {table_name}_created_at_id_idx "
+        f"ON {table_name} "
+        "((COALESCE((metadata->>'created_at')::double precision, 0)), id)"
+    )
+    return statements
+
+
 default_model_path = str(Path.home() / ".cache" / "onnx_models")
 
 
@@ -270,56 +725,149 @@ class PostgresClient:
         model_name="all-MiniLM-L6-v2",
         model_path=default_model_path,
     ):
-        self.connection = psycopg2.connect(connection_string)
-        self.cur = self.connection.cursor()
-        from pgvector.psycopg2 import register_vector
-
-        register_vector(self.cur)  # Register PGVector functions
+        # connections are borrowed from the process-wide pool per operation
+        self.pool = get_pool(connection_string)
+        self.schema = get_schema_cache(connection_string)
+        self.model_name = model_name
         self.model_path = model_path
 
     def _table_name(self, category):
         return f"memory_{category}"
 
+    @contextmanager
+    def cursor(self):
+        """Cursor on a pooled connection, committed when the block exits cleanly."""
+        with self.pool.connection() as connection:
+            with connection.cursor() as cur:
+                yield cur
+
+    def run(self, category, operation, metadata=None):
+        """
+        Run `operation(cur)` on a pooled cursor. If another worker dropped the
+        table or columns it uses, refresh the schema cache, recreate them and
+        retry once.
+        """
+        try:
+            with self.cursor() as cur:
+                return operation(cur)
+        except (errors.UndefinedTable, errors.UndefinedColumn):
+            self.schema.invalidate()
+            self.ensure_table_exists(category)
+            if metadata:
+                self._ensure_metadata_columns_exist(category, metadata)
+            with self.cursor() as cur:
+                return operation(cur)
+
+    def _load_schema(self):
+        if not self.schema.loaded:
+            with self.cursor() as cur:
+                self.schema.load(cur)
+
+    def _layout(self, category):
+        """Metadata layout of a category table, see POSTGRES_METADATA_LAYOUT."""
+        table_name = self._table_name(category)
+        self._load_schema()
+        if self.schema.has_table(table_name):
+            if self.schema.has_column(table_name, "metadata"):
+                return "jsonb"
+            return "columns"
+        return POSTGRES_METADATA_LAYOUT
+
     def ensure_table_exists(self, category):
         table_name = self._table_name(category)
-        self.cur.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id SERIAL PRIMARY KEY,
-                document TEXT NOT NULL,
-                embedding VECTOR(384)
+        self._load_schema()
+        if self.schema.has_table(table_name):
+            return
+        with self.cursor() as cur:
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id SERIAL PRIMARY KEY,
+                    document TEXT NOT NULL,
+                    embedding VECTOR(384)
+                )
+            """
             )
+            if POSTGRES_METADATA_LAYOUT == "jsonb":
+                cur.execute(
+                    f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS "
+                    "metadata JSONB NOT NULL DEFAULT '{}'::jsonb"
+                )
+                for statement in metadata_index_sql(table_name):
+                    cur.execute(statement)
+            # the table may have existed already with more columns
+            self.schema.drop_table(table_name)
+            self.schema.load(cur)
+        self.ensure_vector_index(category)
+        self.ensure_text_index(category)
+
+    def ensure_text_index(self, category):
         """
-        )
-        self.connection.commit()
+        Add the text search column and indexes of a new category table.
+        Existing tables are indexed with `python -m agentmemory.admin
+        text-index`, as adding the column rewrites the table.
+        """
+        table_name = self._table_name(category)
+        statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+        statements += text_index_sql(table_name)
+        for statement in statements:
+            try:
+                with self.cursor() as cur:
+                    cur.execute(statement)
+            except (
+                errors.InsufficientPrivilege,
+                errors.UndefinedFile,
+                errors.UndefinedObject,
+                errors.FeatureNotSupported,
+            ) as e:
+                # text search still works without them, by scanning the table
+                logger.warning(f"{table_name}: {statement} failed: {e}")
+        with self.cursor() as cur:
+            self.schema.drop_table(table_name)
+            self.schema.load(cur)
+
+    def ensure_vector_index(self, category, method=PGVECTOR_INDEX):
+        """
+        Create the ANN index of a category table if it has none. Builds on
+        existing large tables should go through `python -m agentmemory.admin`,
+        which builds concurrently.
+        """
+        if method == "none":
+            return
+        table_name = self._table_name(category)
+        try:
+            with self.cursor() as cur:
+                cur.execute(vector_index_sql(table_name, method))
+        except (errors.UndefinedObject, errors.FeatureNotSupported):
+            if method != "hnsw":
+                raise
+            # pgvector < 0.5 has no hnsw access method
+            with self.cursor() as cur:
+                cur.execute(vector_index_sql(table_name, "ivfflat"))
 
     def _ensure_metadata_columns_exist(self, category, metadata):
         table_name = self._table_name(category)
-        for key in metadata.keys():
-            self.cur.execute(
-                """
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM pg_catalog.pg_attribute 
-                    WHERE attrelid = %s::regclass 
-                    AND attname = %s 
-                    AND NOT attisdropped
-                )
-            """,
-                (table_name, key),
+        if self._layout(category) == "jsonb":
+            return
+        missing = self.schema.missing_columns(table_name, metadata.keys())
+        if not missing:
+            return
+        with self.cursor() as cur:
+            cur.execute(
+                f"ALTER TABLE {table_name} "
+                + ", ".join(f"ADD COLUMN IF NOT EXISTS {key} TEXT" for key in missing)
             )
-            exists = self.cur.fetchone()[0]
-            if not exists:
-                self.cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {key} TEXT")
-                self.connection.commit()
+        self.schema.add_columns(table_name, missing)
 
     def list_collections(self):
-        self.cur.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='public'"
-        )
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema='public'"
+            )
+            rows = cur.fetchall()
         return [
-            PostgresCategory(row[0].split("_")[1])
-            for row in self.cur.fetchall()
+            PostgresCategory(row[0][len("memory_") :])
+            for row in rows
             if row[0].startswith("memory_")
         ]
 
@@ -328,170 +876,346 @@ class PostgresClient:
 
     def delete_collection(self, category):
         table_name = self._table_name(category)
-        self.cur.execute(f"DROP TABLE IF EXISTS {table_name}")
-        self.connection.commit()
+        with self.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.schema.drop_table(table_name)
 
     def get_or_create_collection(self, category):
         return PostgresCollection(category, self)
 
     def insert_memory(self, category, document, metadata={}, embedding=None, id=None):
+        return self.insert_memories(
+            category,
+            [document],
+            [metadata],
+            ids=None if id is None else [id],
+            embeddings=None if embedding is None else [embedding],
+        )[0]
+
+    def insert_memories(
+        self,
+        category,
+        documents,
+        metadatas=None,
+        ids=None,
+        embeddings=None,
+        upsert=False,
+        page_size=1000,
+    ):
+        """
+        Write many memories in one transaction with multi-row INSERTs.
+
+        Missing embeddings are computed in one batch, missing ids continue
+        from the current row count, and with `upsert` existing ids are
+        overwritten instead of raising.
+        """
+        if not documents:
+            return []
+        if metadatas is None:
+            metadatas = [{} for _ in documents]
         self.ensure_table_exists(category)
-        self._ensure_metadata_columns_exist(category, parse_metadata(metadata))
+        keys = []
+        for metadata in metadatas:
+            keys.extend(key for key in metadata if key not in keys)
+        self._ensure_metadata_columns_exist(
+            category, parse_metadata({key: None for key in keys})
+        )
         table_name = self._table_name(category)
 
-        if embedding is None:
-            embedding = self.create_embedding(document)
-
-        # if the id is None, get the length of the table by counting the number of rows in the category
-        if id is None:
-            id = self.get_or_create_collection(category).count()
+        if embeddings is None:
+            embeddings = [None] * len(documents)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = embed_documents(
+                [documents[i] for i in missing],
+                model_path=self.model_path,
+                model_name=self.model_name,
+            )
+            embeddings = list(embeddings)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+
+        if ids is None:
+            start = self.get_or_create_collection(category).count()
+            ids = list(range(start, start + len(documents)))
+
+        if self._layout(category) == "jsonb":
+            columns = ["id", "document", "embedding", "metadata"]
+            rows = [
+                [
+                    id_,
+                    document,
+                    np.asarray(embedding, dtype=np.float32),
+                    Json(jsonb_metadata(metadata)),
+                ]
+                for id_, document, metadata, embedding in zip(
+                    ids, documents, metadatas, embeddings
+                )
+            ]
+        else:
+            columns = ["id", "document", "embedding"] + keys
+            rows = [
+                [id_, document, np.asarray(embedding, dtype=np.float32)]
+                + [metadata.get(key) for key in keys]
+                for id_, document, metadata, embedding in zip(
+                    ids, documents, metadatas, embeddings
+                )
+            ]
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s"
+        if upsert:
+            updates = [f"{column}=EXCLUDED.{column}" for column in columns[1:]]
+            query += f" ON CONFLICT (id) DO UPDATE SET {', '.join(updates)}"
+        query += " RETURNING id"
 
-        # Extracting the keys and values from metadata to insert them into respective columns
-        columns = ["id", "document", "embedding"] + list(metadata.keys())
-        placeholders = ["%s"] * len(columns)
-        values = [id, document, embedding] + list(metadata.values())
+        def run(cur):
+            returned = execute_values(cur, query, rows, page_size=page_size, fetch=True)
+            return [row[0] for row in returned]
 
-        query = f"""
-        INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(placeholders)})
-        RETURNING id;
-        """
-        self.cur.execute(query, tuple(values))
-        self.connection.commit()
-        return self.cur.fetchone()[0]
+        return self.run(category, run, parse_metadata({key: None for key in keys}))
 
     def create_embedding(self, document):
-        embeddings = infer_embeddings([document], model_path=self.model_path)
+        embeddings = embed_documents(
+            [document], model_path=self.model_path, model_name=self.model_name
+        )
         return embeddings[0]
 
     def add(self, category, documents, metadatas, ids):
-        self.ensure_table_exists(category)
-        table_name = self._table_name(category)
-        with self.connection.cursor() as cur:
-            for document, metadata, id_ in zip(documents, metadatas, ids):
-                self._ensure_metadata_columns_exist(category, parse_metadata(metadata))
-
-                columns = ["id", "document", "embedding"] + list(metadata.keys())
-                placeholders = ["%s"] * len(columns)
-                embedding = self.create_embedding(document)
-                values = [id_, document, embedding] + list(metadata.values())
-
-                query = f"""
-                INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(placeholders)});
-                """
-                cur.execute(query, tuple(values))
-            self.connection.commit()
+        self.insert_memories(category, documents, metadatas, ids)
 
     def query(
-        self, category, query_texts, n_results=5, where=None, where_document=None
+        self,
+        category,
+        query_texts,
+        n_results=5,
+        where=None,
+        where_document=None,
+        ef_search=None,
+        probes=None,
+        include=None,
     ):
+        """
+        Nearest neighbours of each query text. `ef_search` (hnsw) and `probes`
+        (ivfflat) trade recall for speed for this call only. Embeddings are
+        only selected when `include` asks for them (or is None).
+        """
         self.ensure_table_exists(category)
         table_name = self._table_name(category)
-        conditions = []
-        params = []
-
-        # Check if where_document is given
-        if where_document:
-            if where_document.get("$contains", None) is not None:
-                where_document = where_document["$contains"]
-            conditions.append("document LIKE %s")
-            params.append(f"%{where_document}%")
-
-        if where:
-            for key, value in where.items():
-                if key == "$and":
-                    new_conditions, new_params = handle_and_condition(value)
-                    conditions.extend(new_conditions)
-                    params.extend(new_params)
-                elif key == "$or":
-                    or_condition, new_params = handle_or_condition(value)
-                    conditions.append(or_condition)
-                    params.extend(new_params)
-                elif key == "$contains":
-                    conditions.append(f"document LIKE %s")
-                    params.append(f"%{value}%")
-                else:
-                    conditions.append(f"{key}=%s")
-                    params.append(str(value))
-
+        conditions, params, layout = self._conditions(category, where, where_document)
         where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        include_embeddings = include is None or "embeddings" in include
 
-        results = {
-            "ids": [],
-            "documents": [],
-            "metadatas": [],
-            "embeddings": [],
-            "distances": [],
-        }
-        with self.connection.cursor() as cur:
-            for emb in query_texts:
-                query_emb = self.create_embedding(emb)
+        query_embs = [self.create_embedding(text) for text in query_texts]
+
+        def run(cur):
+            results = query_results(include_embeddings)
+            self._set_search_options(cur, ef_search, probes)
+            for query_emb in query_embs:
                 params_with_emb = [query_emb] + params + [query_emb, n_results]
                 string = f"""
-                    SELECT id, document, embedding, embedding <-> %s AS distance, *
-                    FROM {table_name}
+                    SELECT {projection_sql(layout, include_embeddings)},
+                        t.embedding <-> %s AS distance
+                    FROM {table_name} t
                     {where_clause}
-                    ORDER BY embedding <-> %s
+                    ORDER BY t.embedding <-> %s
                     LIMIT %s
                     """
                 cur.execute(
                     string,
                     tuple(params_with_emb),
                 )
-                rows = cur.fetchall()
                 columns = [desc[0] for desc in cur.description]
-                metadata_columns = [
-                    col
-                    for col in columns
-                    if col not in ["id", "document", "embedding", "distance"]
-                ]
-                for row in rows:
-                    results["ids"].append(row[0])
-                    results["documents"].append(row[1])
-                    results["embeddings"].append(row[2])
-                    results["distances"].append(row[3])
-                    metadata = {
-                        col: row[columns.index(col)] for col in metadata_columns
-                    }
-                    results["metadatas"].append(metadata)
-        return results
+                for row in cur.fetchall():
+                    append_query_result(results, dict(zip(columns, row)))
+            return results
+
+        return self.run(category, run, parse_metadata(where) if where else {})
+
+    def query_many(
+        self,
+        category,
+        query_texts,
+        n_results=5,
+        where=None,
+        where_document=None,
+        ef_search=None,
+        probes=None,
+        include=None,
+    ):
+        """
+        Nearest neighbours of several query texts, embedded as one batch and
+        searched in one statement with a LATERAL join over the query vectors.
+        Returns one result dict per query text, in order.
+        """
+        self.ensure_table_exists(category)
+        table_name = self._table_name(category)
+        conditions, params, layout = self._conditions(category, where, where_document)
+        where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        include_embeddings = include is None or "embeddings" in include
+        query_embs = embed_documents(
+            list(query_texts), model_path=self.model_path, model_name=self.model_name
+        )
+        string = f"""
+            SELECT q.ord, m.*
+            FROM unnest(%s::vector[]) WITH ORDINALITY AS q(embedding, ord)
+            CROSS JOIN LATERAL (
+                SELECT {projection_sql(layout, include_embeddings)},
+                    t.embedding <-> q.embedding AS distance
+                FROM {table_name} t
+                {where_clause}
+                ORDER BY t.embedding <-> q.embedding
+                LIMIT %s
+            ) m
+            ORDER BY q.ord, m.distance
+            """
+        query_params = [[np.asarray(emb, dtype=np.float32) for emb in query_embs]]
+        query_params += params + [n_results]
+
+        def run(cur):
+            self._set_search_options(cur, ef_search, probes)
+            cur.execute(string, tuple(query_params))
+            rows = cur.fetchall()
+            columns = [desc[0] for desc in cur.description]
+            results = [query_results(include_embeddings) for _ in query_embs]
+            for row in rows:
+                item = dict(zip(columns, row))
+                append_query_result(results[item["ord"] - 1], item)
+            return results
+
+        return self.run(category, run, parse_metadata(where) if where else {})
+
+    def hybrid_query(
+        self,
+        category,
+        query_text,
+        n_results=5,
+        where=None,
+        where_document=None,
+        ef_search=None,
+        probes=None,
+        candidates=None,
+        rrf_k=HYBRID_RRF_K,
+        include=None,
+    ):
+        """
+        Vector and word search in one statement, fused with reciprocal rank
+        fusion: each row scores 1 / (rrf_k + rank) for each ranking it is in.
+        Each ranking holds `candidates` rows, by default n_results.
+        """
+        self.ensure_table_exists(category)
+        table_name = self._table_name(category)
+        conditions, params, layout = self._conditions(category, where, where_document)
+        where_clause = " AND ".join(conditions) if conditions else "TRUE"
+        tsvector = "to_tsvector('simple', document)"
+        if self.schema.has_column(table_name, "document_tsv"):
+            tsvector = "document_tsv"
+        candidates = candidates or n_results
+        include_embeddings = include is None or "embeddings" in include
+        query_emb = self.create_embedding(query_text)
+        tsquery = TSQUERY_ANY
+        string = f"""
+            WITH vector AS (
+                SELECT id, row_number() OVER (ORDER BY embedding <-> %s) AS rank
+                FROM {table_name}
+                WHERE {where_clause}
+                ORDER BY embedding <-> %s
+                LIMIT %s
+            ), lexical AS (
+                SELECT id, row_number() OVER (ORDER BY ts_rank({tsvector}, q) DESC) AS rank
+                FROM {table_name}, {tsquery} AS q
+                WHERE {where_clause} AND {tsvector} @@ q
+                ORDER BY ts_rank({tsvector}, q) DESC
+                LIMIT %s
+            ), fused AS (
+                SELECT id,
+                    COALESCE(1.0 / (%s + vector.rank), 0)
+                    + COALESCE(1.0 / (%s + lexical.rank), 0) AS score,
+                    lexical.rank IS NOT NULL AS lexical_match
+                FROM vector FULL OUTER JOIN lexical USING (id)
+            )
+            SELECT {projection_sql(layout, include_embeddings)},
+                t.embedding <-> %s AS distance, fused.score, fused.lexical_match
+            FROM fused JOIN {table_name} t ON t.id = fused.id
+            ORDER BY fused.score DESC, distance
+            LIMIT %s
+            """
+        query_params = (
+            [query_emb]
+            + params
+            + [query_emb, candidates, query_text]
+            + params
+            + [candidates, rrf_k, rrf_k, query_emb, n_results]
+        )
+
+        def run(cur):
+            self._set_search_options(cur, ef_search, probes)
+            cur.execute(string, tuple(query_params))
+            columns = [desc[0] for desc in cur.description]
+            results = query_results(include_embeddings)
+            results["scores"] = []
+            results["lexical_matches"] = []
+            for row in cur.fetchall():
+                item = dict(zip(columns, row))
+                append_query_result(results, item)
+                results["scores"].append(float(item["score"]))
+                results["lexical_matches"].append(item["lexical_match"])
+            return results
+
+        return self.run(category, run, parse_metadata(where) if where else {})
+
+    def _conditions(self, category, where, where_document):
+        conditions = []
+        params = []
+        if where_document:
+            if where_document.get("$contains", None) is not None:
+                where_document = where_document["$contains"]
+            conditions.append("document LIKE %s")
+            params.append(f"%{where_document}%")
+        layout = self._layout(category)
+        if where:
+            new_conditions, new_params = where_conditions(where, layout)
+            conditions.extend(new_conditions)
+            params.extend(new_params)
+        return conditions, params, layout
+
+    def _set_search_options(self, cur, ef_search=None, probes=None):
+        # SET LOCAL only lasts until the pooled connection's transaction ends
+        if ef_search is not None:
+            cur.execute("SET LOCAL hnsw.ef_search = %s", (int(ef_search),))
+        if probes is not None:
+            cur.execute("SET LOCAL ivfflat.probes = %s", (int(probes),))
 
     def update(self, category, id_, document=None, metadata=None, embedding=None):
         self.ensure_table_exists(category)
         table_name = self._table_name(category)
-        with self.connection.cursor() as cur:
-            if document:
-                if embedding is None:
-                    embedding = self.create_embedding(document)
-                if metadata:
-                    self._ensure_metadata_columns_exist(
-                        category, parse_metadata(metadata)
-                    )
-                    columns = ["document=%s", "embedding=%s"] + [
-                        f"{key}=%s" for key in metadata.keys()
-                    ]
-                    values = [document, embedding] + list(metadata.values())
-                else:
-                    columns = ["document=%s", "embedding=%s"]
-                    values = [document, embedding]
-
-                query = f"""
-                UPDATE {table_name}
-                SET {', '.join(columns)}
-                WHERE id=%s
-                """
-                cur.execute(query, tuple(values) + (id_,))
-            elif metadata:
-                self._ensure_metadata_columns_exist(category, parse_metadata(metadata))
-                columns = [f"{key}=%s" for key in metadata.keys()]
-                values = list(metadata.values())
-                query = f"""
-                UPDATE {table_name}
-                SET {', '.join(columns)}
-                WHERE id=%s
-                """
-                cur.execute(query, tuple(values) + (id_,))
-            self.connection.commit()
+        if metadata:
+            self._ensure_metadata_columns_exist(category, parse_metadata(metadata))
+        columns = []
+        values = []
+        if document:
+            if embedding is None:
+                embedding = self.create_embedding(document)
+            columns += ["document=%s", "embedding=%s"]
+            values += [document, embedding]
+        if metadata and self._layout(category) == "jsonb":
+            # merged into the stored object, like setting the columns
+            columns.append("metadata = metadata || %s")
+            values.append(Json(jsonb_metadata(metadata)))
+        elif metadata:
+            columns += [f"{key}=%s" for key in metadata.keys()]
+            values += list(metadata.values())
+        if not columns:
+            return
+        query = f"""
+        UPDATE {table_name}
+        SET {', '.join(columns)}
+        WHERE id=%s
+        """
+        self.run(
+            category,
+            lambda cur: cur.execute(query, tuple(values) + (id_,)),
+            parse_metadata(metadata) if metadata else {},
+        )
 
     def close(self):
-        self.cur.close()
-        self.connection.close()
+        # connections belong to the shared pool, see agentmemory.pool.close_pools
+        pass
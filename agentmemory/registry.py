@@ -0,0 +1,203 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from agentmemory.text_index import TextIndex
+
+CHROMA_MAX_CLIENTS = int(os.environ.get("CHROMA_MAX_CLIENTS", 64))
+CHROMA_CLIENT_IDLE_TTL = float(os.environ.get("CHROMA_CLIENT_IDLE_TTL", 900))
+# a client used more recently than this is never evicted, even over the limit,
+# so an operation that is still running keeps a working store
+CHROMA_CLIENT_MIN_IDLE = float(os.environ.get("CHROMA_CLIENT_MIN_IDLE", 60))
+# how often run_eviction looks for idle clients
+CHROMA_EVICT_INTERVAL = float(os.environ.get("CHROMA_EVICT_INTERVAL", 60))
+
+
+class _Entry:
+    __slots__ = ("client", "collections", "text_indexes", "last_used")
+
+    def __init__(self, client):
+        self.client = client
+        self.collections = {}
+        self.text_indexes = {}
+        self.last_used = time.monotonic()
+
+
+class ChromaClientRegistry:
+    """
+    One open Chroma client, plus its collection handles, per user.
+
+    Users idle for longer than `idle_ttl` are evicted, by run_eviction or
+    when another client is opened, and so are the least recently used ones
+    once more than `max_clients` are open. Evicted clients have their system
+    stopped, which releases the SQLite and HNSW resources.
+
+    The registry lock only guards the map of users. Opening a client,
+    creating collections and building text indexes hold a lock of the user,
+    so a slow cold start of one user does not stall the others.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        max_clients: int = CHROMA_MAX_CLIENTS,
+        idle_ttl: float = CHROMA_CLIENT_IDLE_TTL,
+        min_idle: float = CHROMA_CLIENT_MIN_IDLE,
+    ):
+        self.factory = factory
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.min_idle = min_idle
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._user_locks: Dict[str, threading.RLock] = {}
+        self.opened = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def _user_lock(self, username: str) -> threading.RLock:
+        with self._lock:
+            return self._user_locks.setdefault(username, threading.RLock())
+
+    def _touch(self, username: str, entry: _Entry) -> _Entry:
+        self._entries.move_to_end(username)
+        entry.last_used = time.monotonic()
+        return entry
+
+    def _entry(self, username: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                self.hits += 1
+                return self._touch(username, entry)
+        with self._user_lock(username):
+            with self._lock:
+                entry = self._entries.get(username)
+                if entry is not None:
+                    # opened by another thread meanwhile
+                    self.hits += 1
+                    return self._touch(username, entry)
+            client = self.factory(username)
+            with self._lock:
+                entry = _Entry(client)
+                self._entries[username] = entry
+                self.opened += 1
+                self._touch(username, entry)
+                self._evict()
+            return entry
+
+    def get_client(self, username: str):
+        return self._entry(username).client
+
+    def get_or_create_collection(self, username: str, category: str, **kwargs):
+        entry = self._entry(username)
+        with self._user_lock(username):
+            collection = entry.collections.get(category)
+            if collection is None:
+                collection = entry.client.get_or_create_collection(category, **kwargs)
+                entry.collections[category] = collection
+            return collection
+
+    def forget_collections(self, username: str) -> None:
+        """Drop cached collection handles, e.g. after collections were deleted."""
+        with self._user_lock(username), self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                entry.collections.clear()
+                entry.text_indexes.clear()
+
+    def get_text_index(
+        self, username: str, category: str, build: Callable[[], TextIndex]
+    ) -> TextIndex:
+        # built under the user lock, which update_text_index takes too, so no
+        # write can land between the build and the index becoming visible
+        entry = self._entry(username)
+        with self._user_lock(username):
+            index = entry.text_indexes.get(category)
+            if index is None:
+                index = build()
+                entry.text_indexes[category] = index
+            return index
+
+    def _text_index(self, username: str, category: str) -> Optional[TextIndex]:
+        with self._lock:
+            entry = self._entries.get(username)
+            return entry.text_indexes.get(category) if entry else None
+
+    def update_text_index(self, username: str, category: str, ids, documents) -> None:
+        """Add or replace documents in the text index, if one was built."""
+        with self._user_lock(username):
+            index = self._text_index(username, category)
+            if index is not None:
+                index.add(ids, documents)
+
+    def remove_from_text_index(self, username: str, category: str, ids) -> None:
+        with self._user_lock(username):
+            index = self._text_index(username, category)
+            if index is not None:
+                index.remove(ids)
+
+    def forget_text_index(self, username: str, category: str) -> None:
+        """Drop a text index whose changes are not known, it is rebuilt on use."""
+        with self._user_lock(username), self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                entry.text_indexes.pop(category, None)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for username, entry in list(self._entries.items()):
+            idle = now - entry.last_used
+            over_limit = len(self._entries) > self.max_clients
+            if idle > self.idle_ttl or (over_limit and idle > self.min_idle):
+                self._close(username)
+                self.evictions += 1
+
+    def evict_idle(self) -> None:
+        with self._lock:
+            self._evict()
+
+    async def run_eviction(self, interval: float = CHROMA_EVICT_INTERVAL) -> None:
+        """Evict idle clients every `interval` seconds, until cancelled, so a
+        quiet server releases them too."""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.evict_idle)
+
+    def _close(self, username: str) -> None:
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            _stop_client(entry.client)
+
+    def close(self, username: str) -> None:
+        with self._lock:
+            self._close(username)
+
+    def close_all(self) -> None:
+        with self._lock:
+            for username in list(self._entries):
+                self._close(username)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "open_clients": len(self._entries),
+                "max_clients": self.max_clients,
+                "opened": self.opened,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "collections": sum(len(e.collections) for e in self._entries.values()),
+                "text_indexes": sum(
+                    len(e.text_indexes) for e in self._entries.values()
+                ),
+            }
+
+
+def _stop_client(client) -> None:
+    # chromadb has no public close; stopping the system closes its stores
+    system: Optional[object] = getattr(client, "_system", None)
+    if system is not None:
+        system.stop()
@@ -0,0 +1,131 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Set
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def trigrams(text: str) -> Set[str]:
+    text = text.lower()
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def words(text: str) -> List[str]:
+    # the same split as Postgres' 'simple' text search configuration
+    return WORD_PATTERN.findall(text.lower())
+
+
+class TextIndex:
+    """
+    In-process trigram and word index over the documents of one collection,
+    the Chroma counterpart of the pg_trgm and tsvector indexes of the
+    Postgres backend.
+
+    Substring lookups intersect the postings of the query trigrams and check
+    only the remaining candidates, so their cost follows the number of
+    matches rather than the collection size.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._documents: Dict[str, str] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._words: Dict[str, Set[str]] = {}
+        self._total_words = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, ids: Iterable[str], documents: Iterable[str]) -> None:
+        with self._lock:
+            for id_, document in zip(ids, documents):
+                self._remove(id_)
+                document = document or ""
+                self._documents[id_] = document.lower()
+                for trigram in trigrams(document):
+                    self._trigrams.setdefault(trigram, set()).add(id_)
+                document_words = words(document)
+                self._total_words += len(document_words)
+                for word in set(document_words):
+                    self._words.setdefault(word, set()).add(id_)
+
+    def remove(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            for id_ in ids:
+                self._remove(id_)
+
+    def _remove(self, id_: str) -> None:
+        document = self._documents.pop(id_, None)
+        if document is None:
+            return
+        for trigram in trigrams(document):
+            postings = self._trigrams.get(trigram)
+            if postings is not None:
+                postings.discard(id_)
+                if not postings:
+                    del self._trigrams[trigram]
+        document_words = words(document)
+        self._total_words -= len(document_words)
+        for word in set(document_words):
+            postings = self._words.get(word)
+            if postings is not None:
+                postings.discard(id_)
+                if not postings:
+                    del self._words[word]
+
+    def search_substring(self, text: str) -> List[str]:
+        """Ids of the documents containing `text`, ignoring case."""
+        text = text.lower()
+        with self._lock:
+            query_trigrams = trigrams(text)
+            if query_trigrams:
+                postings = sorted(
+                    (self._trigrams.get(trigram, set()) for trigram in query_trigrams),
+                    key=len,
+                )
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                # too short for trigrams, check every document
+                candidates = self._documents.keys()
+            return sorted(id_ for id_ in candidates if text in self._documents[id_])
+
+    def search_words(self, text: str, match_all: bool = True) -> List[str]:
+        """
+        Ids of the documents containing every word of `text`, or with
+        `match_all=False` any of them, best BM25 score first.
+        """
+        query_words = set(words(text))
+        if not query_words:
+            return []
+        with self._lock:
+            postings = sorted(
+                (self._words.get(word, set()) for word in query_words), key=len
+            )
+            if match_all:
+                matches = set(postings[0]).intersection(*postings[1:])
+            else:
+                matches = set().union(*postings)
+            scores = {id_: self._bm25(id_, query_words) for id_ in matches}
+        return sorted(matches, key=lambda id_: (-scores[id_], id_))
+
+    def _bm25(self, id_: str, query_words: Set[str], k1=1.2, b=0.75) -> float:
+        total = len(self._documents)
+        document_words = words(self._documents[id_])
+        average_length = max(1.0, self._total_words / max(1, total))
+        counts = Counter(document_words)
+        score = 0.0
+        for word in query_words:
+            count = counts.get(word, 0)
+            if not count:
+                continue
+            frequency = len(self._words.get(word, ()))
+            idf = math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            score += (
+                idf
+                * count
+                * (k1 + 1)
+                / (count + k1 * (1 - b + b * len(document_words) / average_length))
+            )
+        return score
@@ -59,6 +59,8 @@ async def update_configuration(
         from configuration_page import reload_configuration, update_api_keys
 
         update_api_keys()
+        # the default model of new settings depends on the keys
+        SettingsManager.invalidate_settings()
 
         return JSONResponse(content={"message": "Configuration updated successfully"})
     except Exception as e:
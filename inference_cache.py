@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# seconds an auxiliary LLM response is reused across requests, 0 disables it
+AUX_INFERENCE_TTL = float(os.environ.get("AUX_INFERENCE_TTL", 60))
+AUX_INFERENCE_MAX_ENTRIES = int(os.environ.get("AUX_INFERENCE_MAX_ENTRIES", 1024))
+
+
+def inference_key(
+    username: str, role: str, model: str, message: Any
+) -> Tuple[str, str, str, str]:
+    """(username, role, model, input hash) key of an auxiliary LLM call."""
+    if not isinstance(message, str):
+        message = json.dumps(message, sort_keys=True, default=str)
+    digest = hashlib.sha256(message.encode("utf-8")).hexdigest()
+    return (username, role, model, digest)
+
+
+class TTLCache:
+    """Bounded mapping whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+shared_inferences = TTLCache(AUX_INFERENCE_TTL, AUX_INFERENCE_MAX_ENTRIES)
+
+
+class AuxiliaryInferenceCache:
+    """
+    Responses of the auxiliary LLM calls (date extraction, categorisation,
+    summaries) made while handling one request.
+
+    Stages asking for the same call share one response, and a stage asking
+    while the call is still running waits for it instead of making its own.
+    Responses are also kept in `shared` for a short time, so the next request
+    with the same input skips the call.
+    """
+
+    def __init__(self, shared: Optional[TTLCache] = shared_inferences):
+        self.shared = shared
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.hits = 0
+
+    async def get(
+        self, key: Hashable, call: Callable[[], Awaitable[Any]]
+    ) -> Optional[Any]:
+        task = self._calls.get(key)
+        if task is None:
+            cached = self.shared.get(key) if self.shared is not None else None
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.calls += 1
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            self.hits += 1
+        # a waiter cancelled at a deadline must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future) -> None:
+        if task.cancelled() or task.exception() is not None:
+            # failed calls are not cached, the next caller retries
+            self._calls.pop(key, None)
+        elif self.shared is not None and task.result() is not None:
+            self.shared.set(key, task.result())
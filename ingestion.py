@@ -0,0 +1,282 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import logs
+from config import USERS_DIR
+
+logger = logs.Log("ingestion", "ingestion.log").get_logger()
+
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS", 2))
+INGESTION_MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", 3))
+# fsync every log append, off trades durability for latency on slow disks
+INGESTION_WAL_FSYNC = os.environ.get("INGESTION_WAL_FSYNC", "true").lower() == "true"
+WAL_FILENAME = "ingestion.wal"
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the memory writes queued for one user, one JSON line
+    per write and a {"done": seq} line once every write up to seq is stored.
+    """
+
+    def __init__(self, path: str, fsync: bool = INGESTION_WAL_FSYNC):
+        self.path = path
+        self.fsync = fsync
+        self.last_seq = 0
+        self._lock = threading.Lock()
+
+    def _append(self, line: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, default=str) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def append(self, seq: int, write: Dict[str, Any]) -> None:
+        with self._lock:
+            self._append({"seq": seq, "write": write})
+            self.last_seq = max(self.last_seq, seq)
+
+    def mark_done(self, seq: int) -> None:
+        """Record that the writes up to `seq` are stored, emptying the log
+        when that is all of them."""
+        with self._lock:
+            if seq >= self.last_seq:
+                open(self.path, "w").close()
+            else:
+                self._append({"done": seq})
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """The logged writes without a later done line, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        writes, done = [], 0
+        with self._lock, open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line torn by a crash while it was written
+                    continue
+                if "done" in record:
+                    done = max(done, record["done"])
+                else:
+                    writes.append(record)
+                    self.last_seq = max(self.last_seq, record["seq"])
+        return [record for record in writes if record["seq"] > done]
+
+
+class _Write:
+    def __init__(self, seq: int, write: Dict[str, Any], enqueued: float):
+        self.seq = seq
+        self.write = write
+        self.enqueued = enqueued
+        self.attempts = 0
+        self.stored = asyncio.get_running_loop().create_future()
+
+
+class IngestionQueue:
+    """
+    Memory writes taken off the response path.
+
+    Writes are logged to a per-user write-ahead log, then stored by a pool of
+    `workers` asyncio tasks with `apply(username, writes)`, which gets all the
+    writes queued for a user since its last call, oldest first, so it can
+    embed and insert them in batches. A user's writes are applied by one
+    worker at a time, in the order they were queued, so each chat keeps its
+    order. Writes logged but not stored when the process stopped are queued
+    again by `recover`, so a write may be applied twice after a crash.
+
+    `flush(username)` waits until the writes queued for a user so far are
+    stored, for readers that must see them.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[str, List[Dict[str, Any]]], Awaitable[None]],
+        users_dir: str = USERS_DIR,
+        workers: int = INGESTION_WORKERS,
+        max_attempts: int = INGESTION_MAX_ATTEMPTS,
+    ):
+        self.apply = apply
+        self.users_dir = users_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._logs: Dict[str, WriteAheadLog] = {}
+        self._pending: Dict[str, List[_Write]] = {}
+        self._in_flight: Dict[str, List[_Write]] = {}
+        self._seq: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.applied = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def _log(self, username: str) -> WriteAheadLog:
+        if username not in self._logs:
+            self._logs[username] = WriteAheadLog(
+                os.path.join(self.users_dir, username, WAL_FILENAME)
+            )
+        return self._logs[username]
+
+    def start(self) -> None:
+        if self._tasks and not all(task.done() for task in self._tasks):
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(max(1, self.workers))
+        ]
+        # users queued before the workers were (re)started
+        for username, writes in self._pending.items():
+            if writes and username not in self._in_flight:
+                self._ready.put_nowait(username)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Store what is queued, waiting at most `timeout` seconds, then stop."""
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Stopping with {self.stats()['depth']} memory writes left in the log"
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, username: str, write: Dict[str, Any]) -> None:
+        """Log a write and queue it. Returns once it is logged, not stored."""
+        self.start()
+        # one write of a user is logged at a time, so they are queued in order
+        async with self._locks.setdefault(username, asyncio.Lock()):
+            seq = self._seq.get(username, 0) + 1
+            self._seq[username] = seq
+            await asyncio.to_thread(self._log(username).append, seq, write)
+            self._queue(username, _Write(seq, write, time.time()))
+
+    def _queue(self, username: str, item: _Write) -> None:
+        writes = self._pending.setdefault(username, [])
+        writes.append(item)
+        if len(writes) == 1 and username not in self._in_flight:
+            self._ready.put_nowait(username)
+
+    async def recover(self) -> int:
+        """Queue the logged writes of every user that were not stored."""
+        self.start()
+        recovered = 0
+        if not os.path.isdir(self.users_dir):
+            return recovered
+        for username in os.listdir(self.users_dir):
+            if not os.path.exists(os.path.join(self.users_dir, username, WAL_FILENAME)):
+                continue
+            records = await asyncio.to_thread(self._log(username).pending)
+            for record in records:
+                self._seq[username] = max(self._seq.get(username, 0), record["seq"])
+                self._queue(
+                    username, _Write(record["seq"], record["write"], time.time())
+                )
+            recovered += len(records)
+        if recovered:
+            logger.info(f"Recovered {recovered} memory writes from the log")
+        return recovered
+
+    async def flush(self, username: Optional[str] = None) -> None:
+        """Wait until the writes queued so far, of one user or all, are stored."""
+        if username is not None:
+            users = {username}
+        else:
+            users = {*self._pending, *self._in_flight}
+        waiting = [
+            item.stored
+            for user in users
+            for item in self._in_flight.get(user, []) + self._pending.get(user, [])
+        ]
+        if waiting:
+            await asyncio.gather(*waiting, return_exceptions=True)
+
+    async def _work(self) -> None:
+        while True:
+            username = await self._ready.get()
+            batch = self._pending.pop(username, [])
+            if not batch:
+                continue
+            self._in_flight[username] = batch
+            try:
+                await self._apply(username, batch)
+            finally:
+                del self._in_flight[username]
+                if self._pending.get(username):
+                    self._ready.put_nowait(username)
+
+    async def _apply(self, username: str, batch: List[_Write]) -> None:
+        try:
+            await self.apply(username, [item.write for item in batch])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            for item in batch:
+                item.attempts += 1
+            dropped = [item for item in batch if item.attempts >= self.max_attempts]
+            retry = [item for item in batch if item.attempts < self.max_attempts]
+            if dropped:
+                logger.error(
+                    f"Dropping {len(dropped)} memory writes of {username} after "
+                    f"{self.max_attempts} attempts: {e}"
+                )
+                self.dropped += len(dropped)
+            if retry:
+                # dropped writes stay in the log until the retried ones are stored
+                self._resolve(dropped, e)
+                logger.error(
+                    f"Storing {len(retry)} memory writes of {username} failed, retrying: {e}"
+                )
+                await asyncio.sleep(retry[0].attempts)
+                # back in front of anything queued meanwhile
+                self._pending[username] = retry + self._pending.get(username, [])
+                return
+            error = e
+        else:
+            self.applied += len(batch)
+            self.batches += 1
+            error = None
+        # marked before the writes resolve, so a flushed user has a clean log
+        await asyncio.to_thread(self._log(username).mark_done, batch[-1].seq)
+        self._resolve(batch, error)
+
+    @staticmethod
+    def _resolve(items: List[_Write], error: Optional[Exception] = None) -> None:
+        for item in items:
+            if item.stored.done():
+                continue
+            if error is None:
+                item.stored.set_result(None)
+            else:
+                item.stored.set_exception(error)
+                # flush gathers with return_exceptions, nobody else retrieves it
+                item.stored.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        queued = [
+            item
+            for writes in list(self._pending.values()) + list(self._in_flight.values())
+            for item in writes
+            if not item.stored.done()
+        ]
+        oldest = min((item.enqueued for item in queued), default=None)
+        return {
+            "depth": len(queued),
+            "users": len({*self._pending, *self._in_flight}),
+            "lag_seconds": time.time() - oldest if oldest is not None else 0.0,
+            "applied": self.applied,
+            "batches": self.batches,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from typing import List, Type
 
@@ -64,7 +65,8 @@ def create_app(
 
     nltk.download("punkt")
 
-    model_name = "all-MiniLM-L6-v2"
+    # a name ending in -int8 selects a quantized copy made from the fp32 model
+    model_name = os.environ.get("POSTGRES_MODEL_NAME", "all-MiniLM-L6-v2")
     model_path = default_model_path
     downloaded_model_path = check_model(model_name=model_name, model_path=model_path)
 
@@ -92,9 +94,32 @@ def create_app(
         allow_headers=["*"],
     )
 
+    @app.on_event("startup")
+    async def startup_event():
+        from agentmemory.batcher import start_embedding_batcher
+        from agentmemory.client import run_client_eviction
+        from memory import ingestion_queue
+
+        await start_embedding_batcher()
+        app.state.client_eviction = asyncio.create_task(run_client_eviction())
+        # memory writes logged but not stored before the last shutdown
+        await ingestion_queue.recover()
+
     @app.on_event("shutdown")
-    def shutdown_event():
+    async def shutdown_event():
+        from agentmemory.batcher import stop_embedding_batcher
+        from agentmemory.client import close_clients
+        from agentmemory.pool import close_pools
+        from llm_clients import close_llm_clients
+        from memory import ingestion_queue
+
         logs.Log("main", "main.log").get_logger().debug("Shutting down server")
+        app.state.client_eviction.cancel()
+        await ingestion_queue.stop()
+        await stop_embedding_batcher()
+        await close_llm_clients()
+        close_pools()
+        close_clients()
 
     if middlewares is None:
         middlewares = default_middleware()
@@ -0,0 +1,157 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+
+import logs
+
+logger = logs.Log("llm_clients", "llm_clients.log").get_logger()
+
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 60))
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+LLM_HTTP2 = (
+    os.environ.get("LLM_HTTP2", "true").lower() == "true"
+    and importlib.util.find_spec("h2") is not None
+)
+
+PROVIDERS: Dict[str, Callable[..., Any]] = {
+    "openai": AsyncOpenAI,
+    "anthropic": AsyncAnthropic,
+}
+
+
+class _LoopClients:
+    """The httpx client of one event loop and the SDK clients using it."""
+
+    def __init__(self, http_client: httpx.AsyncClient):
+        self.http_client = http_client
+        self.clients: Dict[Tuple[str, str, Optional[str]], Any] = {}
+
+
+class LLMClientPool:
+    """
+    SDK clients of the process, one per (provider, api key, base url), all
+    sending their requests through one httpx client, so the calls of every
+    responder reuse the same kept-alive connections instead of opening a new
+    TLS connection each.
+
+    An httpx client can only use its connections on the event loop they were
+    opened on, so each loop gets its own httpx and SDK clients, kept while
+    the loop exists. Clients asked for outside of a loop share one more set.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        http2: bool = LLM_HTTP2,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self._loops: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._no_loop: Optional[_LoopClients] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _new(self) -> _LoopClients:
+        return _LoopClients(httpx.AsyncClient(limits=self.limits, http2=self.http2))
+
+    def _clients(self) -> _LoopClients:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        # loops that finished can not close their clients any more, the
+        # sockets go with the client
+        for closed in [other for other in self._loops if other.is_closed()]:
+            del self._loops[closed]
+        if loop is None:
+            current = self._no_loop
+        else:
+            current = self._loops.get(loop)
+        if current is None or current.http_client.is_closed:
+            current = self._new()
+            if loop is None:
+                self._no_loop = current
+            else:
+                self._loops[loop] = current
+        return current
+
+    def get(self, provider: str, api_key: str, base_url: Optional[str] = None) -> Any:
+        """The SDK client of `provider` ("openai" or "anthropic") for a key."""
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unsupported provider: {provider}")
+        key = (provider, api_key, base_url)
+        with self._lock:
+            current = self._clients()
+            client = current.clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            kwargs = {"api_key": api_key, "http_client": current.http_client}
+            if base_url:
+                kwargs["base_url"] = base_url
+            client = PROVIDERS[provider](**kwargs)
+            current.clients[key] = client
+            return client
+
+    async def close(self) -> None:
+        """Close the clients of every loop: on this one directly, on other
+        running loops by scheduling the close there."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entries = list(self._loops.items())
+            if self._no_loop is not None:
+                entries.append((loop, self._no_loop))
+            self._loops.clear()
+            self._no_loop = None
+        for owner, entry in entries:
+            if entry.http_client.is_closed:
+                continue
+            if owner is loop:
+                await entry.http_client.aclose()
+            elif owner.is_running():
+                asyncio.run_coroutine_threadsafe(entry.http_client.aclose(), owner)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._loops.values())
+            if self._no_loop is not None:
+                entries.append(self._no_loop)
+            return {
+                "loops": len(entries),
+                "clients": sum(len(entry.clients) for entry in entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "http2": self.http2,
+            }
+
+
+llm_clients = LLMClientPool()
+
+
+def get_llm_client(provider: str, api_key: str, base_url: Optional[str] = None):
+    return llm_clients.get(provider, api_key, base_url)
+
+
+async def close_llm_clients():
+    await llm_clients.close()
+
+
+def get_llm_client_stats():
+    return llm_clients.stats()
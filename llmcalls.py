@@ -10,14 +10,14 @@ import re
 import time
 import traceback
 import uuid
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
-import aiohttp
 import utils
 from PIL import Image
 
-from anthropic import AsyncAnthropic, APIStatusError, BadRequestError, RateLimitError
+from anthropic import APIStatusError, BadRequestError, RateLimitError
 from anthropic.types import ToolUseBlock, TextDelta
+from llm_clients import get_llm_client
+from settings_cache import addon_registry
 
 
 load_dotenv()
@@ -25,6 +25,15 @@ load_dotenv()
 stopPressed = {}
 
 
+def load_addons():
+    """The addon modules by name, imported once per process."""
+    return {
+        addon_name: addon_registry.get(addon_name)
+        for addon_name in addon_registry.addon_names()
+        if addon_name != "__init__"
+    }
+
+
 class ClaudeResponser:
     def __init__(
         self, api_key: str, default_params=None, model="claude-3-sonnet-20240620"
@@ -32,20 +41,14 @@ class ClaudeResponser:
         if default_params is None:
             default_params = {}
 
-        self.client = AsyncAnthropic(api_key=api_key)
+        self.client = get_llm_client("anthropic", api_key)
         self.default_params = default_params
-        self.addons = self.load_addons()
         self.model = model
 
-    def load_addons(self):
-        """Load the addons from the addons directory."""
-        addons = {}
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py") and filename != "__init__.py":
-                addon_name = filename.replace(".py", "")
-                addon = __import__(f"addons.{addon_name}", fromlist=[""])
-                addons[addon_name] = addon
-        return addons
+    @property
+    def addons(self):
+        # looked up when a tool is called, most responders never call one
+        return load_addons()
 
     async def process_chunk(self, chunk, collected_temp, chat_id, username, message):
         if chunk.type == "content_block_delta" and chunk.delta.type == "text_delta":
@@ -113,8 +116,6 @@ class ClaudeResponser:
             return img_byte_arr.getvalue()
 
     async def get_image_description(self, image_paths, prompt, username):
-        client = AsyncAnthropic(api_key=self.client.api_key)
-
         content = []
         for image_path in image_paths:
             image_data = self.resize_image(image_path)
@@ -133,7 +134,7 @@ class ClaudeResponser:
         content.append({"type": "text", "text": prompt})
 
         try:
-            response = await client.messages.create(
+            response = await self.client.messages.create(
                 model=self.model,
                 max_tokens=1000,
                 messages=[
@@ -232,132 +233,130 @@ class ClaudeResponser:
 
         for attempt in range(max_retries):
             try:
-                async with aiohttp.ClientSession() as session:
-                    self.client.session = session
-                    response = await asyncio.wait_for(
-                        self.client.messages.create(**params),
-                        timeout=timeout,
-                    )
-                    if stream:
-                        collected_messages = []
-                        collected_temp = []
-                        tool_calls = []
-                        current_tool_call = None
-                        code_result = None
-                        async for chunk in response:
-                            global stopPressed
+                response = await asyncio.wait_for(
+                    self.client.messages.create(**params),
+                    timeout=timeout,
+                )
+                if stream:
+                    collected_messages = []
+                    collected_temp = []
+                    tool_calls = []
+                    current_tool_call = None
+                    code_result = None
+                    async for chunk in response:
+                        global stopPressed
+                        stopStream = False
+                        if username in stopPressed:
+                            stopStream = stopPressed[username]
+                        if stopStream:
+                            stopPressed[username] = False
                             stopStream = False
-                            if username in stopPressed:
-                                stopStream = stopPressed[username]
-                            if stopStream:
-                                stopPressed[username] = False
-                                stopStream = False
-                                await utils.MessageSender.send_message(
-                                    {"cancel_message": True, "chat_id": chat_id},
-                                    "blue",
-                                    username,
-                                )
-                                break
-
-                            if chunk.type == "content_block_start":
-                                if isinstance(chunk.content_block, ToolUseBlock):
-                                    current_tool_call = {
-                                        "name": chunk.content_block.name,
-                                        "id": chunk.content_block.id,
-                                        "input": "",
-                                    }
-                                    tool_calls.append(current_tool_call)
-                            elif chunk.type == "content_block_delta":
-                                python_result = await self.process_chunk(
-                                    chunk, collected_temp, chat_id, username, message
-                                )
-                                if python_result:
-                                    code_result = python_result
-                                if chunk.delta.type == "text_delta":
-                                    content = chunk.delta.text
-                                    if content:
-                                        collected_messages.append(content)
-                                        yield await utils.MessageSender.send_message(
-                                            {
-                                                "chunk_message": content,
-                                                "chat_id": chat_id,
-                                            },
-                                            "blue",
-                                            username,
-                                        )
-                                elif chunk.delta.type == "input_json_delta":
-                                    if current_tool_call:
-                                        current_tool_call[
-                                            "input"
-                                        ] += chunk.delta.partial_json
-                            elif chunk.type == "content_block_stop":
-                                if current_tool_call:
-                                    current_tool_call = None
-                            elif chunk.type == "message_delta":
-                                if chunk.delta.stop_reason == "tool_use":
-                                    break
-                            elif chunk.type == "message_stop":
-                                break
-
-                        full_response = "".join(collected_messages)
-                        if code_result and role is None:
-                            full_response += f"<br><br>{code_result}"
-                            yield await utils.MessageSender.send_message(
-                                {
-                                    "chunk_message": f"<br><br>{code_result}",
-                                    "chat_id": chat_id,
-                                },
+                            await utils.MessageSender.send_message(
+                                {"cancel_message": True, "chat_id": chat_id},
                                 "blue",
                                 username,
                             )
+                            break
 
-                        yield full_response
-                        await utils.MessageSender.send_message(
+                        if chunk.type == "content_block_start":
+                            if isinstance(chunk.content_block, ToolUseBlock):
+                                current_tool_call = {
+                                    "name": chunk.content_block.name,
+                                    "id": chunk.content_block.id,
+                                    "input": "",
+                                }
+                                tool_calls.append(current_tool_call)
+                        elif chunk.type == "content_block_delta":
+                            python_result = await self.process_chunk(
+                                chunk, collected_temp, chat_id, username, message
+                            )
+                            if python_result:
+                                code_result = python_result
+                            if chunk.delta.type == "text_delta":
+                                content = chunk.delta.text
+                                if content:
+                                    collected_messages.append(content)
+                                    yield await utils.MessageSender.send_message(
+                                        {
+                                            "chunk_message": content,
+                                            "chat_id": chat_id,
+                                        },
+                                        "blue",
+                                        username,
+                                    )
+                            elif chunk.delta.type == "input_json_delta":
+                                if current_tool_call:
+                                    current_tool_call[
+                                        "input"
+                                    ] += chunk.delta.partial_json
+                        elif chunk.type == "content_block_stop":
+                            if current_tool_call:
+                                current_tool_call = None
+                        elif chunk.type == "message_delta":
+                            if chunk.delta.stop_reason == "tool_use":
+                                break
+                        elif chunk.type == "message_stop":
+                            break
+
+                    full_response = "".join(collected_messages)
+                    if code_result and role is None:
+                        full_response += f"<br><br>{code_result}"
+                        yield await utils.MessageSender.send_message(
                             {
-                                "stop_message": True,
+                                "chunk_message": f"<br><br>{code_result}",
                                 "chat_id": chat_id,
-                                "model": self.model,
                             },
                             "blue",
                             username,
                         )
 
-                        for tool_call in tool_calls:
-                            try:
-                                tool_input = json.loads(tool_call["input"])
-                                yield f"Executing tool: {tool_call['name']} with input {tool_input}"
-                                tool_result = (
-                                    await utils.MessageParser.process_function_call(
-                                        tool_call["name"],
-                                        tool_input,
-                                        self.addons,
-                                        function_metadata,
-                                        message,
-                                        message,
-                                        username,
-                                        None,
-                                        chat_id=chat_id,
-                                    )
-                                )
-                                yield f"{tool_result}"
-                            except json.JSONDecodeError:
-                                print(
-                                    f"Error decoding tool input JSON: {tool_call['input']}"
+                    yield full_response
+                    await utils.MessageSender.send_message(
+                        {
+                            "stop_message": True,
+                            "chat_id": chat_id,
+                            "model": self.model,
+                        },
+                        "blue",
+                        username,
+                    )
+
+                    for tool_call in tool_calls:
+                        try:
+                            tool_input = json.loads(tool_call["input"])
+                            yield f"Executing tool: {tool_call['name']} with input {tool_input}"
+                            tool_result = (
+                                await utils.MessageParser.process_function_call(
+                                    tool_call["name"],
+                                    tool_input,
+                                    self.addons,
+                                    function_metadata,
+                                    message,
+                                    message,
+                                    username,
+                                    None,
+                                    chat_id=chat_id,
                                 )
-                                yield f"Error processing tool call: Invalid JSON input"
+                            )
+                            yield f"{tool_result}"
+                        except json.JSONDecodeError:
+                            print(
+                                f"Error decoding tool input JSON: {tool_call['input']}"
+                            )
+                            yield f"Error processing tool call: Invalid JSON input"
 
+                else:
+                    elapsed = time.time() - now
+                    if response.content and len(response.content) > 0:
+                        await utils.MessageSender.update_token_usage(
+                            response, username, False, elapsed=elapsed
+                        )
+                        yield response.content[0].text
                     else:
-                        elapsed = time.time() - now
-                        if response.content and len(response.content) > 0:
-                            await utils.MessageSender.update_token_usage(
-                                response, username, False, elapsed=elapsed
-                            )
-                            yield response.content[0].text
-                        else:
-                            yield None
+                        yield None
 
-                    # If we get here, the request was successful, so we can break the retry loop
-                    break
+                # If we get here, the request was successful, so we can break the retry loop
+                break
 
             except asyncio.TimeoutError:
                 if attempt == max_retries - 1:
@@ -515,20 +514,14 @@ class OpenAIResponser:
             default_params = {}
 
         base_url = os.getenv("BASE_URL", None)
-        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        self.client = get_llm_client("openai", api_key, base_url)
         self.default_params = default_params
-        self.addons = self.load_addons()
         self.model = model
 
-    def load_addons(self):
-        """Load the addons from the addons directory."""
-        addons = {}
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py") and filename != "__init__.py":
-                addon_name = filename.replace(".py", "")
-                addon = __import__(f"addons.{addon_name}", fromlist=[""])
-                addons[addon_name] = addon
-        return addons
+    @property
+    def addons(self):
+        # looked up when a tool is called, most responders never call one
+        return load_addons()
 
     async def generate_audio(self, text, username, users_dir, voice="alloy", speed=1.0):
         """Asynchronously generate audio from text using the OpenAI API."""
@@ -674,118 +667,113 @@ class OpenAIResponser:
         timeout = 180.0
         now = time.time()
         try:
-            async with aiohttp.ClientSession() as session:
-                self.client.session = session
-                response = await asyncio.wait_for(
-                    self.client.chat.completions.create(**params),
-                    timeout=timeout,
-                )
-                if stream:
-                    func_call = {
-                        "name": None,
-                        "arguments": "",
-                    }
-                    collected_messages = []
-                    collected_temp = []
-                    tool_calls = []
-                    tool_calls_complete = False
-                    accumulated_name = ""
-                    accumulated_arguments = ""
-                    code_result = None
-                    async for chunk in response:
-                        delta = chunk.choices[0].delta
-                        # check if the user pressed stop
-                        global stopPressed
+            response = await asyncio.wait_for(
+                self.client.chat.completions.create(**params),
+                timeout=timeout,
+            )
+            if stream:
+                func_call = {
+                    "name": None,
+                    "arguments": "",
+                }
+                collected_messages = []
+                collected_temp = []
+                tool_calls = []
+                tool_calls_complete = False
+                accumulated_name = ""
+                accumulated_arguments = ""
+                code_result = None
+                async for chunk in response:
+                    delta = chunk.choices[0].delta
+                    # check if the user pressed stop
+                    global stopPressed
+                    stopStream = False
+                    if username in stopPressed:
+                        stopStream = stopPressed[username]
+                    if stopStream:
+                        stopPressed[username] = False
                         stopStream = False
-                        if username in stopPressed:
-                            stopStream = stopPressed[username]
-                        if stopStream:
-                            stopPressed[username] = False
-                            stopStream = False
-                            await utils.MessageSender.send_message(
-                                {"cancel_message": True, "chat_id": chat_id},
-                                "blue",
-                                username,
-                            )
-                            break
-
-                        content = delta.content or ""
-                        if content:
-                            collected_messages.append(content)
-                            yield await utils.MessageSender.send_message(
-                                {"chunk_message": content, "chat_id": chat_id},
-                                "blue",
-                                username,
-                            )
-
-                        if delta.tool_calls:
-                            for toolcall_chunk in delta.tool_calls:
-                                if (
-                                    toolcall_chunk.function.name
-                                    and not accumulated_name
-                                ):
-                                    accumulated_name = toolcall_chunk.function.name
-                                accumulated_arguments += (
-                                    toolcall_chunk.function.arguments or ""
-                                )
-
-                        python_result = await self.process_chunk(
-                            chunk, collected_temp, chat_id, username, message
+                        await utils.MessageSender.send_message(
+                            {"cancel_message": True, "chat_id": chat_id},
+                            "blue",
+                            username,
                         )
-                        if python_result:
-                            code_result = python_result
+                        break
 
-                        if chunk.choices[0].finish_reason:
-                            break
-
-                    full_response = "".join(collected_messages)
-
-                    if code_result and role is None:
-                        full_response += f"<br><br>{code_result}"
+                    content = delta.content or ""
+                    if content:
+                        collected_messages.append(content)
                         yield await utils.MessageSender.send_message(
-                            {
-                                "chunk_message": f"<br><br>{code_result}",
-                                "chat_id": chat_id,
-                            },
+                            {"chunk_message": content, "chat_id": chat_id},
                             "blue",
                             username,
                         )
 
-                    yield full_response
+                    if delta.tool_calls:
+                        for toolcall_chunk in delta.tool_calls:
+                            if toolcall_chunk.function.name and not accumulated_name:
+                                accumulated_name = toolcall_chunk.function.name
+                            accumulated_arguments += (
+                                toolcall_chunk.function.arguments or ""
+                            )
 
-                    await utils.MessageSender.send_message(
-                        {"stop_message": True, "chat_id": chat_id, "model": self.model},
+                    python_result = await self.process_chunk(
+                        chunk, collected_temp, chat_id, username, message
+                    )
+                    if python_result:
+                        code_result = python_result
+
+                    if chunk.choices[0].finish_reason:
+                        break
+
+                full_response = "".join(collected_messages)
+
+                if code_result and role is None:
+                    full_response += f"<br><br>{code_result}"
+                    yield await utils.MessageSender.send_message(
+                        {
+                            "chunk_message": f"<br><br>{code_result}",
+                            "chat_id": chat_id,
+                        },
                         "blue",
                         username,
                     )
 
-                    if accumulated_name and accumulated_arguments:
-                        try:
-                            parsed_arguments = json.loads(accumulated_arguments)
-                        except json.JSONDecodeError:
-                            parsed_arguments = (
-                                accumulated_arguments  # Use as-is if not valid JSON
-                            )
+                yield full_response
 
-                        tool_response = await utils.MessageParser.process_function_call(
-                            accumulated_name,
-                            parsed_arguments,
-                            self.addons,
-                            function_metadata,
-                            message,
-                            message,
-                            username,
-                            None,
-                            chat_id=chat_id,
+                await utils.MessageSender.send_message(
+                    {"stop_message": True, "chat_id": chat_id, "model": self.model},
+                    "blue",
+                    username,
+                )
+
+                if accumulated_name and accumulated_arguments:
+                    try:
+                        parsed_arguments = json.loads(accumulated_arguments)
+                    except json.JSONDecodeError:
+                        parsed_arguments = (
+                            accumulated_arguments  # Use as-is if not valid JSON
                         )
-                        yield tool_response
 
-                else:
-                    elapsed = time.time() - now
-                    await utils.MessageSender.update_token_usage(
-                        response, username, False, elapsed=elapsed
+                    tool_response = await utils.MessageParser.process_function_call(
+                        accumulated_name,
+                        parsed_arguments,
+                        self.addons,
+                        function_metadata,
+                        message,
+                        message,
+                        username,
+                        None,
+                        chat_id=chat_id,
                     )
-                    yield response.choices[0].message.content
+                    yield tool_response
+
+            else:
+                elapsed = time.time() - now
+                await utils.MessageSender.update_token_usage(
+                    response, username, False, elapsed=elapsed
+                )
+                yield response.choices[0].message.content
         except asyncio.TimeoutError:
             yield "The request timed out. Please try again."
         except Exception as e:
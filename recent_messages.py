@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RECENT_MESSAGES_PER_CHAT = int(os.environ.get("RECENT_MESSAGES_PER_CHAT", 100))
+RECENT_MESSAGES_MAX_CHATS = int(os.environ.get("RECENT_MESSAGES_MAX_CHATS", 1000))
+
+
+def history_line(message: Dict[str, Any]) -> str:
+    """The line of a message in the chat history given to the model."""
+    return f"{message['metadata'].get('username')}: {message['document']}"
+
+
+class RecentMessageCache:
+    """
+    Ring buffer of the last `per_chat` active_brain messages of each
+    (user, chat), oldest first, each with the token count of its history line.
+
+    A chat is filled from the memory store on first access and appended to
+    as messages are written. Edits and deletes invalidate it, and the least
+    recently used chats are evicted once more than `max_chats` are cached.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        per_chat: int = RECENT_MESSAGES_PER_CHAT,
+        max_chats: int = RECENT_MESSAGES_MAX_CHATS,
+    ):
+        self.count_tokens = count_tokens
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[Tuple[str, str], deque]" = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by the writes to a chat, or to every chat of a user, so a
+        # fill that read the store before a write landed is not cached
+        # without it, while writes to other chats leave it alone
+        self._chat_generations: Dict[Tuple[str, str], int] = {}
+        self._user_generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        entry = {
+            "document": message["document"],
+            "metadata": message["metadata"],
+            "id": message["id"],
+        }
+        if self.count_tokens is not None:
+            entry["tokens"] = self.count_tokens(history_line(entry))
+        return entry
+
+    def generation(self, username: str, chat_id: str) -> Tuple[int, int]:
+        """Write generation of a chat, read before filling it from the store."""
+        with self._lock:
+            return self._generation(username, chat_id)
+
+    def _generation(self, username: str, chat_id: str) -> Tuple[int, int]:
+        return (
+            self._user_generations.get(username, 0),
+            self._chat_generations.get((username, chat_id), 0),
+        )
+
+    def _bump(self, username: str, chat_id: str) -> None:
+        key = (username, chat_id)
+        self._chat_generations[key] = self._chat_generations.get(key, 0) + 1
+
+    def get(self, username: str, chat_id: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            messages = self._chats.get((username, chat_id))
+            if messages is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._chats.move_to_end((username, chat_id))
+            return [dict(message) for message in messages]
+
+    def fill(
+        self,
+        username: str,
+        chat_id: str,
+        messages: List[Dict[str, Any]],
+        generation: Tuple[int, int],
+    ) -> List[Dict[str, Any]]:
+        """
+        Cache the messages read from the store, unless the chat was written
+        to since `generation` was read, and return them with their token
+        counts.
+        """
+        entries = [self._entry(message) for message in messages[-self.per_chat :]]
+        with self._lock:
+            if generation == self._generation(username, chat_id):
+                self._chats[(username, chat_id)] = deque(entries, maxlen=self.per_chat)
+                self._chats.move_to_end((username, chat_id))
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+                    self.evictions += 1
+        return [dict(entry) for entry in entries]
+
+    def append(
+        self, username: str, chat_id: str, messages: List[Dict[str, Any]]
+    ) -> None:
+        """Add newly written messages to the chat, if it is cached."""
+        entries = [self._entry(message) for message in messages]
+        with self._lock:
+            self._bump(username, chat_id)
+            chat = self._chats.get((username, chat_id))
+            if chat is not None:
+                chat.extend(entries)
+
+    def invalidate(self, username: str, chat_id: Optional[str] = None) -> None:
+        """Drop one chat of a user, or all of them when `chat_id` is None."""
+        with self._lock:
+            if chat_id is not None:
+                self._bump(username, chat_id)
+                self._chats.pop((username, chat_id), None)
+                return
+            self._user_generations[username] = (
+                self._user_generations.get(username, 0) + 1
+            )
+            # the user generation now tells these apart from earlier fills
+            for key in [key for key in self._chat_generations if key[0] == username]:
+                del self._chat_generations[key]
+            for key in [key for key in self._chats if key[0] == username]:
+                del self._chats[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "max_chats": self.max_chats,
+                "per_chat": self.per_chat,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -57,10 +57,11 @@ from memory import (
     export_memory_to_file,
     import_file_to_memory,
     get_last_message,
-    get_memories,
+    list_memories,
     update_memory,
     delete_memory,
     MemoryManager,
+    recent_message_cache,
 )
 from simple_utils import get_root, convert_name
 from user_management.dao import UsersDAO, AdminControlsDAO
@@ -141,13 +142,29 @@ async def read_root():
 @router.get(
     "/memory_explorer/{category}", response_class=HTMLResponse, tags=[LOGIN_REQUIRED]
 )
-async def get_memory_explorer(request: Request, category: str):
+async def get_memory_explorer(
+    request: Request,
+    category: str,
+    cursor: Optional[str] = None,
+    page_size: int = 50,
+):
     with UsersDAO() as dao:
         username = request.state.user.username
-        memories = get_memories(category, username=username)
+        memories, next_cursor = list_memories(
+            category,
+            username=username,
+            n_results=page_size,
+            cursor=cursor,
+        )
         return templates.TemplateResponse(
             "memory_explorer.html",
-            {"request": request, "category": category, "memories": memories},
+            {
+                "request": request,
+                "category": category,
+                "memories": memories,
+                "page_size": page_size,
+                "next_cursor": next_cursor,
+            },
         )
 
 
@@ -331,6 +348,7 @@ async def handle_update_settings(request: Request, user: editSettings):
         raise HTTPException(status_code=400, detail="Category not found")
     with open(settings_file, "w") as f:
         json.dump(settings, f)
+    SettingsManager.invalidate_settings(username)
     with Database() as db, UsersDAO() as dao:
         total_tokens_used, total_cost = db.get_token_usage(username)
         total_daily_tokens_used, total_daily_cost = db.get_token_usage(username, True)
@@ -1005,6 +1023,8 @@ async def handle_upload_data(request: Request, data_file: UploadFile = File(...)
             replace=True,
             username=username,
         )
+        recent_message_cache.invalidate(username)
+        SettingsManager.invalidate_settings(username)
 
         # Delete the zip file
         os.remove(file_path)
@@ -1259,6 +1279,8 @@ async def edit_memory(
 ):
     username = request.state.user.username
     update_memory(category, memory_id, text=content, username=username)
+    if category == "active_brain":
+        recent_message_cache.invalidate(username)
     return {"message": "Memory updated successfully"}
 
 
@@ -1269,6 +1291,8 @@ async def delete_memory_route(
     user = request.state.user
     username = user.username if user else None
     delete_memory(category, id=memory_id, username=username)
+    if category == "active_brain":
+        recent_message_cache.invalidate(username)
     return {"message": "Memory deleted successfully"}
 
 
@@ -1277,7 +1301,13 @@ async def search_memories(
     request: Request, category: str = Form(...), search_query: str = Form(...)
 ):
     username = request.state.user.username
-    memories = search_memory(category, search_query, username=username, n_results=20)
+    memories = search_memory(
+        category,
+        search_query,
+        username=username,
+        n_results=20,
+        include_embeddings=False,
+    )
 
     # Include the distance value in each memory object
     for memory in memories:
@@ -1301,7 +1331,13 @@ async def sort_memories(
     search_query: str = Form(...),
 ):
     username = request.state.user.username
-    memories = search_memory(category, search_query, username=username, n_results=20)
+    memories = search_memory(
+        category,
+        search_query,
+        username=username,
+        n_results=20,
+        include_embeddings=False,
+    )
 
     # Sort the memories based on the selected sorting option and order
     if sort_by == "created_at":
@@ -1347,6 +1383,8 @@ async def search_memories(
     exact_match: bool = Form(False),
 ):
     username = request.state.user.username
+    # hybrid search finds exact names and codes without a rewritten query
+    mode = "exact" if exact_match else "hybrid"
 
     memories = search_memory(
         category,
@@ -1355,7 +1393,8 @@ async def search_memories(
         n_results=100,
         max_distance=1.4,
         min_distance=0.0,
-        exact_match=exact_match,
+        mode=mode,
+        include_embeddings=False,
     )
 
     # Sort the memories based on the selected sorting option and order
@@ -1395,17 +1434,26 @@ async def search_memories(
         else:
             print("memory is not a dict", memory)
 
-    rewritten = await queryRewrite(search_query, username, USERS_DIR, memories)
+    # only pay for the rewrite LLM call when no memory matched the words
+    rewritten = None
+    rewritten_memories = []
+    if not any(
+        memory.get("lexical_match") or exact_match
+        for memory in memories
+        if isinstance(memory, dict)
+    ):
+        rewritten = await queryRewrite(search_query, username, USERS_DIR, memories)
 
-    rewritten_memories = search_memory(
-        category,
-        rewritten,
-        username=username,
-        n_results=100,
-        max_distance=1.4,
-        min_distance=0.0,
-        exact_match=exact_match,
-    )
+        rewritten_memories = search_memory(
+            category,
+            rewritten,
+            username=username,
+            n_results=100,
+            max_distance=1.4,
+            min_distance=0.0,
+            mode=mode,
+            include_embeddings=False,
+        )
 
     return JSONResponse(
         content={
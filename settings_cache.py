@@ -0,0 +1,121 @@
+import copy
+import importlib.util
+import os
+import threading
+from types import ModuleType
+from typing import Any, Dict, List, Optional, Tuple
+
+ADDONS_DIR = "addons"
+
+
+def file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    """(mtime, size) of a file, None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class SettingsCache:
+    """
+    Validated settings.json of each (users_dir, username), kept until the file
+    or the addons directory changes on disk, or until invalidated after a
+    settings update.
+    """
+
+    def __init__(self):
+        self._settings: Dict[Tuple[str, str], Tuple[Any, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, users_dir: str, username: str, stamp: Any) -> Optional[Dict]:
+        """A copy of the cached settings, if they were cached at `stamp`."""
+        with self._lock:
+            entry = self._settings.get((users_dir, username))
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return None
+            self.hits += 1
+            settings = entry[1]
+        return copy.deepcopy(settings)
+
+    def set(
+        self, users_dir: str, username: str, stamp: Any, settings: Dict[str, Any]
+    ) -> None:
+        with self._lock:
+            self._settings[(users_dir, username)] = (stamp, copy.deepcopy(settings))
+
+    def invalidate(self, username: Optional[str] = None) -> None:
+        """Drop the settings of a user, or of everyone when `username` is None."""
+        with self._lock:
+            if username is None:
+                self._settings.clear()
+                return
+            for key in [key for key in self._settings if key[1] == username]:
+                del self._settings[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "users": len(self._settings),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class AddonRegistry:
+    """
+    Addon modules of the process, each imported once and imported again only
+    when its file changes.
+    """
+
+    def __init__(self, directory: str = ADDONS_DIR):
+        self.directory = directory
+        self._modules: Dict[str, Tuple[Tuple[int, int], ModuleType]] = {}
+        self._names: Optional[Tuple[int, List[str]]] = None
+        self._lock = threading.Lock()
+        self.imports = 0
+
+    def directory_stamp(self) -> int:
+        return os.stat(self.directory).st_mtime_ns
+
+    def addon_names(self) -> List[str]:
+        """Names of the addon files, in directory order."""
+        stamp = self.directory_stamp()
+        with self._lock:
+            if self._names is not None and self._names[0] == stamp:
+                return list(self._names[1])
+        names = [
+            filename[:-3]
+            for filename in os.listdir(self.directory)
+            if filename.endswith(".py")
+        ]
+        with self._lock:
+            self._names = (stamp, names)
+        return list(names)
+
+    def get(self, name: str) -> ModuleType:
+        """The module of an addon, imported again if its file changed."""
+        path = os.path.join(self.directory, f"{name}.py")
+        stamp = file_stamp(path)
+        with self._lock:
+            entry = self._modules.get(name)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        with self._lock:
+            self._modules[name] = (stamp, module)
+            self.imports += 1
+        return module
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"modules": len(self._modules), "imports": self.imports}
+
+
+settings_cache = SettingsCache()
+addon_registry = AddonRegistry()
@@ -0,0 +1,505 @@
+"""
+Local parser for the date a chat message refers to.
+
+Resolves common absolute and relative expressions ("yesterday", "last Monday",
+"3 days ago", "2024-03-05", "5 March") in English, Dutch, German, French,
+Spanish and Czech to a date range, and recognises messages without any date
+vocabulary as referring to no date. Anything else is reported as unsure, so
+the caller can fall back to the LLM date extractor.
+"""
+import re
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+RELATIVE_DAYS = {
+    0: ["today", "vandaag", "heute", "aujourd'hui", "hoy", "dnes"],
+    -1: ["yesterday", "gisteren", "gestern", "ayer", "včera"],
+    -2: [
+        "day before yesterday",
+        "eergisteren",
+        "vorgestern",
+        "avant-hier",
+        "anteayer",
+        "předevčírem",
+    ],
+}
+
+WEEKDAYS = [
+    ["monday", "maandag", "montag", "lundi", "lunes", "pondělí"],
+    ["tuesday", "dinsdag", "dienstag", "mardi", "martes", "úterý"],
+    ["wednesday", "woensdag", "mittwoch", "mercredi", "miércoles", "středa", "středu"],
+    ["thursday", "donderdag", "donnerstag", "jeudi", "jueves", "čtvrtek"],
+    ["friday", "vrijdag", "freitag", "vendredi", "viernes", "pátek"],
+    ["saturday", "zaterdag", "samstag", "samedi", "sábado", "sobota", "sobotu"],
+    ["sunday", "zondag", "sonntag", "dimanche", "domingo", "neděle", "neděli"],
+]
+
+MONTHS = [
+    ["january", "jan", "januari", "januar", "janvier", "enero", "ledna", "leden"],
+    ["february", "feb", "februari", "februar", "février", "febrero", "února", "únor"],
+    ["march", "mar", "maart", "märz", "mars", "marzo", "března", "březen"],
+    ["april", "apr", "avril", "abril", "dubna", "duben"],
+    ["may", "mei", "mai", "mayo", "května", "květen"],
+    ["june", "jun", "juni", "juin", "junio", "června", "červen"],
+    ["july", "jul", "juli", "juillet", "julio", "července", "červenec"],
+    ["august", "aug", "augustus", "août", "agosto", "srpna", "srpen"],
+    ["september", "sep", "sept", "septembre", "septiembre", "září"],
+    ["october", "oct", "oktober", "octobre", "octubre", "října", "říjen"],
+    ["november", "nov", "novembre", "noviembre", "listopadu", "listopad"],
+    ["december", "dec", "dezember", "décembre", "diciembre", "prosince", "prosinec"],
+]
+# month names that are also common words, only trusted next to a day number
+AMBIGUOUS_MONTHS = {"jan", "mar", "march", "mars", "may", "mai", "aug", "august"}
+
+# "<n> days ago" in each language
+DAYS_AGO = [
+    r"(\d{1,3}) days? ago",
+    r"(\d{1,3}) dag(?:en)? geleden",
+    r"vor (\d{1,3}) tag(?:en)?",
+    r"il y a (\d{1,3}) jours?",
+    r"hace (\d{1,3}) d[ií]as?",
+    r"před (\d{1,3}) dn(?:y|em)",
+]
+
+# (phrase, unit, offset): the week, month or year `offset` units from now
+RELATIVE_PERIODS = [
+    (
+        [
+            "this week",
+            "deze week",
+            "diese woche",
+            "cette semaine",
+            "esta semana",
+            "tento týden",
+        ],
+        "week",
+        0,
+    ),
+    (
+        [
+            "last week",
+            "vorige week",
+            "afgelopen week",
+            "letzte woche",
+            "vergangene woche",
+            "la semaine dernière",
+            "la semana pasada",
+            "minulý týden",
+        ],
+        "week",
+        -1,
+    ),
+    (
+        [
+            "this month",
+            "deze maand",
+            "diesen monat",
+            "ce mois-ci",
+            "este mes",
+            "tento měsíc",
+        ],
+        "month",
+        0,
+    ),
+    (
+        [
+            "last month",
+            "vorige maand",
+            "afgelopen maand",
+            "letzten monat",
+            "vergangenen monat",
+            "le mois dernier",
+            "el mes pasado",
+            "minulý měsíc",
+        ],
+        "month",
+        -1,
+    ),
+    (
+        ["this year", "dit jaar", "dieses jahr", "cette année", "este año", "letos"],
+        "year",
+        0,
+    ),
+    (
+        [
+            "last year",
+            "vorig jaar",
+            "afgelopen jaar",
+            "letztes jahr",
+            "l'année dernière",
+            "el año pasado",
+            "loni",
+            "minulý rok",
+        ],
+        "year",
+        -1,
+    ),
+]
+
+# words about the future; a weekday next to one of them is not the past one
+FUTURE_WORDS = [
+    "next",
+    "tomorrow",
+    "coming",
+    "volgende",
+    "komende",
+    "morgen",
+    "nächste",
+    "nächsten",
+    "übermorgen",
+    "prochain",
+    "prochaine",
+    "demain",
+    "próximo",
+    "próxima",
+    "mañana",
+    "příští",
+    "zítra",
+]
+
+# words that may refer to a date the rules above do not resolve
+DATE_CUES = [
+    "ago",
+    "day",
+    "days",
+    "week",
+    "weeks",
+    "weekend",
+    "month",
+    "months",
+    "year",
+    "years",
+    "morning",
+    "afternoon",
+    "evening",
+    "night",
+    "tonight",
+    "earlier",
+    "recently",
+    "previous",
+    "last",
+    "past",
+    "before",
+    "when",
+    "date",
+    "then",
+    "geleden",
+    "dag",
+    "dagen",
+    "weken",
+    "maand",
+    "jaar",
+    "ochtend",
+    "middag",
+    "avond",
+    "nacht",
+    "vorige",
+    "afgelopen",
+    "toen",
+    "wanneer",
+    "datum",
+    "tag",
+    "tage",
+    "tagen",
+    "woche",
+    "wochen",
+    "monat",
+    "jahr",
+    "abend",
+    "letzte",
+    "letzten",
+    "damals",
+    "wann",
+    "vor",
+    "jour",
+    "jours",
+    "semaine",
+    "mois",
+    "année",
+    "matin",
+    "soir",
+    "nuit",
+    "dernier",
+    "dernière",
+    "hier",
+    "quand",
+    "il y a",
+    "hace",
+    "día",
+    "días",
+    "semana",
+    "mes",
+    "año",
+    "tarde",
+    "noche",
+    "pasado",
+    "pasada",
+    "cuando",
+    "fecha",
+    "před",
+    "dny",
+    "týden",
+    "měsíc",
+    "rok",
+    "ráno",
+    "večer",
+    "noc",
+    "odpoledne",
+    "minulý",
+    "minulou",
+    "minulé",
+    "kdy",
+]
+
+
+def _alternation(words: List[str]) -> str:
+    # longest first, so "day before yesterday" wins over "yesterday"
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+
+def _words_pattern(words: List[str]) -> "re.Pattern":
+    return re.compile(rf"(?<!\w)(?:{_alternation(words)})(?!\w)", re.IGNORECASE)
+
+
+_MONTH_NUMBERS = {name: i + 1 for i, names in enumerate(MONTHS) for name in names}
+_MONTH = _alternation(list(_MONTH_NUMBERS))
+_ORDINAL = r"(?:st|nd|rd|th|e|er|\.)?"
+_YEAR = r"(?:,?\s+(?:de\s+)?(\d{4}))?"
+
+ISO_DATE = re.compile(r"(?<!\d)(\d{4})-(\d{1,2})-(\d{1,2})(?!\d)")
+NUMERIC_DATE = re.compile(
+    r"(?<![\d.])(\d{1,2})([./-])(\d{1,2})\2(\d{4}|\d{2})(?![\d.])"
+)
+DAY_MONTH = re.compile(
+    rf"(?<!\w)(\d{{1,2}}){_ORDINAL}\s+(?:of\s+|de\s+)?({_MONTH})(?!\w){_YEAR}",
+    re.IGNORECASE,
+)
+MONTH_DAY = re.compile(
+    rf"(?<!\w)({_MONTH})\.?\s+(\d{{1,2}}){_ORDINAL}(?!\w){_YEAR}", re.IGNORECASE
+)
+MONTH_ONLY = _words_pattern(
+    [name for name in _MONTH_NUMBERS if name not in AMBIGUOUS_MONTHS]
+)
+DAYS_AGO_PATTERN = re.compile(
+    r"(?<!\w)(?:" + "|".join(DAYS_AGO) + r")(?!\w)", re.IGNORECASE
+)
+CLOCK_TIME = re.compile(
+    r"(?<![\d:])([01]?\d|2[0-3])[:h]([0-5]\d)(?![\d:])|(?<!\w)(1[0-2]|0?[1-9])\s*(am|pm)(?!\w)",
+    re.IGNORECASE,
+)
+RELATIVE_DAY_PATTERNS = [
+    (offset, _words_pattern(words)) for offset, words in RELATIVE_DAYS.items()
+]
+WEEKDAY_PATTERNS = [
+    (weekday, _words_pattern(names)) for weekday, names in enumerate(WEEKDAYS)
+]
+PERIOD_PATTERNS = [
+    (unit, offset, _words_pattern(phrases))
+    for phrases, unit, offset in RELATIVE_PERIODS
+]
+FUTURE_PATTERN = _words_pattern(FUTURE_WORDS)
+CUE_PATTERN = _words_pattern(DATE_CUES)
+NUMBER_CUE = re.compile(r"(?<!\d)(?:\d{1,4}[./-]\d{1,2}|(?:19|20)\d{2})(?!\d)")
+
+
+@dataclass(frozen=True)
+class DateRange:
+    """The half-open range [start, end) of local time a message refers to."""
+
+    start: datetime
+    end: datetime
+    has_time: bool = False
+
+    @property
+    def is_single_day(self) -> bool:
+        return not self.has_time and self.end - self.start == timedelta(days=1)
+
+    def format(self) -> str:
+        """The start in the reply format of the LLM date extractor."""
+        if self.has_time:
+            return self.start.strftime("%d-%m-%Y %H:%M:%S")
+        return self.start.strftime("%d-%m-%Y")
+
+
+@dataclass(frozen=True)
+class TemporalParse:
+    """Outcome of parse_temporal: "date" with its range, "none" or "unsure"."""
+
+    status: str
+    range: Optional[DateRange] = None
+
+
+def _day(now: datetime, offset: int = 0) -> DateRange:
+    start = datetime(now.year, now.month, now.day) + timedelta(days=offset)
+    return DateRange(start, start + timedelta(days=1))
+
+
+def _calendar_day(year: int, month: int, day: int) -> Optional[DateRange]:
+    try:
+        start = datetime(year, month, day)
+    except ValueError:
+        return None
+    return DateRange(start, start + timedelta(days=1))
+
+
+def _past_day(now: datetime, month: int, day: int, year: Optional[str]):
+    if year is not None:
+        return _calendar_day(int(year), month, day)
+    found = _calendar_day(now.year, month, day)
+    if found is not None and found.start > now:
+        # a day without a year that has not come yet is last year's
+        found = _calendar_day(now.year - 1, month, day)
+    return found
+
+
+def _period(now: datetime, unit: str, offset: int) -> DateRange:
+    today = datetime(now.year, now.month, now.day)
+    if unit == "week":
+        start = today - timedelta(days=today.weekday()) + timedelta(weeks=offset)
+        return DateRange(start, start + timedelta(weeks=1))
+    if unit == "month":
+        month = now.year * 12 + now.month - 1 + offset
+        start = datetime(month // 12, month % 12 + 1, 1)
+        month += 1
+        return DateRange(start, datetime(month // 12, month % 12 + 1, 1))
+    start = datetime(now.year + offset, 1, 1)
+    return DateRange(start, datetime(now.year + offset + 1, 1, 1))
+
+
+def _matches(text: str, now: datetime) -> Tuple[List[Tuple[int, int, object]], bool]:
+    """Spans of the resolved expressions, None for unresolvable ones, and
+    whether the text talks about the future."""
+    found = []
+    for match in ISO_DATE.finditer(text):
+        year, month, day = (int(group) for group in match.groups())
+        found.append((match.start(), match.end(), _calendar_day(year, month, day)))
+    for match in NUMERIC_DATE.finditer(text):
+        day, _, month, year = match.groups()
+        day, month, year = int(day), int(month), int(year)
+        if year < 100:
+            year += 2000
+        if month > 12 and day <= 12:
+            # month-first, as in 03/25/2024
+            day, month = month, day
+        found.append((match.start(), match.end(), _calendar_day(year, month, day)))
+    for match in DAY_MONTH.finditer(text):
+        day, month, year = match.groups()
+        month = _MONTH_NUMBERS[month.lower()]
+        found.append(
+            (match.start(), match.end(), _past_day(now, month, int(day), year))
+        )
+    for match in MONTH_DAY.finditer(text):
+        month, day, year = match.groups()
+        month = _MONTH_NUMBERS[month.lower()]
+        found.append(
+            (match.start(), match.end(), _past_day(now, month, int(day), year))
+        )
+    for match in DAYS_AGO_PATTERN.finditer(text):
+        days = int(next(group for group in match.groups() if group is not None))
+        found.append((match.start(), match.end(), _day(now, -days)))
+    for offset, pattern in RELATIVE_DAY_PATTERNS:
+        for match in pattern.finditer(text):
+            found.append((match.start(), match.end(), _day(now, offset)))
+    for unit, offset, pattern in PERIOD_PATTERNS:
+        for match in pattern.finditer(text):
+            found.append((match.start(), match.end(), _period(now, unit, offset)))
+    future = FUTURE_PATTERN.search(text) is not None
+    for weekday, pattern in WEEKDAY_PATTERNS:
+        for match in pattern.finditer(text):
+            # the last one before today, a week ago when it is today
+            days = (now.weekday() - weekday) % 7 or 7
+            found.append(
+                (match.start(), match.end(), None if future else _day(now, -days))
+            )
+    # an expression inside a longer one ("yesterday" in "day before yesterday")
+    # is part of it
+    found.sort(key=lambda item: (item[0], -(item[1] - item[0])))
+    kept = []
+    for start, end, value in found:
+        if kept and start < kept[-1][1]:
+            continue
+        kept.append((start, end, value))
+    return kept, future
+
+
+def parse_temporal(text: str, now: datetime) -> TemporalParse:
+    """
+    The date range `text` refers to, relative to the user's current time
+    `now`. "none" means the text has no date vocabulary at all, "unsure" that
+    it has some the rules cannot resolve to exactly one range.
+    """
+    if now.tzinfo is not None:
+        # ranges are in the user's local time, like the LLM's answers
+        now = now.replace(tzinfo=None)
+    matches, future = _matches(text, now)
+    ranges = {value for _, _, value in matches}
+    if None in ranges or len(ranges) > 1 or future:
+        return TemporalParse("unsure")
+    if not ranges:
+        cue = (
+            CUE_PATTERN.search(text)
+            or MONTH_ONLY.search(text)
+            or NUMBER_CUE.search(text)
+            or CLOCK_TIME.search(text)
+        )
+        return TemporalParse("unsure" if cue else "none")
+
+    found = ranges.pop()
+    times = []
+    for match in CLOCK_TIME.finditer(text):
+        if any(start <= match.start() < end for start, end, _ in matches):
+            continue
+        hour, minute, short_hour, meridiem = match.groups()
+        if short_hour is not None:
+            hour, minute = int(short_hour) % 12, 0
+            if meridiem.lower() == "pm":
+                hour += 12
+        times.append((int(hour), int(minute)))
+    if len(times) > 1 or (times and not found.is_single_day):
+        return TemporalParse("unsure")
+    if times:
+        hour, minute = times[0]
+        start = found.start.replace(hour=hour, minute=minute)
+        found = DateRange(start, start + timedelta(hours=1), has_time=True)
+    return TemporalParse("date", found)
+
+
+class TemporalStats:
+    """How often the local parser answered instead of the LLM date extractor."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.dates = 0
+        self.no_date = 0
+        self.llm_fallbacks = 0
+
+    def record(self, outcome: str) -> None:
+        with self._lock:
+            if outcome == "date":
+                self.dates += 1
+            elif outcome == "none":
+                self.no_date += 1
+            else:
+                self.llm_fallbacks += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            saved = self.dates + self.no_date
+            total = saved + self.llm_fallbacks
+            return {
+                "messages": total,
+                "local_dates": self.dates,
+                "local_no_date": self.no_date,
+                "llm_fallbacks": self.llm_fallbacks,
+                "saved_calls": saved,
+                "hit_rate": saved / total if total else 0.0,
+            }
+
+
+temporal_stats = TemporalStats()
+
+
+def get_temporal_stats() -> Dict[str, float]:
+    return temporal_stats.stats()
@@ -0,0 +1,243 @@
+"""
+Token counting with cached encoders and memoized counts, fitting of text
+pieces into a token budget without re-tokenizing after every removal, and
+chunking of text on token offsets.
+"""
+import bisect
+import functools
+import json
+import os
+import re
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import tiktoken
+
+import logs
+
+logger = logs.Log("token_accounting", "token_accounting.log").get_logger()
+
+# strings up to this many characters have their counts memoized, longer ones
+# are mostly one-off joins of the pieces that are
+TOKEN_MEMO_MAX_CHARS = int(os.environ.get("TOKEN_MEMO_MAX_CHARS", 8192))
+TOKEN_MEMO_MAX_ENTRIES = int(os.environ.get("TOKEN_MEMO_MAX_ENTRIES", 65536))
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """The encoding of a model, None if tiktoken does not know the model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (KeyError, ValueError):
+        logger.warning(f"Warning: model {model} not found, counting characters.")
+        return None
+
+
+def _count(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+
+_memoized_count = functools.lru_cache(maxsize=TOKEN_MEMO_MAX_ENTRIES)(_count)
+
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    """Number of tokens of `text`, or its length for models tiktoken does not know."""
+    if len(text) <= TOKEN_MEMO_MAX_CHARS:
+        return _memoized_count(text, model)
+    return _count(text, model)
+
+
+@functools.lru_cache(maxsize=1024)
+def _tool_tokens(tool: str, model: str) -> int:
+    function = json.loads(tool)["function"]
+    encoding = get_encoding(model)
+    function_tokens = len(encoding.encode(function["name"]))
+    function_tokens += len(encoding.encode(function["description"]))
+
+    if "parameters" in function:
+        parameters = function["parameters"]
+        if "properties" in parameters:
+            for propertiesKey, v in parameters["properties"].items():
+                function_tokens += len(encoding.encode(propertiesKey))
+                for field in v:
+                    if field == "type":
+                        function_tokens += 2
+                        function_tokens += len(encoding.encode(v["type"]))
+                    elif field == "description":
+                        function_tokens += 2
+                        function_tokens += len(encoding.encode(v["description"]))
+                    elif field == "default":
+                        function_tokens += 2
+                    elif field == "enum":
+                        function_tokens -= 3
+                        for o in v["enum"]:
+                            function_tokens += 3
+                            function_tokens += len(encoding.encode(o))
+                    elif field == "items":
+                        function_tokens += 10
+                    else:
+                        logger.warning(f"Warning: not supported field {field}")
+            function_tokens += 11
+    return function_tokens
+
+
+def count_function_tokens(functions: List[Dict[str, Any]], model: str = "gpt-4") -> int:
+    """Number of tokens the function schemas add to a request, 0 for unknown models."""
+    if get_encoding(model) is None:
+        return 0
+    num_tokens = 0
+    for tool in functions:
+        if tool["type"] == "function":
+            # the same addon schemas come with every message
+            num_tokens += _tool_tokens(json.dumps(tool, sort_keys=True), model)
+    num_tokens += 12  # Account for any additional overhead
+    return num_tokens
+
+
+def fit_pieces(
+    pieces: Sequence[str],
+    budget: int,
+    model: str = "gpt-4",
+    separator: str = "\n",
+    keep_last: bool = False,
+) -> Tuple[int, int]:
+    """
+    Return how many of the first pieces (the last ones with `keep_last`) fit
+    in `budget` tokens when joined with `separator`, and the token count of
+    that join.
+
+    This is the largest number the loops that dropped one piece and counted
+    the whole join again would keep, found with one pass over the memoized
+    counts of the pieces and a couple of counts of the join, which can merge
+    tokens across separators. At least one piece is kept, even if it does
+    not fit.
+    """
+
+    def joined(kept):
+        kept_pieces = pieces[len(pieces) - kept :] if keep_last else pieces[:kept]
+        return count_tokens(separator.join(kept_pieces), model)
+
+    total = joined(len(pieces))
+    if total <= budget or len(pieces) <= 1:
+        return len(pieces), total
+
+    separator_tokens = count_tokens(separator, model)
+    ordered = reversed(pieces) if keep_last else pieces
+    kept, estimate = 0, 0
+    for piece in ordered:
+        cost = count_tokens(piece, model) + (separator_tokens if kept else 0)
+        if estimate + cost > budget:
+            break
+        estimate += cost
+        kept += 1
+
+    kept = max(kept, 1)
+    total = joined(kept)
+    while total > budget and kept > 1:
+        kept -= 1
+        total = joined(kept)
+    while kept + 1 < len(pieces) and total <= budget:
+        more = joined(kept + 1)
+        if more > budget:
+            break
+        kept, total = kept + 1, more
+    return kept, total
+
+
+def fit_lines(text: str, budget: int, model: str = "gpt-4") -> Tuple[str, int]:
+    """
+    The leading lines of `text` that fit in `budget` tokens and their token
+    count. A single line that does not fit loses 100 characters at a time.
+    """
+    lines = text.split("\n")
+    kept, token_count = fit_pieces(lines, budget, model)
+    text = "\n".join(lines[:kept])
+    while token_count > budget and text:
+        text = text[:-100]
+        token_count = count_tokens(text, model)
+    return text, token_count
+
+
+LINE_END = re.compile(r"\n+")
+SENTENCE_END = re.compile(r"[.!?]+(?=\s)")
+
+
+def _token_offsets(text: str, model: str) -> Sequence[int]:
+    """Start offset in `text` of each token, or of each character for models
+    tiktoken does not know."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return range(len(text))
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode_with_offsets(tokens)[1]
+
+
+def _boundaries(pattern: "re.Pattern", text: str, offsets: Sequence[int]) -> List[int]:
+    # index of the first token after each match
+    found = []
+    for match in pattern.finditer(text):
+        index = bisect.bisect_left(offsets, match.end())
+        if 0 < index < len(offsets) and (not found or found[-1] != index):
+            found.append(index)
+    return found
+
+
+def _last_before(boundaries: List[int], low: int, high: int) -> Optional[int]:
+    """The last boundary in (low, high], if any."""
+    index = bisect.bisect_right(boundaries, high) - 1
+    if index >= 0 and boundaries[index] > low:
+        return boundaries[index]
+    return None
+
+
+def iter_chunks(
+    text: str, max_tokens: int = 200, overlap: int = 0, model: str = "gpt-4"
+) -> Iterator[str]:
+    """
+    Yield the chunks of at most `max_tokens` tokens of `text`, in order.
+
+    The text is encoded once and cut on token offsets, at the last line end
+    that fits, else the last sentence end, else after `max_tokens` tokens.
+    Each chunk after the first starts up to `overlap` tokens before the end
+    of the previous one, at a line or sentence start where there is one.
+    Chunks are sliced from the text as they are yielded, so a caller that
+    consumes them one at a time never holds all of them.
+    """
+    offsets = _token_offsets(text, model)
+    count = len(offsets)
+    if count <= max_tokens:
+        yield text
+        return
+    overlap = min(overlap, max_tokens - 1)
+    lines = _boundaries(LINE_END, text, offsets)
+    sentences = _boundaries(SENTENCE_END, text, offsets)
+    starts = sorted(set(lines) | set(sentences))
+
+    def offset(index):
+        return offsets[index] if index < count else len(text)
+
+    start = 0
+    while start < count:
+        end = start + max_tokens
+        if end >= count:
+            end = count
+        else:
+            end = (
+                _last_before(lines, start, end)
+                or _last_before(sentences, start, end)
+                or end
+            )
+        chunk = text[offset(start) : offset(end)]
+        yield chunk.rstrip("\n") if end < count else chunk
+        if end >= count:
+            return
+        next_start = end
+        if overlap:
+            next_start = end - overlap
+            # start the overlap on a line or sentence where there is one
+            index = bisect.bisect_left(starts, next_start)
+            if index < len(starts) and starts[index] < end:
+                next_start = starts[index]
+        start = max(next_start, start + 1)
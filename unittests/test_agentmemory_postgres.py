@@ -0,0 +1,130 @@
+import itertools
+import re
+from contextlib import contextmanager, nullcontext
+import unittest
+from unittest.mock import MagicMock, patch
+
+from agentmemory import postgres
+from agentmemory.helpers import reciprocal_rank_fusion
+
+try:
+    import pglast
+except ImportError:
+    pglast = None
+
+
+class RecordingCursor:
+    description = []
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append((query, params))
+
+    def fetchall(self):
+        return []
+
+
+def numbered(query):
+    # psycopg2 placeholders as the $n parameters the Postgres parser knows
+    counter = itertools.count(1)
+    return re.sub(r"%s", lambda _: f"${next(counter)}", query)
+
+
+class TestHybridQuery(unittest.TestCase):
+    def setUp(self):
+        for name in ("get_pool", "get_schema_cache"):
+            patcher = patch.object(postgres, name, return_value=MagicMock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = postgres.PostgresClient("postgresql://localhost/test")
+        self.client.ensure_table_exists = MagicMock()
+        self.client.create_embedding = MagicMock(return_value=[0.1, 0.2, 0.3])
+        self.cursor = RecordingCursor()
+        self.client.run = lambda category, operation, metadata=None: operation(
+            self.cursor
+        )
+
+    def hybrid_statement(self, **kwargs):
+        results = self.client.hybrid_query(
+            "memories", "coffee in the morning", **kwargs
+        )
+        self.assertEqual(results["scores"], [])
+        query, params = self.cursor.statements[-1]
+        self.assertEqual(query.count("%s"), len(params))
+        return query
+
+    def test_placeholders_match_params(self):
+        self.hybrid_statement()
+        self.hybrid_statement(
+            where={"chat_id": "c1"}, where_document={"$contains": "coffee"}
+        )
+
+    @unittest.skipIf(pglast is None, "pglast is not installed")
+    def test_statement_parses(self):
+        for kwargs in (
+            {},
+            {"where": {"chat_id": "c1"}, "where_document": {"$contains": "coffee"}},
+        ):
+            pglast.parse_sql(numbered(self.hybrid_statement(**kwargs)))
+
+
+class TestReciprocalRankFusion(unittest.TestCase):
+    def test_fusion(self):
+        fused = reciprocal_rank_fusion([["a", "b"], ["b", "c"]], k=60)
+        self.assertEqual([id for id, _ in fused], ["b", "a", "c"])
+        self.assertAlmostEqual(dict(fused)["b"], 1 / 62 + 1 / 61)
+        self.assertAlmostEqual(dict(fused)["c"], 1 / 62)
+
+    def test_empty(self):
+        self.assertEqual(reciprocal_rank_fusion([]), [])
+        self.assertEqual(reciprocal_rank_fusion([[], ["a"]], k=0), [("a", 1.0)])
+
+
+class SchemaCursor(RecordingCursor):
+    def fetchall(self):
+        return [("memory_memories", "id"), ("memory_memories", "metadata")]
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        self.reloads = 0
+
+        @contextmanager
+        def cursor():
+            self.reloads += 1
+            yield SchemaCursor()
+
+        self.schema = postgres.SchemaCache(cursor)
+
+    def test_reloads_after_invalidate(self):
+        self.schema.load(SchemaCursor())
+        self.schema.invalidate()
+        self.assertTrue(self.schema.has_table("memory_memories"))
+        self.assertTrue(self.schema.has_column("memory_memories", "metadata"))
+        self.assertEqual(
+            self.schema.missing_columns("memory_memories", ["id", "uid"]), ["uid"]
+        )
+        self.assertEqual(self.reloads, 1)
+
+    def test_invalidated_between_load_and_lookup(self):
+        with patch.object(postgres, "get_pool"), patch.object(
+            postgres, "get_schema_cache", return_value=self.schema
+        ):
+            client = postgres.PostgresClient("postgresql://localhost/test")
+        load_schema = client._load_schema
+
+        def load_then_invalidate():
+            load_schema()
+            # another thread's statement hit a dropped table
+            self.schema.invalidate()
+
+        client._load_schema = load_then_invalidate
+        client.cursor = lambda: nullcontext(SchemaCursor())
+        self.assertEqual(client._layout("memories"), "jsonb")
+        self.assertEqual(self.reloads, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
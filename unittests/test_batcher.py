@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from agentmemory import batcher
+from agentmemory.batcher import BatcherStopped, EmbeddingBatcher
+
+
+class TestEmbeddingBatcher(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def embed(texts, model_path, model_name=None):
+            self.release.wait(5)
+            self.batches.append(list(texts))
+            return np.array([[float(text)] for text in texts])
+
+        patcher = patch.object(batcher, "cached_embeddings", side_effect=embed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batcher = EmbeddingBatcher(max_batch_size=4, max_wait_ms=20)
+        self.addAsyncCleanup(self.batcher.stop)
+
+    def texts(self, start, count):
+        return [str(n) for n in range(start, start + count)]
+
+    async def test_batches_stay_within_max_size(self):
+        results = await asyncio.gather(
+            self.batcher.embed(self.texts(0, 3), "model"),
+            self.batcher.embed(self.texts(3, 3), "model"),
+            self.batcher.embed(self.texts(6, 1), "model"),
+        )
+        self.assertEqual([len(batch) for batch in self.batches], [3, 4])
+        self.assertEqual(results[1].ravel().tolist(), [3.0, 4.0, 5.0])
+
+    async def test_large_request_is_split(self):
+        result = await self.batcher.embed(self.texts(0, 10), "model")
+        self.assertEqual(result.ravel().tolist(), [float(n) for n in range(10)])
+        self.assertTrue(all(len(batch) <= 4 for batch in self.batches))
+
+    async def test_stop_fails_waiting_requests(self):
+        self.release.clear()
+        first = asyncio.ensure_future(self.batcher.embed(["1"], "model"))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(self.batcher.embed(["2"], "model"))
+        await asyncio.sleep(0)
+        await self.batcher.stop()
+        self.release.set()
+        for request in (first, second):
+            with self.assertRaises(BatcherStopped):
+                await request
+
+    async def test_embed_after_stop(self):
+        await self.batcher.embed(["1"], "model")
+        await self.batcher.stop()
+        result = await self.batcher.embed(["2", "3"], "model")
+        self.assertEqual(result.ravel().tolist(), [2.0, 3.0])
+        self.assertTrue(self.batcher.running)
+
+    async def test_threads_fall_back_on_stop(self):
+        self.batcher.start()
+        self.release.clear()
+        result = asyncio.ensure_future(
+            asyncio.to_thread(self.batcher.embed_threadsafe, ["7"], "model")
+        )
+        await asyncio.sleep(0.05)
+        await self.batcher.stop()
+        self.release.set()
+        embedding = await asyncio.wait_for(result, 5)
+        self.assertEqual(embedding.ravel().tolist(), [7.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
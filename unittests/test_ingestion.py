@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from ingestion import WAL_FILENAME, IngestionQueue, WriteAheadLog
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def test_pending(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = WriteAheadLog(os.path.join(directory, "u", WAL_FILENAME), fsync=False)
+            for seq in (1, 2, 3):
+                log.append(seq, {"n": seq})
+            log.mark_done(1)
+            with open(log.path, "a") as f:
+                f.write('{"seq": 4, "wri')
+            self.assertEqual([r["write"]["n"] for r in log.pending()], [2, 3])
+            log.mark_done(3)
+            self.assertEqual(log.pending(), [])
+            self.assertEqual(os.path.getsize(log.path), 0)
+
+
+class TestIngestionQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.applied = []
+        self.failing = 0
+
+    async def apply(self, username, writes):
+        await asyncio.sleep(0.01)
+        if self.failing:
+            self.failing -= 1
+            raise RuntimeError("store failed")
+        self.applied.append((username, [write["n"] for write in writes]))
+
+    def queue(self, **kwargs):
+        queue = IngestionQueue(self.apply, users_dir=self.directory.name, **kwargs)
+        self.addAsyncCleanup(queue.stop)
+        return queue
+
+    async def test_order_and_flush(self):
+        queue = self.queue(workers=2)
+        for n in range(5):
+            await queue.enqueue("a", {"n": n})
+            await queue.enqueue("b", {"n": n})
+        await queue.flush("a")
+        self.assertEqual(
+            [n for user, ns in self.applied if user == "a" for n in ns], list(range(5))
+        )
+        await queue.flush()
+        self.assertEqual(
+            [n for user, ns in self.applied if user == "b" for n in ns], list(range(5))
+        )
+        # writes queued while a batch is stored go in one batch
+        self.assertLess(len(self.applied), 10)
+        self.assertEqual(queue.stats()["depth"], 0)
+        self.assertEqual(queue.stats()["applied"], 10)
+
+    async def test_recover(self):
+        log = WriteAheadLog(
+            os.path.join(self.directory.name, "a", WAL_FILENAME), fsync=False
+        )
+        log.append(1, {"n": 1})
+        log.append(2, {"n": 2})
+        log.mark_done(1)
+        queue = self.queue()
+        self.assertEqual(await queue.recover(), 1)
+        await queue.flush()
+        await queue.enqueue("a", {"n": 3})
+        await queue.flush()
+        self.assertEqual([n for _, ns in self.applied for n in ns], [2, 3])
+
+    async def test_retry_and_drop(self):
+        queue = self.queue(max_attempts=2)
+        self.failing = 1
+        await queue.enqueue("a", {"n": 1})
+        await queue.flush()
+        self.assertEqual(self.applied, [("a", [1])])
+        self.failing = 2
+        await queue.enqueue("a", {"n": 2})
+        await queue.flush()
+        stats = queue.stats()
+        self.assertEqual((stats["failures"], stats["dropped"]), (3, 1))
+        self.assertEqual(queue._log("a").pending(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import unittest
+
+from llm_clients import LLMClientPool
+
+
+class TestLLMClientPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = LLMClientPool(http2=False)
+        self.addAsyncCleanup(self.pool.close)
+
+    async def test_reuses_clients(self):
+        openai = self.pool.get("openai", "key-1")
+        self.assertIs(self.pool.get("openai", "key-1"), openai)
+        self.assertIsNot(self.pool.get("openai", "key-2"), openai)
+        self.assertIsNot(self.pool.get("openai", "key-1", "http://localhost"), openai)
+        anthropic = self.pool.get("anthropic", "key-1")
+        # every client sends through the same connection pool
+        self.assertIs(openai._client, anthropic._client)
+        self.assertEqual(self.pool.stats()["clients"], 4)
+        self.assertEqual(self.pool.stats()["hits"], 1)
+        with self.assertRaises(ValueError):
+            self.pool.get("other", "key-1")
+
+    async def test_close(self):
+        client = self.pool.get("openai", "key-1")
+        http_client = client._client
+        await self.pool.close()
+        self.assertTrue(http_client.is_closed)
+        self.assertIsNot(self.pool.get("openai", "key-1"), client)
+
+    async def test_new_loop(self):
+        client = self.pool.get("openai", "key-1")
+
+        async def get():
+            return self.pool.get("openai", "key-1")
+
+        # a client of another loop can not use this loop's connections
+        other = await asyncio.to_thread(asyncio.run, get())
+        self.assertIsNot(other, client)
+        # the finished loop's clients are dropped on the next get
+        self.assertIs(self.pool.get("openai", "key-1"), client)
+        self.assertEqual(self.pool.stats()["loops"], 1)
+
+    async def test_alternating_loops_keep_their_clients(self):
+        other_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=other_loop.run_forever)
+        thread.start()
+
+        async def get():
+            return self.pool.get("openai", "key-1")
+
+        def get_on_other_loop():
+            return asyncio.run_coroutine_threadsafe(get(), other_loop).result(5)
+
+        try:
+            client = self.pool.get("openai", "key-1")
+            other = get_on_other_loop()
+            self.assertIsNot(other, client)
+            for _ in range(3):
+                self.assertIs(self.pool.get("openai", "key-1"), client)
+                self.assertIs(get_on_other_loop(), other)
+            self.assertEqual(self.pool.stats()["misses"], 2)
+            await self.pool.close()
+            self.assertTrue(client._client.is_closed)
+            # the other loop's client is closed on that loop
+            for _ in range(50):
+                if other._client.is_closed:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertTrue(other._client.is_closed)
+        finally:
+            other_loop.call_soon_threadsafe(other_loop.stop)
+            thread.join()
+            other_loop.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
+import threading
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import memory
 from memory import MemoryManager
 
 
@@ -306,3 +309,73 @@ class TestMemoryManager(unittest.TestCase):
             0.1,
             username="test_user",
         )
+
+
+class TestStoreQueuedMemories(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.inserts = []
+
+        def create_memories(category, documents, metadatas, **kwargs):
+            self.inserts.append((category, list(documents), threading.get_ident()))
+            for metadata in metadatas:
+                metadata["username"] = kwargs["mUsername"]
+            return [f"{category}-{i}" for i in range(len(documents))]
+
+        patches = [
+            patch.object(memory, "create_memories", side_effect=create_memories),
+            patch.object(
+                memory,
+                "embedding_function",
+                side_effect=lambda texts: [[0.0] for _ in texts],
+            ),
+            patch.object(
+                MemoryManager, "infer", AsyncMock(return_value="Hobbies\nFood")
+            ),
+            patch.object(memory.utils.SettingsManager, "load_settings", AsyncMock()),
+            patch.object(memory, "recent_message_cache"),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_stores_off_the_loop_and_categorises(self):
+        writes = [
+            {
+                "category": "active_brain",
+                "documents": ["hello"],
+                "metadatas": [{"chat_id": "c1"}],
+                "mUsername": "assistant",
+            },
+            {
+                "category": None,
+                "documents": ["I like pizza"],
+                "metadatas": [{"uid": "x"}],
+                "mUsername": "user",
+                "categorise": "I like pizza",
+            },
+        ]
+        await memory.store_queued_memories("u", writes)
+        self.assertEqual(
+            [(category, documents) for category, documents, _ in self.inserts],
+            [
+                ("active_brain", ["hello"]),
+                ("hobbies", ["I like pizza"]),
+                ("food", ["I like pizza"]),
+            ],
+        )
+        loop_thread = threading.get_ident()
+        self.assertTrue(all(thread != loop_thread for *_, thread in self.inserts))
+        memory.recent_message_cache.append.assert_called_once_with(
+            "u",
+            "c1",
+            [
+                {
+                    "id": "active_brain-0",
+                    "document": "hello",
+                    "metadata": {"chat_id": "c1", "username": "assistant"},
+                }
+            ],
+        )
+        # a retried batch keeps its categories
+        await memory.store_queued_memories("u", writes)
+        MemoryManager.infer.assert_awaited_once()
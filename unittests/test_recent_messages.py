@@ -0,0 +1,38 @@
+import unittest
+
+from recent_messages import RecentMessageCache
+
+
+def message(id, document, chat_id="a"):
+    return {"id": id, "document": document, "metadata": {"chat_id": chat_id}}
+
+
+class TestRecentMessageCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = RecentMessageCache(count_tokens=len)
+
+    def test_writes_to_other_chats_keep_the_fill(self):
+        generation = self.cache.generation("u", "a")
+        self.cache.append("u", "b", [message("1", "hi", "b")])
+        self.cache.append("v", "a", [message("2", "hi")])
+        self.cache.fill("u", "a", [message("3", "hello")], generation)
+        self.assertEqual([m["id"] for m in self.cache.get("u", "a")], ["3"])
+
+    def test_write_to_the_chat_drops_the_fill(self):
+        generation = self.cache.generation("u", "a")
+        self.cache.append("u", "a", [message("1", "hi")])
+        filled = self.cache.fill("u", "a", [message("0", "old")], generation)
+        self.assertEqual(filled[0]["tokens"], len("None: old"))
+        self.assertIsNone(self.cache.get("u", "a"))
+
+    def test_invalidating_a_user_drops_fills_of_all_chats(self):
+        self.cache.append("u", "a", [message("1", "hi")])
+        generation = self.cache.generation("u", "a")
+        self.cache.invalidate("u")
+        self.cache.append("u", "a", [message("2", "hi")])
+        self.cache.fill("u", "a", [message("1", "hi")], generation)
+        self.assertIsNone(self.cache.get("u", "a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from agentmemory.registry import ChromaClientRegistry
+
+
+class TestChromaClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.opening = {}
+
+        def factory(username):
+            if username in self.opening:
+                self.opening[username].wait(5)
+            return MagicMock(name=username)
+
+        self.registry = ChromaClientRegistry(factory, idle_ttl=0.05, min_idle=0)
+
+    def test_idle_clients_are_evicted_without_a_new_open(self):
+        client = self.registry.get_client("a")
+        time.sleep(0.1)
+        self.registry.evict_idle()
+        self.assertEqual(self.registry.stats()["open_clients"], 0)
+        client._system.stop.assert_called_once()
+
+    def test_run_eviction(self):
+        client = self.registry.get_client("a")
+
+        async def run():
+            task = asyncio.create_task(self.registry.run_eviction(interval=0.02))
+            await asyncio.sleep(0.2)
+            task.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(self.registry.stats()["evictions"], 1)
+        client._system.stop.assert_called_once()
+
+    def test_slow_open_does_not_block_other_users(self):
+        self.registry.idle_ttl = 60
+        self.registry.get_client("b")
+        self.opening["a"] = threading.Event()
+        opening = threading.Thread(target=self.registry.get_client, args=("a",))
+        opening.start()
+        try:
+            time.sleep(0.05)
+            started = time.monotonic()
+            self.registry.get_or_create_collection("b", "memories")
+            self.registry.get_text_index("b", "memories", MagicMock())
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            self.opening["a"].set()
+            opening.join()
+        self.assertEqual(self.registry.stats()["open_clients"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
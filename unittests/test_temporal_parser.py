@@ -0,0 +1,84 @@
+import unittest
+from datetime import datetime
+from temporal_parser import TemporalStats, parse_temporal
+
+# a Wednesday
+NOW = datetime(2024, 3, 13, 15, 30)
+
+
+class TestParseTemporal(unittest.TestCase):
+    def assertDate(self, text, expected):
+        result = parse_temporal(text, NOW)
+        self.assertEqual(result.status, "date", text)
+        self.assertEqual(result.range.format(), expected, text)
+
+    def assertStatus(self, text, status):
+        self.assertEqual(parse_temporal(text, NOW).status, status, text)
+
+    def test_no_date(self):
+        self.assertStatus("What is the capital of France?", "none")
+        self.assertStatus("Kun je me helpen met Python?", "none")
+
+    def test_relative_days(self):
+        self.assertDate("What did we talk about yesterday?", "12-03-2024")
+        self.assertDate("Was haben wir gestern besprochen?", "12-03-2024")
+        self.assertDate("the day before yesterday", "11-03-2024")
+        self.assertDate("¿Qué dije anteayer?", "11-03-2024")
+        self.assertDate("Co jsem říkal včera?", "12-03-2024")
+        self.assertDate("what did I eat today", "13-03-2024")
+
+    def test_days_ago(self):
+        self.assertDate("3 days ago", "10-03-2024")
+        self.assertDate("wat zei ik 2 dagen geleden", "11-03-2024")
+        self.assertDate("il y a 5 jours", "08-03-2024")
+
+    def test_weekdays(self):
+        self.assertDate("What did I say last Monday?", "11-03-2024")
+        self.assertDate("on Wednesday", "06-03-2024")
+        self.assertStatus("what are we doing next Friday?", "unsure")
+
+    def test_absolute_dates(self):
+        self.assertDate("on 2024-03-05", "05-03-2024")
+        self.assertDate("on 05/03/2024", "05-03-2024")
+        self.assertDate("on 03/25/2023", "25-03-2023")
+        self.assertDate("on 5 March", "05-03-2024")
+        self.assertDate("am 5. Februar 2023", "05-02-2023")
+        self.assertDate("on December 24th", "24-12-2023")
+
+    def test_times(self):
+        self.assertDate("yesterday at 14:00", "12-03-2024 14:00:00")
+        self.assertDate("yesterday around 3pm", "12-03-2024 15:00:00")
+        self.assertStatus("at 14:00", "unsure")
+
+    def test_ranges(self):
+        result = parse_temporal("what did we do last week?", NOW)
+        self.assertEqual(result.status, "date")
+        self.assertEqual(result.range.start, datetime(2024, 3, 4))
+        self.assertEqual(result.range.end, datetime(2024, 3, 11))
+        self.assertFalse(result.range.is_single_day)
+        result = parse_temporal("last month", NOW)
+        self.assertEqual(result.range.start, datetime(2024, 2, 1))
+        self.assertEqual(result.range.end, datetime(2024, 3, 1))
+
+    def test_unsure(self):
+        self.assertStatus("what did we discuss back then?", "unsure")
+        self.assertStatus("yesterday or 3 days ago", "unsure")
+        self.assertStatus("what happened in 2019", "unsure")
+        self.assertStatus("tomorrow", "unsure")
+
+
+class TestTemporalStats(unittest.TestCase):
+    def test_hit_rate(self):
+        stats = TemporalStats()
+        stats.record("date")
+        stats.record("none")
+        stats.record("none")
+        stats.record("unsure")
+        result = stats.stats()
+        self.assertEqual(result["saved_calls"], 3)
+        self.assertEqual(result["llm_fallbacks"], 1)
+        self.assertEqual(result["hit_rate"], 0.75)
+
+
+if __name__ == "__main__":
+    unittest.main()
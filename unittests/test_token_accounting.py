@@ -0,0 +1,164 @@
+import random
+import re
+import unittest
+from unittest.mock import patch
+
+import token_accounting
+from token_accounting import (
+    count_function_tokens,
+    count_tokens,
+    fit_lines,
+    fit_pieces,
+    iter_chunks,
+)
+
+MODEL = "test-model"
+
+
+class FakeEncoding:
+    """Words and symbols with their leading space, and runs of newlines, which
+    merge across pieces."""
+
+    def encode(self, text, **kwargs):
+        # tokens are their start offsets
+        return [
+            match.start() for match in re.finditer(r" ?\w+| ?[^\w\s]|\n+|\s+", text)
+        ]
+
+    def decode_with_offsets(self, tokens):
+        return None, list(tokens)
+
+
+def naive_fit_lines(text, budget):
+    # the loop fit_lines replaces
+    token_count = count_tokens(text, MODEL)
+    while token_count > budget:
+        lines = text.split("\n")
+        if len(lines) > 1:
+            lines.pop(-1)
+            text = "\n".join(lines)
+        else:
+            text = text[:-100]
+        token_count = count_tokens(text, MODEL)
+    return text, token_count
+
+
+def history(lines, seed=0):
+    words = ["memory", "note", "today", "coffee", "python", "x", "a.b", "!"]
+    rng = random.Random(seed)
+    return "\n".join(
+        " ".join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+        for _ in range(lines)
+    )
+
+
+class TestTokenAccounting(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(
+            token_accounting, "get_encoding", return_value=FakeEncoding()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        token_accounting._memoized_count.cache_clear()
+        token_accounting._tool_tokens.cache_clear()
+
+    def test_count_tokens(self):
+        self.assertEqual(count_tokens("hello world!", MODEL), 3)
+        self.assertEqual(count_tokens("a\n\nb", MODEL), 3)
+
+    def test_fit_lines_matches_loop(self):
+        for seed in range(20):
+            text = history(60, seed) + ("\n" if seed % 2 else "")
+            for budget in (0, 1, 5, 50, 200, 10000):
+                self.assertEqual(
+                    fit_lines(text, budget, MODEL), naive_fit_lines(text, budget)
+                )
+
+    def test_fit_lines_shortens_a_single_line(self):
+        text = "word " * 100
+        fitted, token_count = fit_lines(text, 10, MODEL)
+        self.assertEqual((fitted, token_count), naive_fit_lines(text, 10))
+        self.assertEqual(fit_lines(text, -1, MODEL), ("", 0))
+
+    def test_fit_pieces(self):
+        pieces = ["a b", "c d e", "f", "g h i j"]
+        self.assertEqual(fit_pieces(pieces, 6, MODEL, keep_last=True), (2, 6))
+        self.assertEqual(fit_pieces(pieces, 6, MODEL), (2, 6))
+        self.assertEqual(fit_pieces(pieces, 100, MODEL), (4, 13))
+        self.assertEqual(fit_pieces(pieces, 0, MODEL), (1, 2))
+
+    def test_function_tokens(self):
+        tool = {
+            "type": "function",
+            "function": {
+                "name": "search",
+                "description": "search the web",
+                "parameters": {
+                    "properties": {
+                        "query": {"type": "string", "description": "the query"}
+                    }
+                },
+            },
+        }
+        # 1 + 3 + 1 + (2 + 1) + (2 + 2) + 11, plus 12 overhead
+        self.assertEqual(count_function_tokens([tool], MODEL), 35)
+        self.assertEqual(count_function_tokens([tool, tool], MODEL), 35 + 23)
+
+    def test_iter_chunks(self):
+        text = "One two three. Four five six.\nSeven eight nine ten eleven"
+        self.assertEqual(list(iter_chunks(text, 100, model=MODEL)), [text])
+        self.assertEqual(
+            list(iter_chunks(text, 10, model=MODEL)),
+            ["One two three. Four five six.", "Seven eight nine ten eleven"],
+        )
+        self.assertEqual(
+            list(iter_chunks(text, 5, model=MODEL)),
+            ["One two three.", " Four five six.", "Seven eight nine ten eleven"],
+        )
+        self.assertEqual(
+            list(iter_chunks("a b c d e f g", 3, model=MODEL)),
+            ["a b c", " d e f", " g"],
+        )
+
+    def test_iter_chunks_overlap(self):
+        text = "One two. Three four. Five six. Seven eight."
+        chunks = list(iter_chunks(text, 6, overlap=3, model=MODEL))
+        self.assertEqual(
+            chunks,
+            [
+                "One two. Three four.",
+                " Three four. Five six.",
+                " Five six. Seven eight.",
+            ],
+        )
+        for chunk in iter_chunks(history(300), 50, overlap=10, model=MODEL):
+            self.assertLessEqual(count_tokens(chunk, MODEL), 50)
+
+    def test_iter_chunks_covers_text(self):
+        text = history(300)
+        chunks = list(iter_chunks(text, 40, model=MODEL))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("\n".join(chunks).replace("\n", ""), text.replace("\n", ""))
+
+    def test_long_history(self):
+        text = history(800)
+        expected = naive_fit_lines(text, 500)
+        with patch.object(
+            token_accounting, "count_tokens", wraps=token_accounting.count_tokens
+        ) as count:
+            self.assertEqual(fit_lines(text, 500, MODEL), expected)
+        # the loop counted the join again for each of the hundreds of dropped
+        # lines, fit_lines only a few times to correct the per-line estimate
+        joins = [call for call in count.call_args_list if "\n" in call.args[0]]
+        self.assertLessEqual(len(joins), 10)
+
+    def test_benchmark_matches_the_loops(self):
+        from agentmemory.benchmark import run_tokens
+
+        results = run_tokens(lines=(10, 200), budget=300, model=MODEL, repeats=1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result["same"] for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
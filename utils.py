@@ -1,6 +1,6 @@
 import asyncio
 import base64
-import importlib
+import copy
 import inspect
 import json
 import ast
@@ -21,13 +21,15 @@ from pathlib import Path
 from chat_tabs.dao import ChatTabsDAO
 from config import api_keys, default_params, fakedata, USERS_DIR
 from database import Database
-import tiktoken
 from pydub import audio_segment
 import logs
 import prompts
 from unidecode import unidecode
 import llmcalls
 from simple_utils import get_root
+from recent_messages import history_line
+from settings_cache import addon_registry, file_stamp, settings_cache
+from token_accounting import count_function_tokens, count_tokens
 from user_management.dao import UsersDAO
 from typing import List, Dict, Any
 from datetime import datetime
@@ -41,6 +43,10 @@ logger = logs.Log("utils", "utils.log").get_logger()
 max_responses = 1
 COT_RETRIES = {}
 stopPressed = {}
+# seconds the memory retrieval stages of a message may take before the reply
+# is generated without the ones still running
+RETRIEVAL_DEADLINE = float(os.environ.get("RETRIEVAL_DEADLINE", 30))
+background_tasks = set()
 
 MODEL_COSTS = {
     "gpt-4o": {
@@ -250,7 +256,19 @@ class AddonManager:
     """This class contains functions to load addons"""
 
     @staticmethod
-    async def load_addons(username, users_dir):
+    def load_user_settings(username, users_dir):
+        """
+        Return the user's settings.json with missing or mistyped keys set to
+        their defaults and the installed addons listed, writing it back if
+        that changed it. Cached until the file or the addons directory changes.
+        """
+        user_path = os.path.join(users_dir, username)
+        settings_file = os.path.join(user_path, "settings.json")
+        stamp = (file_stamp(settings_file), addon_registry.directory_stamp())
+        settings = settings_cache.get(users_dir, username, stamp)
+        if settings is not None:
+            return settings
+
         anthropic_api_key = api_keys.get("anthropic")
         openai_api_key = api_keys.get("openai")
         if anthropic_api_key:
@@ -285,18 +303,11 @@ class AddonManager:
 
         data_username = convert_username(username)
 
-        function_dict = {}
-        function_metadata = []
-        module_timestamps = {}
-
         data_dir = os.path.join(users_dir, data_username, "data")
         # create the users directory if it doesn't exist
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
 
-        user_path = os.path.join(users_dir, username)
-        settings_file = os.path.join(user_path, "settings.json")
-
         if not os.path.exists(user_path):
             os.makedirs(user_path)
 
@@ -305,14 +316,14 @@ class AddonManager:
                 json.dump(default_settings, f)
 
         # Check if settings file exists and is not empty
+        saved = None
         if os.path.exists(settings_file) and os.path.getsize(settings_file) > 0:
             try:
                 with open(settings_file, "r") as f:
-                    settings = json.load(f)
+                    saved = json.load(f)
             except json.JSONDecodeError:
-                settings = default_settings
-        else:
-            settings = default_settings
+                pass
+        settings = copy.deepcopy(saved) if saved is not None else default_settings
 
         # Validate and correct the settings
         for key, default_value in default_settings.items():
@@ -327,68 +338,56 @@ class AddonManager:
                     ) != type(sub_default_value):
                         settings[key][sub_key] = sub_default_value
 
-        # Save the settings
-        with open(settings_file, "w") as f:
-            json.dump(settings, f)
-
-        # Delete addons that don't exist anymore
+        # Delete addons that don't exist anymore, list new ones as disabled
+        addon_names = addon_registry.addon_names()
         for addon in list(settings["addons"].keys()):
-            if not os.path.exists(os.path.join("addons", f"{addon}.py")):
+            if addon not in addon_names:
                 del settings["addons"][addon]
+        for addon_name in addon_names:
+            if addon_name not in settings["addons"]:
+                settings["addons"][addon_name] = False
 
-        # Load addons
-        for filename in os.listdir("addons"):
-            if filename.endswith(".py"):
-                addon_name = filename[:-3]
-                if addon_name not in settings["addons"]:
-                    settings["addons"][addon_name] = False
-
-                # Only load the addon if it is enabled
-                if settings["addons"].get(addon_name, True):
-                    file_path = os.path.join("addons", filename)
-                    spec = importlib.util.spec_from_file_location(
-                        filename[:-3], file_path
-                    )
-                    module = importlib.util.module_from_spec(spec)
-
-                    # Check if the module has been modified since it was last imported
-                    file_timestamp = os.path.getmtime(file_path)
-                    if (
-                        filename in module_timestamps
-                        and file_timestamp > module_timestamps[filename]
-                    ):
-                        module = importlib.reload(module)
-                    module_timestamps[filename] = file_timestamp
-
-                    spec.loader.exec_module(module)
-
-                    # Check for the function in the module and add it with the required structure
-                    if module.__name__ in module.__dict__:
-                        function_detail = {
-                            "name": module.__name__,
-                            "description": getattr(
-                                module, "description", "No description"
-                            ),
-                            "parameters": getattr(
-                                module, "parameters", "No parameters"
-                            ),
-                        }
-                        # Wrap the function detail in the required structure
-                        tool_metadata = {
-                            "type": "function",
-                            "function": function_detail,
-                        }
-                        function_metadata.append(tool_metadata)
-                    else:
-                        await MessageSender.send_debug(
-                            f"Module {module.__name__} does not have a function with the same name.",
-                            2,
-                            "red",
-                            username,
-                        )
+        # Save the settings
+        if settings != saved:
+            with open(settings_file, "w") as f:
+                json.dump(settings, f)
+            stamp = (file_stamp(settings_file), stamp[1])
+
+        settings_cache.set(users_dir, username, stamp, settings)
+        return settings
 
-        with open(settings_file, "w") as f:
-            json.dump(settings, f)
+    @staticmethod
+    async def load_addons(username, users_dir):
+        settings = AddonManager.load_user_settings(username, users_dir)
+
+        function_dict = {}
+        function_metadata = []
+
+        for addon_name in addon_registry.addon_names():
+            # Only load the addon if it is enabled
+            if settings["addons"].get(addon_name, True):
+                module = addon_registry.get(addon_name)
+
+                # Check for the function in the module and add it with the required structure
+                if module.__name__ in module.__dict__:
+                    function_detail = {
+                        "name": module.__name__,
+                        "description": getattr(module, "description", "No description"),
+                        "parameters": getattr(module, "parameters", "No parameters"),
+                    }
+                    # Wrap the function detail in the required structure
+                    tool_metadata = {
+                        "type": "function",
+                        "function": function_detail,
+                    }
+                    function_metadata.append(tool_metadata)
+                else:
+                    await MessageSender.send_debug(
+                        f"Module {module.__name__} does not have a function with the same name.",
+                        2,
+                        "red",
+                        username,
+                    )
 
         if not function_metadata:
             function_metadata = fakedata
@@ -479,6 +478,7 @@ class BrainProcessor:
     @staticmethod
     async def delete_recent_messages(user):
         print(f"Deleting recent messages for {user}")
+        _memory.recent_message_cache.invalidate(user)
 
 
 class MessageParser:
@@ -524,11 +524,7 @@ class MessageParser:
         username: str, chat_id: str, regenerator: bool = False, uuid: str = None
     ) -> List[Dict[str, Any]]:
         memory = _memory.MemoryManager()
-        settings = await SettingsManager.load_settings("users", username)
-        memory.model_used = settings["active_model"]["active_model"]
-        recent_messages = await memory.get_most_recent_messages(
-            "active_brain", username, chat_id=chat_id
-        )
+        recent_messages = await memory.get_cached_recent_messages(username, chat_id)
 
         if regenerator and uuid:
             # Initialize a new list to hold the filtered messages
@@ -550,6 +546,7 @@ class MessageParser:
                 "document": message["document"],
                 "metadata": message["metadata"],
                 "id": message["id"],
+                "tokens": message["tokens"],
             }
             for message in recent_messages
         ]
@@ -866,64 +863,12 @@ class MessageParser:
     @staticmethod
     def num_tokens_from_string(string, model="gpt-4"):
         """Returns the number of tokens in a text string."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except (KeyError, ValueError):
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            # encoding = tiktoken.get_encoding("cl100k_base")
-            return len(string)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        return count_tokens(string, model)
 
     @staticmethod
     def num_tokens_from_functions(functions, model="gpt-4"):
         """Return the number of tokens used by a list of functions."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except (KeyError, ValueError):
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            return 0
-
-        num_tokens = 0
-        for tool in functions:  # Iterate over the tools
-            if tool["type"] == "function":  # Ensure it's a function type
-                function = tool["function"]  # Extract the function details
-                function_tokens = len(encoding.encode(function["name"]))
-                function_tokens += len(encoding.encode(function["description"]))
-
-                if "parameters" in function:
-                    parameters = function["parameters"]
-                    if "properties" in parameters:
-                        for propertiesKey, v in parameters["properties"].items():
-                            function_tokens += len(encoding.encode(propertiesKey))
-                            for field in v:
-                                if field == "type":
-                                    function_tokens += 2
-                                    function_tokens += len(encoding.encode(v["type"]))
-                                elif field == "description":
-                                    function_tokens += 2
-                                    function_tokens += len(
-                                        encoding.encode(v["description"])
-                                    )
-                                elif field == "default":
-                                    function_tokens += 2
-                                elif field == "enum":
-                                    function_tokens -= 3
-                                    for o in v["enum"]:
-                                        function_tokens += 3
-                                        function_tokens += len(encoding.encode(o))
-                                elif field == "items":
-                                    function_tokens += 10
-                                else:
-                                    logger.warning(
-                                        f"Warning: not supported field {field}"
-                                    )
-                        function_tokens += 11
-
-                num_tokens += function_tokens
-
-        num_tokens += 12  # Account for any additional overhead
-        return num_tokens
+        return count_function_tokens(functions, model)
 
     async def generate_full_message(username, merged_result_string, instruction_string):
         full_message = MessageParser.get_message(
@@ -959,26 +904,7 @@ class SettingsManager:
 
     @staticmethod
     async def load_settings(users_dir, username):
-        settings = {}
-        settings_dir = os.path.join(users_dir, username)
-        settings_file = os.path.join(settings_dir, "settings.json")
-
-        # Make sure the directory exists
-        if not os.path.exists(settings_dir):
-            os.makedirs(settings_dir)
-
-        # Make sure the settings file exists
-        if not os.path.exists(settings_file):
-            with open(settings_file, "w") as f:
-                # Write default settings to the file
-                json.dump({}, f)
-
-        # Load addons
-        await AddonManager.load_addons(username, users_dir)
-
-        # Load settings
-        with open(settings_file, "r") as f:
-            settings = json.load(f)
+        settings = AddonManager.load_user_settings(username, users_dir)
 
         # Update memory settings to the new format if needed
         if "memory" in settings:
@@ -1012,6 +938,11 @@ class SettingsManager:
 
         return settings
 
+    @staticmethod
+    def invalidate_settings(username=None):
+        """Forget the cached settings after settings.json was written."""
+        settings_cache.invalidate(username)
+
     @staticmethod
     async def get_current_date_time(username):
         settings = await SettingsManager().load_settings("users", username)
@@ -1045,6 +976,118 @@ def needsTabDescription(chat_id):
             return False
 
 
+async def generate_tab_description(username, chat_id, all_messages, settings):
+    """Give a chat tab a short title generated from its first messages."""
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a chat tab title generator. You will give a very short description of the given conversation, keep it under 5 words. Do not answer the conversation, only give a title to it! Only reply with the title, nothing else!",
+        },
+        {"role": "user", "content": all_messages},
+    ]
+    response = "New Chat"
+    default_par = default_params
+    default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
+    default_par["model"] = settings.get("active_model").get("active_model")
+    responder = llmcalls.get_responder(
+        (
+            api_keys["openai"]
+            if settings.get("active_model").get("active_model").startswith("gpt")
+            else api_keys["anthropic"]
+        ),
+        settings.get("active_model").get("active_model"),
+        default_par,
+    )
+
+    async for resp in responder.get_response(
+        username,
+        messages,
+        stream=False,
+        function_metadata=fakedata,
+        chat_id=chat_id,
+    ):
+        response = resp
+
+    with ChatTabsDAO() as db:
+        db.update_tab_description(chat_id, response)
+
+    await MessageSender.send_message(
+        {
+            "tab_id": chat_id,
+            "tab_description": response,
+        },
+        "blue",
+        username,
+    )
+
+
+def run_in_background(coroutine):
+    """Run a coroutine without awaiting it, logging it if it fails."""
+    task = asyncio.create_task(coroutine)
+    # the event loop only keeps weak references to its tasks
+    background_tasks.add(task)
+
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Background task failed",
+                exc_info=task.exception(),
+            )
+
+    task.add_done_callback(done)
+    return task
+
+
+async def run_retrieval_stages(stages, deadline=None, shielded=()):
+    """
+    Await the stage coroutines of `stages` concurrently and return their
+    results by name. A stage that raises, or is still running `deadline`
+    seconds after the start, gives None so the reply goes ahead without it.
+    Stages named in `shielded` are left to finish in the background instead
+    of being cancelled at the deadline.
+    """
+    timings = {}
+
+    async def timed(name, coroutine):
+        started = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            timings[name] = time.perf_counter() - started
+
+    async def bounded(name, coroutine):
+        task = asyncio.ensure_future(timed(name, coroutine))
+        if name in shielded:
+            task = asyncio.shield(task)
+        return await asyncio.wait_for(task, deadline)
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(bounded(name, coroutine) for name, coroutine in stages.items()),
+        return_exceptions=True,
+    )
+    results = {}
+    summary = []
+    for name, outcome in zip(stages, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            logger.warning(f"{name} missed the {deadline}s retrieval deadline")
+            summary.append(f"{name} timed out")
+            outcome = None
+        elif isinstance(outcome, BaseException):
+            logger.error(f"{name} failed", exc_info=outcome)
+            summary.append(f"{name} failed")
+            outcome = None
+        else:
+            summary.append(f"{name} {timings[name]:.2f}s")
+        results[name] = outcome
+    logger.info(
+        f"retrieval stages in {time.perf_counter() - started:.2f}s: "
+        + ", ".join(summary)
+    )
+    return results
+
+
 async def process_message(
     og_message,
     username,
@@ -1098,35 +1141,29 @@ async def process_message(
         username, chat_id, regenerate, uuid
     )
 
-    # for message in last_messages:
-    #     print(
-    #         f"{message['metadata'].get('username')}: {message['document']}",
-    #     )
-    last_messages_string = "\n".join(
-        f"{message['metadata'].get('username')}: {message['document']}"
-        for message in last_messages[-100:]
-    )
+    last_messages = last_messages[-100:]
 
-    # keep the last messages below 1000 tokens, if it is above 1000 tokens, delete the oldest messages until it is below 1000 tokens
-    last_messages_tokens = MessageParser.num_tokens_from_string(
-        last_messages_string, "gpt-4"
-    )
+    # keep the last messages below tokens_recent_messages by dropping the oldest ones,
+    # counting each message's cached line tokens plus one token per newline between them
+    last_messages_tokens = sum(message["tokens"] for message in last_messages)
+    last_messages_tokens += max(len(last_messages) - 1, 0)
     if tokens_recent_messages > 100:
         logger.debug(
             f"last_messages_tokens: {last_messages_tokens} count: {len(last_messages)}"
         )
-        while last_messages_tokens > tokens_recent_messages:
-            last_messages.pop(0)
-            last_messages_string = "\n".join(
-                f"{message['metadata'].get('username')}: {message['document']}"
-                for message in last_messages[-100:]
-            )
-            last_messages_tokens = MessageParser.num_tokens_from_string(
-                last_messages_string, "gpt-4"
-            )
-            logger.debug(
-                f"new last_messages_tokens: {last_messages_tokens} count: {len(last_messages)}"
-            )
+        dropped = 0
+        while last_messages_tokens > tokens_recent_messages and dropped < len(
+            last_messages
+        ):
+            last_messages_tokens -= last_messages[dropped]["tokens"] + 1
+            dropped += 1
+        last_messages = last_messages[dropped:]
+        last_messages_string = "\n".join(
+            history_line(message) for message in last_messages
+        )
+        logger.debug(
+            f"new last_messages_tokens: {last_messages_tokens} count: {len(last_messages)}"
+        )
     else:
         last_messages_string = ""
 
@@ -1140,47 +1177,9 @@ async def process_message(
     with ChatTabsDAO() as dao:
         needs_tab_description = dao.needs_tab_description(chat_id)
     if needs_tab_description and len(last_messages) >= 2:
-        response = None
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a chat tab title generator. You will give a very short description of the given conversation, keep it under 5 words. Do not answer the conversation, only give a title to it! Only reply with the title, nothing else!",
-            },
-            {"role": "user", "content": all_messages},
-        ]
-        response = "New Chat"
-        default_par = default_params
-        default_par["max_tokens"] = settings.get("memory", {}).get("output", 1000)
-        default_par["model"] = settings.get("active_model").get("active_model")
-        responder = llmcalls.get_responder(
-            (
-                api_keys["openai"]
-                if settings.get("active_model").get("active_model").startswith("gpt")
-                else api_keys["anthropic"]
-            ),
-            settings.get("active_model").get("active_model"),
-            default_par,
-        )
-
-        async for resp in responder.get_response(
-            username,
-            messages,
-            stream=False,
-            function_metadata=fakedata,
-            chat_id=chat_id,
-        ):
-            response = resp
-
-        with ChatTabsDAO() as db:
-            db.update_tab_description(chat_id, response)
-
-        await MessageSender.send_message(
-            {
-                "tab_id": chat_id,
-                "tab_description": response,
-            },
-            "blue",
-            username,
+        # the title does not feed the reply, so it does not hold it up
+        run_in_background(
+            generate_tab_description(username, chat_id, all_messages, settings)
         )
 
     message_tokens = MessageParser.num_tokens_from_string(all_messages, "gpt-4")
@@ -1194,29 +1193,25 @@ async def process_message(
         memory.model_used = settings["active_model"]["active_model"]
         # Use the provided timestamp instead of the current time
         custom_metadata = {"created_at": timestamp.timestamp()} if timestamp else {}
-        (
-            kw_brain_string,
-            token_usage_active_brain,
-            unique_results1,
-        ) = await memory.process_active_brain(
-            og_message,
-            username,
-            all_messages,
-            tokens_active_brain,
-            verbose,
-            chat_id=chat_id,
-            regenerate=regenerate,
-            uid=uuid,
-            settings=settings,
-            custom_metadata=custom_metadata,
-        )
-
-        token_usage += token_usage_active_brain
-        remaining_tokens -= token_usage_active_brain
-        logger.debug(f"2. remaining_tokens: {remaining_tokens}")
 
+        # the stages only read og_message and all_messages, so they run
+        # concurrently and their token usage is added up once all are back
+        stages = {
+            "active_brain": memory.process_active_brain(
+                og_message,
+                username,
+                all_messages,
+                tokens_active_brain,
+                verbose,
+                chat_id=chat_id,
+                regenerate=regenerate,
+                uid=uuid,
+                settings=settings,
+                custom_metadata=custom_metadata,
+            )
+        }
         if tokens_episodic_memory > 100:
-            episodic_memory, timezone = await memory.process_episodic_memory(
+            stages["episodic_memory"] = memory.process_episodic_memory(
                 og_message,
                 username,
                 all_messages,
@@ -1224,18 +1219,52 @@ async def process_message(
                 verbose,
                 settings,
             )
-            if (
-                episodic_memory is None
-                or episodic_memory == ""
-                or episodic_memory == "none"
-            ):
-                episodic_memory_string = ""
-            else:
-                episodic_memory_string = (
-                    f"""Episodic Memory of {timezone}:\n{episodic_memory}\n"""
-                )
-        else:
+        if tokens_cat_brain > 100:
+            stages["incoming_memory"] = memory.process_incoming_memory(
+                None, og_message, username, tokens_cat_brain, verbose, settings
+            )
+        if tokens_notes > 100:
+            stages["notes"] = memory.note_taking(
+                content=all_messages,
+                message=og_message,
+                user_dir=users_dir,
+                username=username,
+                show=False,
+                verbose=verbose,
+                tokens_notes=tokens_notes,
+                settings=settings,
+            )
+        stage_results = await run_retrieval_stages(
+            stages,
+            deadline=RETRIEVAL_DEADLINE,
+            # the stage stores the user's message, it must not be cut off
+            shielded={"active_brain"},
+        )
+
+        (
+            kw_brain_string,
+            token_usage_active_brain,
+            unique_results1,
+        ) = stage_results.get("active_brain") or ("", 0, set())
+
+        token_usage += token_usage_active_brain
+        remaining_tokens -= token_usage_active_brain
+        logger.debug(f"2. remaining_tokens: {remaining_tokens}")
+
+        episodic_memory, timezone = stage_results.get("episodic_memory") or (
+            None,
+            None,
+        )
+        if (
+            episodic_memory is None
+            or episodic_memory == ""
+            or episodic_memory == "none"
+        ):
             episodic_memory_string = ""
+        else:
+            episodic_memory_string = (
+                f"""Episodic Memory of {timezone}:\n{episodic_memory}\n"""
+            )
         episodic_memory_tokens = MessageParser.num_tokens_from_string(
             episodic_memory_string, "gpt-4"
         )
@@ -1243,14 +1272,12 @@ async def process_message(
         remaining_tokens -= episodic_memory_tokens
         logger.debug(f"3. remaining_tokens: {remaining_tokens}")
 
-        if tokens_cat_brain > 100:
+        if stage_results.get("incoming_memory") is not None:
             (
                 results,
                 token_usage_relevant_memory,
                 unique_results2,
-            ) = await memory.process_incoming_memory(
-                None, og_message, username, tokens_cat_brain, verbose, settings
-            )
+            ) = stage_results["incoming_memory"]
             merged_results_dict = {
                 id: (document, distance, formatted_date)
                 for id, document, distance, formatted_date in unique_results1.union(
@@ -1289,21 +1316,10 @@ async def process_message(
             f"""{episodic_memory_string}\nObservations:\n{observations}\n"""
         )
 
-        if tokens_notes > 100:
-            notes = await memory.note_taking(
-                content=all_messages,
-                message=og_message,
-                user_dir=users_dir,
-                username=username,
-                show=False,
-                verbose=verbose,
-                tokens_notes=tokens_notes,
-                settings=settings,
-            )
-
-            if notes is not None or notes != "":
-                notes_string = prompts.notes_string.format(notes)
-                instruction_string += notes_string
+        notes = stage_results.get("notes")
+        if notes is not None:
+            notes_string = prompts.notes_string.format(notes)
+            instruction_string += notes_string
         else:
             notes = ""
             notes_string = ""